@@ -0,0 +1,172 @@
+'''
+Offline benchmark of the check engines over simulated proxies (see `simulated.py`).
+
+Checks 10k-100k simulated HTTP/SOCKS4/SOCKS5 proxies (with some latency, failing, blackholed
+and dead ones) against a local judge, and reports:
+jobs/sec, p50/p99 latency of the working checks, time to the first check and peak RSS.
+
+The results can be saved as a baseline, later runs compare against it and fail on a regression.
+
+    $ python benchmarks/bench_checker.py --engine async --proxies 100000 --save-baseline
+    $ python benchmarks/bench_checker.py --engine async --proxies 100000
+'''
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from json import dumps, loads
+from pathlib import Path
+from time import time
+from multiprocessing import cpu_count
+import resource
+import sys
+
+from simulated import Behavior, ProxyFarm
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from proxion.checker import ProxyChecker, AsyncProxyChecker, CheckerFilter  # noqa: E402
+
+
+engines = {
+    'process': ProxyChecker,
+    'async': AsyncProxyChecker,
+}
+
+# The metrics compared against the baseline, and whether higher is better
+metrics = {
+    'jobs_per_sec': True,
+    'p50_latency': False,
+    'p99_latency': False,
+    'first_check': False,
+    'peak_rss_mb': False,
+}
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def instrument(engine: type) -> type:
+    class Recording(engine):
+        ''' Records when every result arrived and the latency of the working checks '''
+
+        def on_result(self, pip, result, checked_at):
+            super().on_result(pip, result, checked_at)
+            self.arrivals.append(time())
+            if result is not None:
+                self.check_latencies.append(result.last_lat)
+    return Recording
+
+
+def run(args) -> dict:
+    behavior = Behavior(args.latency, args.jitter, args.failure_rate, args.blackhole_rate,
+                        args.dead_rate, args.seed)
+    with ProxyFarm(behavior, args.farm_procs) as farm:
+        checklist, expected = behavior.proxies(args.proxies, farm.ports, not args.unknown_protocols)
+
+        checker_cls = instrument(engines[args.engine])
+        checker_cls.arrivals = []
+        checker_cls.check_latencies = []
+        started = time()
+        with redirect_stdout(StringIO()):
+            checker = checker_cls(checklist, args.workers, args.timeout,
+                                  CheckerFilter(set(), None, None, None, False),
+                                  judge=farm.judge, judge_parser='json')
+        elapsed = time() - started
+        # Read before the farm process is reaped, so only the checker's children count
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    arrivals = checker.arrivals
+    return {
+        'engine': args.engine,
+        'proxies': args.proxies,
+        'jobs': len(arrivals),
+        'working': len(checker.up),
+        'expected_working': expected,
+        'elapsed': elapsed,
+        'jobs_per_sec': len(arrivals) / elapsed,
+        'p50_latency': percentile(checker.check_latencies, 0.5),
+        'p99_latency': percentile(checker.check_latencies, 0.99),
+        'first_check': arrivals[0] - started if arrivals else float('nan'),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children_rss) / 1024,
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    ''' The metrics that regressed by more than `tolerance` (a fraction) '''
+    regressions = []
+    for name, higher_is_better in metrics.items():
+        old, new = baseline.get(name), result[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f'{name}: {old:.4g} -> {new:.4g} ({change:+.0%})')
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser()
+    parser.add_argument('--engine', choices=engines, default='async')
+    parser.add_argument('--proxies', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes or concurrent checks of the engine (default: 8 / 500)')
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--unknown-protocols', action='store_true',
+                        help='Check every proxy for all the protocols, not just its own')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean latency of the working proxies')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency spread, as a fraction of it')
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--blackhole-rate', type=float, default=0.05)
+    parser.add_argument('--dead-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--farm-procs', type=int, default=max(1, cpu_count() // 2),
+                        help='Processes serving the simulated proxies')
+    parser.add_argument('--baseline', type=str,
+                        help='Baseline file (default: benchmarks/baselines/checker-<engine>-<proxies>.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fail if a metric is worse than the baseline by more than this fraction')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = 8 if args.engine == 'process' else 500
+
+    result = run(args)
+    if args.json:
+        print(dumps(result))
+    else:
+        print(f'{result["jobs"]} jobs over {result["proxies"]} proxies on the {args.engine} engine '
+              f'in {result["elapsed"]:.2f}s')
+        print(f'  jobs/sec:     {result["jobs_per_sec"]:.0f}')
+        print(f'  p50 latency:  {result["p50_latency"] * 1000:.1f} ms')
+        print(f'  p99 latency:  {result["p99_latency"] * 1000:.1f} ms')
+        print(f'  first check:  {result["first_check"] * 1000:.0f} ms')
+        print(f'  peak RSS:     {result["peak_rss_mb"]:.0f} MiB')
+        print(f'  working:      {result["working"]} (expected {result["expected_working"]})')
+
+    failed = False
+    if result['working'] != result['expected_working']:
+        print('FAIL: the working checks differ from the simulated proxies')
+        failed = True
+
+    baseline_file = Path(args.baseline) if args.baseline else \
+        Path(__file__).parent / 'baselines' / f'checker-{args.engine}-{args.proxies}.json'
+    if args.save_baseline:
+        baseline_file.parent.mkdir(exist_ok=True)
+        baseline_file.write_text(dumps(result, indent=4) + '\n')
+        print(f'Saved the baseline: {baseline_file}')
+    elif baseline_file.is_file():
+        regressions = compare(result, loads(baseline_file.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        failed |= bool(regressions)
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+'''
+Throughput regression benchmark of the process check engine.
+
+Checks a long list of simulated (see `simulated.py`), always working HTTP proxies
+and reports the checks/sec of every tenth of the run.
+The rate should hold steady until the job list is exhausted, a drop means children are leaving the pool early.
+
+    $ python benchmarks/bench_checker_throughput.py --jobs 5000 --workers 8
+'''
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from time import time
+import sys
+
+from simulated import Behavior, ProxyFarm, simulated_ip
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from proxion.util import Proxy  # noqa: E402
+from proxion.checker import ProxyChecker, CheckerFilter  # noqa: E402
+
+
+class RecordingChecker(ProxyChecker):
+    ''' Records when every result arrived '''
+
+    def on_result(self, pip, result, checked_at):
+        super().on_result(pip, result, checked_at)
+        self.arrivals.append(time())
+
+
+def main() -> int:
+    parser = ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.01, help='Latency of the simulated proxies')
+    parser.add_argument('--farm-procs', type=int, default=1, help='Processes serving the simulated proxies')
+    parser.add_argument('--min-ratio', type=float, default=0.5,
+                        help='Fail if any tenth of the run is slower than this ratio of the median')
+    args = parser.parse_args()
+
+    behavior = Behavior(args.latency, jitter=0, failure_rate=0, blackhole_rate=0, dead_rate=0)
+    with ProxyFarm(behavior, args.farm_procs) as farm:
+        checklist = [Proxy(f'{simulated_ip(i)}:{farm.ports["http"]}', ['http']) for i in range(args.jobs)]
+
+        RecordingChecker.arrivals = []
+        started = time()
+        with redirect_stdout(StringIO()):
+            checker = RecordingChecker(checklist, args.workers, 5,
+                                       CheckerFilter(set(), None, None, None, False),
+                                       judge=farm.judge, judge_parser='json')
+        elapsed = time() - started
+    arrivals = checker.arrivals
+
+    print(f'{len(arrivals)}/{args.jobs} checks ({len(checker.up)} working) '
+          f'in {elapsed:.2f}s = {len(arrivals) / elapsed:.0f} checks/sec')
+    if len(arrivals) < args.jobs:
+        print('FAIL: not all the jobs were checked')
+        return 1
+
+    step = len(arrivals) // 10
+    rates = []
+    for i in range(10):
+        window = arrivals[i * step:(i + 1) * step]
+        rates.append(len(window) / max(window[-1] - window[0], 1e-6))
+    print('checks/sec per tenth: ' + ' '.join(f'{rate:.0f}' for rate in rates))
+
+    median = sorted(rates)[5]
+    if min(rates) < median * args.min_ratio:
+        print(f'FAIL: throughput dropped below {args.min_ratio:.0%} of the median')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+'''
+CLI startup benchmark: how long short `proxion` invocations take, as scripts run them.
+
+Runs every command `--runs` times in a fresh interpreter against a synthetic DB
+(see `bench_storage.py`), and reports the median / p90 wall time of each,
+the import time of `proxion.__main__` and the heavy modules it imported (there should be none).
+
+The results can be saved as a baseline, later runs compare against it and fail on a regression.
+
+    $ python benchmarks/bench_startup.py --save-baseline
+    $ python benchmarks/bench_startup.py
+'''
+from argparse import ArgumentParser
+from json import dumps, loads
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import subprocess
+import sys
+
+from bench_storage import synthetic_proxies
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from proxion.util import ProxyDB  # noqa: E402
+
+
+commands = {
+    'query_1': ['query', '-n', '1', '-f', 'grep'],
+    'add_1': ['add', '1.2.3.4:80'],
+    'help': ['--help'],
+}
+# Only the modes checking or serving should import those
+heavy_modules = ('requests', 'urllib3', 'asyncio', 'multiprocessing', 'ssl', 'cProfile')
+
+
+def run_proxion(args: list, env: dict) -> float:
+    started = perf_counter()
+    subprocess.run([sys.executable, '-m', 'proxion', *args], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return perf_counter() - started
+
+
+def import_profile(env: dict) -> dict:
+    ''' How long importing `proxion.__main__` takes and the heavy modules it imported '''
+    code = ('from time import perf_counter; import json, sys; started = perf_counter(); '
+            'import proxion.__main__; '
+            'print(json.dumps([perf_counter() - started, '
+            f'[m for m in {heavy_modules!r} if m in sys.modules]]))')
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+    import_time, imported = loads(out.stdout)
+    return {'import_time': import_time, 'heavy_modules': imported}
+
+
+def run(args) -> dict:
+    with TemporaryDirectory() as home:
+        store = Path(home, '.cache', 'proxion')
+        store.mkdir(parents=True)
+        ProxyDB(store / args.db_file)
+        ProxyDB.update_some(synthetic_proxies(args.proxies))
+        ProxyDB.storage.close()
+        ProxyDB.storage = None
+
+        env = dict(os.environ, HOME=home, PYTHONPATH=str(ROOT))
+        result = {'proxies': args.proxies, 'db_file': args.db_file, **import_profile(env)}
+        for name, command in commands.items():
+            if name != 'help':
+                command = ['--db-file', args.db_file, *command]
+            times = sorted(run_proxion(command, env) for _ in range(args.runs))
+            result[f'{name}_median'] = median(times)
+            result[f'{name}_p90'] = times[min(int(0.9 * len(times)), len(times) - 1)]
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    ''' The timings that regressed by more than `tolerance` (a fraction) '''
+    regressions = []
+    for name in ['import_time'] + [f'{command}_median' for command in commands]:
+        old, new = baseline.get(name), result[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        if change > tolerance:
+            regressions.append(f'{name}: {old * 1000:.1f} -> {new * 1000:.1f} ms ({change:+.0%})')
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser()
+    parser.add_argument('--proxies', type=int, default=100000, help='Proxies in the synthetic DB')
+    parser.add_argument('--db-file', type=str, default='proxydb.sqlite',
+                        help='The DB file name, its extension picks the storage (.json or SQLite)')
+    parser.add_argument('--runs', type=int, default=20, help='Runs of every command')
+    parser.add_argument('--baseline', type=str,
+                        help='Baseline file (default: benchmarks/baselines/startup-<db file>.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fail if a timing is worse than the baseline by more than this fraction')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(dumps(result))
+    else:
+        print(f'Startup over {result["proxies"]} proxies in {result["db_file"]} ({args.runs} runs)')
+        print(f'  import proxion.__main__: {result["import_time"] * 1000:.1f} ms')
+        for name in commands:
+            print(f'  {name + ":":<9} median {result[f"{name}_median"] * 1000:.1f} ms, '
+                  f'p90 {result[f"{name}_p90"] * 1000:.1f} ms')
+
+    failed = False
+    if result['heavy_modules']:
+        print(f'FAIL: proxion.__main__ imports {", ".join(result["heavy_modules"])}')
+        failed = True
+
+    baseline_file = Path(args.baseline) if args.baseline else \
+        Path(__file__).parent / 'baselines' / f'startup-{args.db_file}.json'
+    if args.save_baseline:
+        baseline_file.parent.mkdir(exist_ok=True)
+        baseline_file.write_text(dumps(result, indent=4) + '\n')
+        print(f'Saved the baseline: {baseline_file}')
+    elif baseline_file.is_file():
+        regressions = compare(result, loads(baseline_file.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        failed |= bool(regressions)
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+'''
+Storage and query micro-benchmarks of the ProxyDB over synthetic databases.
+
+For every storage format and DB size, times:
+adding all the proxies (and saving), loading the DB, reading all of them back (get_proxies),
+deserializing one, `proxion query` (random picks and a filtered one), update/remove round-trips
+of a single proxy and removing 1% of them in a batch.
+Also reports the file size and the memory held by the loaded proxies.
+
+Every measurement is printed as a JSON line, so runs can be compared by a script:
+
+    $ python benchmarks/bench_storage.py --sizes 1000 10000 100000 > storage.jsonl
+    $ python benchmarks/bench_storage.py --formats sqlite --sizes 5000000
+'''
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from io import StringIO
+from json import dumps
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+import gc
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from proxion.util import Proxy, ProxyDB  # noqa: E402
+from proxion.util.proxy import PROTOCOLS  # noqa: E402
+from proxion.util.storage import JSONStorage, deserialize  # noqa: E402
+from proxion.__main__ import query  # noqa: E402
+
+
+COUNTRIES = ('US', 'DE', 'FR', 'BR', 'CN', 'RU', 'IN', 'GB', 'NL', 'ID')
+PORTS = (80, 443, 1080, 3128, 8080, 9050)
+
+
+def synthetic_proxies(count: int, start: int = 0, seed: int = 0) -> list:
+    '''
+    `count` distinct proxies (the `start`-th onwards), most of them checked with some history,
+    some never checked
+    '''
+    rand = Random(f'{seed}:{start}')
+    now = time()
+    proxies = []
+    for i in range(start, start + count):
+        ip = f'{1 + (i >> 24) % 223}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}'
+        proxy = Proxy(f'{ip}:{rand.choice(PORTS)}')
+        if rand.random() < 0.8:
+            proxy.protos = rand.sample(PROTOCOLS, rand.randint(1, 2))
+            proxy.last_check = now - rand.random() * 86400 * 30
+            proxy.last_lat = rand.random() * 5
+            proxy.exit_country = rand.choice(COUNTRIES)
+            for _ in range(rand.randint(1, 16)):
+                proxy.record(rand.random() < 0.8, rand.random() * 5)
+        proxies.append(proxy)
+    return proxies
+
+
+class Recorder:
+    def __init__(self, fmt: str, size: int):
+        self.fmt = fmt
+        self.size = size
+
+    def emit(self, metric: str, value: float, unit: str) -> None:
+        print(dumps({'format': self.fmt, 'size': self.size, 'metric': metric, 'value': value, 'unit': unit}),
+              flush=True)
+
+    @contextmanager
+    def timed(self, metric: str, repeat: int = 1):
+        ''' Time the block, per repetition if it repeats the operation `repeat` times '''
+        gc.collect()
+        started = perf_counter()
+        yield
+        self.emit(metric, (perf_counter() - started) / repeat, 'sec')
+
+
+def bench(fmt: str, size: int, workdir: Path, repeat: int) -> None:
+    recorder = Recorder(fmt, size)
+    proxies = synthetic_proxies(size)
+    db_file = workdir / f'bench-{size}.{fmt}'
+
+    ProxyDB(db_file)
+    with recorder.timed('add_all'):
+        ProxyDB.update_some(proxies)
+    # SQLite may still hold some of the writes in its WAL
+    wal_file = db_file.with_name(db_file.name + '-wal')
+    recorder.emit('file_size', db_file.stat().st_size + (wal_file.stat().st_size if wal_file.exists() else 0),
+                  'bytes')
+
+    with recorder.timed('load'):
+        ProxyDB(db_file)
+        if isinstance(ProxyDB.storage, JSONStorage):
+            # It's parsed on first use
+            ProxyDB.storage.dict_config
+
+    tracemalloc.start()
+    with recorder.timed('get_proxies'):
+        loaded = ProxyDB.get_proxies(do_shuffle=False)
+    recorder.emit('memory', tracemalloc.get_traced_memory()[0], 'bytes')
+    tracemalloc.stop()
+    del loaded
+
+    info = proxies[0].serialize()[proxies[0].pip]
+    with recorder.timed('deserialize', repeat * 100):
+        for _ in range(repeat * 100):
+            deserialize(proxies[0].pip, info)
+
+    with recorder.timed('query_random_100', repeat):
+        for _ in range(repeat):
+            query(StringIO(), 100)
+    with recorder.timed('query_filtered', repeat):
+        for _ in range(repeat):
+            query(StringIO(), 0, True, 'jsonl', protos={'socks5'}, countries=['US'], max_latency=1)
+
+    # Single proxy round-trips, each one saved
+    extra = synthetic_proxies(repeat, size)
+    with recorder.timed('update_one', repeat):
+        for proxy in extra:
+            ProxyDB.update_one(proxy)
+    with recorder.timed('remove_one', repeat):
+        for proxy in extra:
+            ProxyDB.remove_one(proxy)
+
+    batch = proxies[::100]
+    with recorder.timed('remove_some_1pct'):
+        ProxyDB.remove_some(batch)
+    ProxyDB.storage.close()
+    ProxyDB.storage = None
+
+
+def main() -> int:
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--formats', nargs='+', choices=('json', 'sqlite'), default=['json', 'sqlite'])
+    parser.add_argument('--repeat', type=int, default=10, help='Repetitions of the quick operations')
+    parser.add_argument('--workdir', type=str,
+                        help='Where to create the DBs (default: a temporary directory)')
+    args = parser.parse_args()
+
+    with TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            for fmt in args.formats:
+                bench(fmt, size, Path(workdir), args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
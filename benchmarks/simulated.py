@@ -0,0 +1,234 @@
+'''
+Simulated proxies for offline benchmarks.
+
+A `ProxyFarm` runs (in processes of its own, so it doesn't skew the measurements) a local judge
+and one fake HTTP, SOCKS4 and SOCKS5 proxy server, listening on every loopback address.
+Linux routes the whole 127.0.0.0/8 to the loopback, so every 127.x.y.z address is a simulated
+proxy of its own: the address decides (deterministically, by the seed) how it behaves -
+working after some latency, failing (closing the connection right away),
+a blackhole (accepting but never answering) or dead (nothing listening).
+'''
+from ipaddress import IPv4Address
+from random import Random
+from struct import unpack
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+import asyncio
+import multiprocessing as mp
+import socket
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from proxion.util import Proxy  # noqa: E402
+from proxion.server import JudgeServer  # noqa: E402
+from proxion.checker.async_checker import raise_open_files_limit  # noqa: E402
+
+
+KINDS = ('http', 'socks4', 'socks5')
+# The protocols a check finds working on every kind of simulated proxy
+KIND_PROTOCOLS = {'http': ('http', 'https'), 'socks4': ('socks4',), 'socks5': ('socks5',)}
+
+
+def simulated_ip(i: int) -> str:
+    ''' The i-th simulated proxy address, 127.1.0.0 onwards (leaving 127.0.x.x alone) '''
+    return str(IPv4Address((127 << 24) + (1 << 16) + i))
+
+
+class Behavior:
+    ''' How the simulated proxies behave, a proxy's own behavior is drawn from its address '''
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, failure_rate: float = 0.1,
+                 blackhole_rate: float = 0.05, dead_rate: float = 0.05, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.blackhole_rate = blackhole_rate
+        self.dead_rate = dead_rate
+        self.seed = seed
+
+    def of(self, ip: str) -> Tuple[str, float]:
+        '''
+        returns -> (one of 'dead', 'blackhole', 'fail', 'ok', the latency of a working proxy)
+        '''
+        rand = Random(f'{self.seed}:{ip}')
+        draw = rand.random()
+        latency = self.latency * (1 + self.jitter * (2 * rand.random() - 1))
+        for outcome, rate in (('dead', self.dead_rate), ('blackhole', self.blackhole_rate),
+                              ('fail', self.failure_rate)):
+            if draw < rate:
+                return outcome, latency
+            draw -= rate
+        return 'ok', latency
+
+    def proxies(self, count: int, ports: Dict[str, int],
+                known_protocols: bool = True) -> Tuple[List[Proxy], int]:
+        '''
+        The simulated proxies (of every kind in turn), dead ones pointing to a closed port
+
+        returns -> (proxies, how many checks should find a working protocol)
+        '''
+        proxies = []
+        working = 0
+        for i in range(count):
+            ip = simulated_ip(i)
+            kind = KINDS[i % len(KINDS)]
+            outcome, _ = self.of(ip)
+            port = ports['dead'] if outcome == 'dead' else ports[kind]
+            if outcome == 'ok':
+                working += 1 if known_protocols else len(KIND_PROTOCOLS[kind])
+            proxies.append(Proxy(f'{ip}:{port}', [kind] if known_protocols else None))
+        return proxies, working
+
+
+async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def relay(reader, writer, host: str, port: int, reply: bytes, first: bytes = b'') -> None:
+    up_reader, up_writer = await asyncio.open_connection(host, port)
+    writer.write(reply)
+    up_writer.write(first)
+    await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+
+
+async def serve_http(reader, writer) -> None:
+    head = await reader.readuntil(b'\r\n\r\n')
+    method, target, rest = head.split(b' ', 2)
+    if method == b'CONNECT':
+        host, port = target.decode().rsplit(':', 1)
+        await relay(reader, writer, host, int(port), b'HTTP/1.1 200 Connection established\r\n\r\n')
+    else:
+        url = urlsplit(target.decode())
+        path = (url.path or '/') + ('?' + url.query if url.query else '')
+        await relay(reader, writer, url.hostname, url.port or 80, b'',
+                    method + b' ' + path.encode() + b' ' + rest)
+
+
+async def serve_socks4(reader, writer) -> None:
+    version, command, port = unpack('>BBH', await reader.readexactly(4))
+    address = await reader.readexactly(4)
+    await reader.readuntil(b'\x00')  # User ID
+    if version != 4 or command != 1:
+        return
+    host = str(IPv4Address(address))
+    if address[:3] == b'\x00\x00\x00':  # SOCKS4a
+        host = (await reader.readuntil(b'\x00'))[:-1].decode()
+    await relay(reader, writer, host, port, b'\x00\x5a' + bytes(6))
+
+
+async def serve_socks5(reader, writer) -> None:
+    version, methods = await reader.readexactly(2)
+    await reader.readexactly(methods)
+    if version != 5:
+        return
+    writer.write(b'\x05\x00')
+    _, command, _, atyp = await reader.readexactly(4)
+    if atyp == 1:
+        host = str(IPv4Address(await reader.readexactly(4)))
+    elif atyp == 3:
+        host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+    else:
+        return
+    port = unpack('>H', await reader.readexactly(2))[0]
+    if command != 1:
+        return
+    await relay(reader, writer, host, port, b'\x05\x00\x00\x01' + bytes(6))
+
+
+servers = {'http': serve_http, 'socks4': serve_socks4, 'socks5': serve_socks5}
+
+
+def simulate(kind: str, behavior: Behavior):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ip = writer.get_extra_info('sockname')[0]
+        try:
+            # Listening on every address, but only the loopback ones are simulated proxies
+            if not ip.startswith('127.'):
+                return
+            outcome, latency = behavior.of(ip)
+            if outcome == 'blackhole':
+                await reader.read()
+                return
+            if outcome == 'fail':
+                return
+            await asyncio.sleep(latency)
+            await servers[kind](reader, writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+def closed_port() -> int:
+    ''' A port nothing listens on (connections get refused) '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_farm(behavior: Behavior, ports: Dict[str, int], conn) -> None:
+    ''' Serve the judge and the proxies on the `ports` of the other farm processes (or new ones) '''
+    async def main():
+        raise_open_files_limit(65536)
+        judge = JudgeServer('127.0.0.1', ports.get('judge', 0))
+        judge.server = await asyncio.start_server(judge.handle, '127.0.0.1', judge.port, reuse_port=True)
+        bound = {'judge': judge.server.sockets[0].getsockname()[1],
+                 'dead': ports.get('dead') or closed_port()}
+        for kind in KINDS:
+            server = await asyncio.start_server(simulate(kind, behavior), '0.0.0.0', ports.get(kind, 0),
+                                                backlog=4096, reuse_port=True)
+            bound[kind] = server.sockets[0].getsockname()[1]
+        conn.send(bound)
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+class ProxyFarm:
+    '''
+    Runs the simulated proxies (and the judge) in `procs` child processes,
+    sharing the same ports (SO_REUSEPORT) so the kernel spreads the connections between them
+    '''
+
+    def __init__(self, behavior: Behavior, procs: int = 2):
+        self.behavior = behavior
+        self.procs = procs
+        self.ports: Dict[str, int] = {}
+        self._procs = []
+
+    @property
+    def judge(self) -> str:
+        return f'http://127.0.0.1:{self.ports["judge"]}/'
+
+    def start(self) -> Dict[str, int]:
+        for _ in range(self.procs):
+            parent, child = mp.Pipe()
+            proc = mp.Process(target=run_farm, args=(self.behavior, self.ports, child), daemon=True)
+            proc.start()
+            self._procs.append(proc)
+            self.ports = parent.recv()
+        return self.ports
+
+    def stop(self) -> None:
+        for proc in self._procs:
+            proc.terminate()
+            proc.join()
+        self._procs = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
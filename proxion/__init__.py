@@ -1,11 +1,23 @@
+from typing import TYPE_CHECKING
+
 from .util import (
     InvalidProxyFormatError,
     is_proxy_format,
     is_ip_address,
     Proxy,
     parse_proxies_file,
-    ProxyDB
+    lazy_exports,
 )
 from .config import Config, Defaults
-from .checker import ProxyChecker
-from .__main__ import main
+
+if TYPE_CHECKING:
+    from .util import ProxyDB
+    from .checker import ProxyChecker
+    from .__main__ import main
+
+# Imported on first use, so every `proxion` run imports only what its mode needs
+__getattr__ = lazy_exports(__name__, {
+    'ProxyDB': '.util',
+    'ProxyChecker': '.checker',
+    'main': '.__main__',
+})
@@ -1,20 +1,25 @@
 #!/bin/env python3
 import sys
 from pathlib import Path
-from typing import Iterable, Set
-from json import dumps
+from typing import Iterable, Set, TextIO
 
 from interutils import pr, cyan
 
 from proxion.util import (
     is_proxy_format,
+    is_proxy_list,
     InvalidProxyFormatError,
+    parse_time_string,
     Proxy,
     parse_proxies_file,
+    ProxyListReader,
     ProxyDB,
+    ProxyDBCommitter,
+    GeoIP,
+    Profiler,
 )
+from proxion.util.output import writers
 from proxion import Config, Defaults
-from proxion.checker import ProxyChecker, CheckerFilter
 
 
 def main() -> int:
@@ -22,9 +27,24 @@ def main() -> int:
     if not args:
         return 1
 
+    if not args.profile:
+        return run(args)
+    Profiler.start(Path(args.profile))
+    try:
+        return run(args)
+    finally:
+        Profiler.stop()
+
+
+def run(args) -> int:
+    # The judge doesn't need the DB
+    if args.mode.lower().startswith('j'):
+        return judge(args)
+
     if args.verbose:
         pr('Loading proxy DB.. ', '*', end='')
-    ProxyDB(Config.get_db_file())
+    with Profiler.phase('load db'):
+        ProxyDB(Config.get_db_file())
     if args.verbose:
         print('Done!')
 
@@ -34,7 +54,10 @@ def main() -> int:
 
     # Modify
     mode = args.mode.lower()
-    if mode.startswith('a'):
+    if mode == 'api':
+        return api(args)
+
+    elif mode.startswith('a'):
         mod('add', args.proxies, args.submode)
 
     elif mode.startswith('r'):
@@ -42,33 +65,76 @@ def main() -> int:
 
     # Query
     elif mode.startswith('q'):
-        buffer = query(args.num, args.no_shuffle,
-                       args.format, args.json_inline, args.info, args.protocols)
+        query_args = (args.num, args.no_shuffle,
+                      args.format, args.json_inline, args.info, set(args.protocols or ()),
+                      args.country, args.max_latency,
+                      parse_time_string(args.fresh) if args.fresh else None, args.order,
+                      args.min_reliability)
         if args.output:
             output_f = Path(args.output)
             pr(f'Dumping into "{cyan(output_f.resolve())}"', '*')
-            output_f.write_text(buffer)
+            with output_f.open('w', newline='') as stream:
+                query(stream, *query_args)
         else:
-            print(buffer)
+            query(sys.stdout, *query_args)
 
     # Checker
     elif mode.startswith('c'):
         checker(args)
 
+    # Gateway
+    elif mode.startswith('s'):
+        return serve(args)
+
+
+# Every mode imports what it needs (the checkers and the servers) by itself, keeping startup fast
+def judge(args) -> int:
+    from proxion.server.judge import JudgeServer, make_ssl_context
+
+    ssl_context = make_ssl_context(args.cert, args.key) if args.cert else None
+    JudgeServer(args.host, args.port, ssl_context, args.verbose).run()
+    return 0
+
+
+def serve(args) -> int:
+    from proxion.server.gateway import GatewayServer
+
+    protocols = frozenset(args.protocols or Defaults.checker_proxy_protocols)
+
+    def source() -> Iterable[Proxy]:
+        for proxy in ProxyDB.query(protocols, args.country, args.max_latency,
+                                   min_reliability=args.min_reliability):
+            # Use only the requested protocols of the proxy
+            proxy.protos = proxy.protos & protocols
+            yield proxy
+
+    committer = ProxyDBCommitter() if args.save else None
+    GatewayServer(args.host, args.port, source, args.strategy, committer,
+                  args.retries, args.pool_size, verbose=args.verbose).run()
+    return 0
+
+
+def api(args) -> int:
+    from proxion.server.api import ApiServer
+
+    ApiServer(args.host, args.port, Config.get_db_file(), args.reload_interval, args.verbose).run()
+    return 0
+
 
 def mod(mode: str, proxies: Iterable[str], submode: str):
     def _mod_from_file(action: str, path: Path) -> int:
         '''
-        Attempt to read file and for each line update/remove proxy in the DB.
+        Stream the file (or stdin for '-') and update/remove its proxies in the DB batch by batch.
         Catches exceptions.
 
         returns -> int: Count of proxies modified
         '''
         pr(f'{action}ing from a proxy list: {cyan(str(path))}')
-        method = ProxyDB.update_some if action == 'Add' else ProxyDB.remove_some
-        count = method(parse_proxies_file(path))
+        reader = ProxyListReader([path])
+        count = ProxyDB.ingest(reader, remove=action != 'Add')
+        reader.report(path)
         if not count:
-            return pr('No proxies added!', '!')
+            return pr(f'No proxies {action.lower()}ed!', '!')
         pr(f'{action}ed {cyan(count)} proxies!')
         return count
 
@@ -81,6 +147,9 @@ def mod(mode: str, proxies: Iterable[str], submode: str):
         '''
         pr(f'{action}ing a single proxy: {cyan(proxy_ip)}')
         method = ProxyDB.update_one if action == 'Add' else ProxyDB.remove_one
+        if action == 'Add' and ProxyDB.is_in(proxy_ip):
+            pr(f'Proxy {cyan(str(proxy_ip))} is already in the DB', '*')
+            return False
         try:
             method(Proxy(proxy_ip))
             return True
@@ -94,9 +163,8 @@ def mod(mode: str, proxies: Iterable[str], submode: str):
     for arg in proxies:
         try:
             if not submode:
-                arg_path = Path(arg)
-                if arg_path.is_file():
-                    _mod_from_file(action, arg_path)
+                if is_proxy_list(arg):
+                    _mod_from_file(action, arg)
                 elif is_proxy_format(arg):
                     _mod_single_proxy(action, arg)
                 else:
@@ -108,60 +176,60 @@ def mod(mode: str, proxies: Iterable[str], submode: str):
                 _mod_single_proxy(action, arg)
 
             elif submode == 'file':
-                if not Path(arg).is_file():
+                if not is_proxy_list(arg):
                     raise ValueError
                 _mod_from_file(action, arg)
         except ValueError:
             pr(f'Invalid argument: {cyan(arg)}', '!')
 
 
-def query(num: int = 0,
+def query(stream: TextIO,
+          num: int = 0,
           no_shuffle: bool = False,
           fmt: str = 'json',
           json_inline: bool = False,
           info: bool = True,
-          protos: Set[str] = set({})) -> Iterable[Proxy]:
-
-    if fmt == 'json':
-        buffer = []
-    if fmt == 'grep':
-        buffer = ''
-    count = 0
-    for proxy in ProxyDB.get_proxies(not no_shuffle):
-        # Filter protocols by request
-        if protos:
-            if not len(proxy.protos & protos):
-                continue
-
-        if fmt == 'json':
-            if not info:
-                buffer.append(proxy.pip)
-            else:
-                buffer.append(proxy.serialize())
-        elif fmt == 'grep':
-            buffer += proxy.pip
-            if info:
-                for key, val in proxy.serialize()[proxy.pip].items():
-                    buffer += f' ,{key}:{val}'
-            buffer += '\n'
-        count += 1
-        if count == num:
-            break
-
-    if fmt == 'json':
-        _indent = 4
-        if json_inline:
-            _indent = None
-        buffer = dumps(buffer, indent=_indent)
-    return buffer
+          protos: Set[str] = set({}),
+          countries: Iterable[str] = None,
+          max_latency: float = None,
+          fresh: int = None,
+          order: str = None,
+          min_reliability: float = None) -> int:
+    '''
+    Write the matching proxies into `stream` as they are read from the DB.
+
+    returns -> int: Count of proxies written
+    '''
+    if order is None and not no_shuffle:
+        order = 'random'
+
+    writer_args = {'inline': json_inline} if fmt == 'json' else {}
+    with writers[fmt](stream, info, **writer_args) as writer:
+        for proxy in ProxyDB.query(protos, countries, max_latency, fresh=fresh, order=order, limit=num,
+                                   min_reliability=min_reliability):
+            writer.write(proxy)
+    return writer.count
 
 
 def checker(args):
+    from proxion.util.storage import Query
+    from proxion.checker import (
+        ProxyChecker, AsyncProxyChecker, ContinuousChecker, CheckerFilter, ProtocolRanker)
+    from proxion.checker.metrics import MetricsExporter
+
+    order = args.order if args.order != 'random' else None
+    # Check in that order
+    no_shuffle = args.no_shuffle or bool(order)
+
     if args.verbose:
         pr(f'Timeout set to {cyan(args.timeout)} sec', '*')
-        pr(f'Using max {cyan(args.max_threads)} threads', '*')
-        pr(f'Shuffling proxies: {cyan(not args.no_shuffle)}', '*')
-        pr(f'Checking only for the following protocols: {cyan(", ".join(args.protocols))}', '*')
+        if args.engine == 'async':
+            pr(f'Using max {cyan(args.concurrency)} concurrent checks', '*')
+        else:
+            pr(f'Using max {cyan(args.max_threads)} threads', '*')
+        pr(f'Shuffling proxies: {cyan(not no_shuffle)}', '*')
+        if args.protocols:
+            pr(f'Checking only for the following protocols: {cyan(", ".join(args.protocols))}', '*')
 
     # Gather proxies to check
     checklist = []
@@ -174,18 +242,56 @@ def checker(args):
     elif args.file:
         pr('Checking proxies from CLI argument files')
         for arg in args.file:
-            path = Path(arg)
-            if not path.is_file():
+            if not is_proxy_list(arg):
                 raise ValueError
-            checklist += [Proxy(p) for p in parse_proxies_file(path)]
-    else:
-        pr('Checking proxies from the ProxyDB')
-        checklist = ProxyDB.get_proxies()
+            checklist += parse_proxies_file(arg)
+
+    geoip = None
+    if args.geoip:
+        pr(f'Loading GeoIP DB: {cyan(args.geoip)}', '*')
+        geoip = GeoIP(args.geoip)
 
-    pcf = CheckerFilter(args.protocols, args.stale,
-                        args.latency, args.exit_country, args.strict)
-    ProxyChecker(checklist, args.max_threads, pcf,
-                 args.timeout, args.no_shuffle, args.verbose)
+    ranker = None
+    if args.smart:
+        # Learn which protocols are most likely on every port from the DB
+        ranker = ProtocolRanker(ProxyDB.port_protocols())
+
+    pcf = CheckerFilter(set(args.protocols or ()), args.older,
+                        args.latency, args.exit_country, args.strict, geoip, ranker,
+                        args.min_reliability)
+    if not args.literal and not args.file:
+        # Let the DB do the filtering (and ordering), so only the matching proxies are loaded
+        pr('Checking proxies from the ProxyDB')
+        checklist = list(ProxyDB.query(**pcf.query_args(), order=order))
+    elif order:
+        checklist = list(Query(order=order).apply(checklist))
+    committer = None
+    if args.save:
+        committer = ProxyDBCommitter(args.commit_batch, args.commit_interval)
+    exporter = None
+    if args.metrics_file or args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_file, args.metrics_port, interval=args.metrics_interval)
+    try:
+        if args.continuous:
+            interval = parse_time_string(args.recheck_interval) if args.recheck_interval \
+                else Defaults.recheck_interval
+            ContinuousChecker(checklist, args.concurrency, args.timeout,
+                              pcf, no_shuffle, args.verbose, committer,
+                              args.judge, args.judge_parser, geoip, args.smart, args.first_success,
+                              args.adaptive_timeout, interval, exporter)
+        elif args.engine == 'async':
+            AsyncProxyChecker(checklist, args.concurrency, args.timeout,
+                              pcf, no_shuffle, args.verbose, committer, args.reuse_connections,
+                              args.judge, args.judge_parser, geoip, args.smart, args.first_success,
+                              args.adaptive_timeout, exporter)
+        else:
+            ProxyChecker(checklist, args.max_threads, args.timeout,
+                         pcf, no_shuffle, args.verbose, committer, args.reuse_connections,
+                         args.judge, args.judge_parser, geoip, args.smart, args.first_success,
+                         args.adaptive_timeout, exporter)
+    finally:
+        if exporter:
+            exporter.close()
 
 
 if __name__ == '__main__':
@@ -1,2 +1,18 @@
-from .checker_filter import CheckerFilter
-from .checker import ProxyChecker
+from typing import TYPE_CHECKING
+
+from proxion.util import lazy_exports
+
+if TYPE_CHECKING:
+    from .checker_filter import CheckerFilter, ProtocolRanker
+    from .checker import ProxyChecker
+    from .async_checker import AsyncProxyChecker
+    from .continuous import ContinuousChecker
+
+# The engines are imported on first use, `proxion.checker.checker` pulls in requests
+__getattr__ = lazy_exports(__name__, {
+    'CheckerFilter': '.checker_filter',
+    'ProtocolRanker': '.checker_filter',
+    'ProxyChecker': '.checker',
+    'AsyncProxyChecker': '.async_checker',
+    'ContinuousChecker': '.continuous',
+})
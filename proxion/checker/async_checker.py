@@ -0,0 +1,288 @@
+from time import time
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+import asyncio
+import ssl
+
+from termcolor import colored
+from interutils import cyan, pr
+
+from proxion.util import (
+    Proxy,
+    GeoIP,
+    ProxyDBCommitter,
+    Profiler,
+)
+from proxion import Defaults
+from proxion.checker import CheckerFilter
+from proxion.checker.base import BaseChecker
+from proxion.checker.checker_filter import job_protocols
+from proxion.checker.metrics import MetricsExporter
+from proxion.checker.tunnel import open_socket, negotiate, TunnelError
+
+
+class AsyncProxyChecker(BaseChecker):
+    '''
+    An asyncio based alternative to the process-per-worker ProxyChecker:
+
+    The job list is built by the same CheckerFilter,
+    but instead of spawning processes we spawn `concurrency` coroutines on a single event loop.
+    Each coroutine pulls the next job from the shared job iterator and checks it,
+    so thousands of checks can be in flight at once while the process mostly waits on sockets.
+
+    The handshakes (HTTP CONNECT, SOCKS4, SOCKS5) are done by hand in `proxion.checker.tunnel`.
+    With `group` all the protocols of a proxy are checked back-to-back by the same coroutine,
+    which `probe` and `first_success` imply (see `BaseChecker`).
+    '''
+
+    max_response_size = 65536
+
+    def __init__(self, checklist: Iterable[Proxy],
+                 concurrency: int = Defaults.checker_concurrency,
+                 timeout: int = Defaults.checker_timeout,
+                 checker_filter: CheckerFilter = None,
+                 no_shuffle: bool = False,
+                 verbose: bool = False,
+                 committer: ProxyDBCommitter = None,
+                 group: bool = False,
+                 judge: str = Defaults.checker_judge,
+                 judge_parser: str = Defaults.checker_judge_parser,
+                 geoip: GeoIP = None,
+                 probe: bool = False,
+                 first_success: bool = False,
+                 adaptive_timeout: bool = False,
+                 exporter: MetricsExporter = None):
+
+        super().__init__(checklist, timeout, verbose, committer, judge, judge_parser, geoip,
+                         probe, first_success, adaptive_timeout, exporter)
+        self.judge = urlsplit(self.judge_url)
+
+        if concurrency < 1:
+            raise ValueError(f'Invalid concurrency: {concurrency}')
+
+        with Profiler.phase('build jobs'):
+            jobs, jobs_count = checker_filter.stream_jobs(
+                checklist, no_shuffle, group or probe or first_success)
+
+        concurrency = min(concurrency, jobs_count)
+        pr('Checking %s proxies (%s jobs) with %s concurrent checks' % (
+            cyan(len(checklist)), cyan(jobs_count), cyan(concurrency)
+        ))
+
+        self.jobs_done = 0
+        self.jobs_count = jobs_count
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+
+        raise_open_files_limit(concurrency)
+        if self.exporter:
+            self.exporter.start()
+        try:
+            with Profiler.phase('check'):
+                asyncio.run(self.run(jobs, concurrency, jobs_count))
+        except KeyboardInterrupt:
+            print()
+            pr('Interrupted, cancelled pending checks!', '!')
+        finally:
+            pr('All checks finished')
+            self.show_status()
+            self.commit_results()
+            self.export_metrics(final=True)
+
+    async def run(self, jobs: Iterable[Tuple[Proxy, Union[str, Tuple[str]]]],
+                  concurrency: int, jobs_count: int):
+        jobs = iter(jobs)
+        workers = [asyncio.create_task(self.worker(jobs)) for _ in range(concurrency)]
+        status = asyncio.create_task(self.handle_status_loop(jobs_count))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            status.cancel()
+
+    async def handle_status_loop(self, jobs_count: int):
+        print_interval = 3
+        while True:
+            await asyncio.sleep(print_interval)
+            if self.committer:
+                self.committer.maybe_commit()
+            self.export_metrics()
+            if self.verbose:
+                pr('Jobs Progress: [%d/%d] = %d%%' % (
+                    self.jobs_done, jobs_count, self.jobs_done * 100 / jobs_count
+                ), '*')
+                self.show_status()
+
+    async def worker(self, jobs: Iterator[Tuple[Proxy, Union[str, Tuple[str]]]]):
+        # All workers share the same iterator, the event loop makes `next()` on it safe
+        for proxy, protos in jobs:
+            protos = job_protocols(protos)
+            self.metrics.queue(protos)
+            await self.check_job(proxy, protos)
+
+    def update_metrics(self) -> None:
+        super().update_metrics()
+        # The jobs are pulled by the coroutines as they get free, the rest are waiting
+        self.metrics.queue_depth = max(self.jobs_count - sum(self.metrics.queued.values()), 0)
+
+    async def check_job(self, proxy: Proxy, protos: Tuple[str]) -> List[Proxy]:
+        '''
+        Check the protocols of a proxy one after the other.
+
+        returns -> The results of the working protocols
+        '''
+        if self.probe and not await self.probe_port(proxy):
+            # A dead port fails all of its protocols at once
+            self.jobs_done += len(protos)
+            self.on_result(proxy.pip, None, time())
+            for proto in protos:
+                self.metrics.start(proto)
+                self.on_check(proxy.pip, proto, 'dead', None)
+            return []
+
+        working = []
+        for i, proto in enumerate(protos, 1):
+            if self.verbose:
+                pr(f'Checking: {cyan(proxy.pip)} for proto: {cyan(proto)}', '*')
+
+            self.metrics.start(proto)
+            _t = time()
+            res, outcome = await self.perform_check(proxy.pip, proto, self.check_timeout(proxy))
+            self.jobs_done += 1
+            self.on_result(proxy.pip, res, time())
+            self.on_check(proxy.pip, proto, outcome, time() - _t)
+            if res is not None:
+                working.append(res)
+                pr(f'Working {cyan(", ".join(res.protos))} proxy @ {colored(proxy.pip, "green")}')
+                if self.first_success:
+                    self.jobs_done += len(protos) - i
+                    for other in protos[i:]:
+                        self.metrics.start(other)
+                        self.on_check(proxy.pip, other, 'skipped', None)
+                    break
+        return working
+
+    async def probe_port(self, proxy: Proxy) -> bool:
+        ''' A cheap TCP connect to the proxy '''
+        try:
+            sock = await asyncio.wait_for(open_socket(proxy.ip, proxy.port),
+                                          min(self.check_timeout(proxy), Defaults.checker_probe_timeout))
+            sock.close()
+            return True
+        except (asyncio.TimeoutError, OSError):
+            if self.verbose:
+                pr(f'{cyan(proxy.pip)} is dead, skipping', '*')
+            return False
+
+    async def perform_check(self, pip: str, protocol: str,
+                            timeout: float = None) -> Tuple[Optional[Proxy], str]:
+        '''
+        Check a protocol of the proxy.
+
+        returns -> (The working proxy or None, how the check ended: one of `CHECK_OUTCOMES`)
+        '''
+        ip_addr, port = pip.split(':')
+        try:
+            _t = time()
+            # Attempt to get our current IP (trough the proxy) from the judge
+            status, body = await asyncio.wait_for(
+                self.fetch(ip_addr, int(port), protocol), timeout or self.timeout)
+            latency = time() - _t
+            try:
+                # Attempt to parse the received data
+                exit_ip, country = self.parse_judge(status, body)
+                return Proxy(pip, (protocol,), time(), latency,
+                             self.resolve_country(exit_ip, country)), 'ok'
+            except (ValueError, KeyError, TypeError) as err:
+                # Any failure will be a sign of the proxy not forwarding us,
+                # but instead returning some custom data to us!
+                if self.verbose:
+                    pr(f'Status Code: {status}, Text: \n{body[:512]}', '*')
+                    pr(f'Result parsing error "{err!r}" occurred!', '*')
+                return None, 'parse'
+
+        except asyncio.TimeoutError:
+            if self.verbose:
+                pr(f'{cyan(pip)} -> {cyan(protocol)} timed out', '*')
+            return None, 'timeout'
+        except ssl.SSLError:
+            if self.verbose:
+                pr(f'{cyan(pip)} -> {cyan(protocol)} TLS error', '*')
+            return None, 'tls'
+        except (OSError, TunnelError, ValueError):
+            if self.verbose:
+                pr(f'{cyan(pip)} -> {cyan(protocol)} connection error', '*')
+            return None, 'connection'
+
+    async def fetch(self, ip_addr: str, port: int, protocol: str) -> Tuple[int, bytes]:
+        '''
+        Send a GET request for the judge URL trough the proxy.
+
+        returns -> (status code, response body)
+        '''
+        host = self.judge.hostname
+        path = self.judge.path or '/'
+        if self.judge.query:
+            path += '?' + self.judge.query
+
+        # A plain HTTP proxy can't tunnel, it receives the full URL and fetches it for us
+        if protocol == 'http':
+            ssl_context = None
+            target = f'http://{self.judge.netloc}{path}'
+            dest_port = 80
+        else:
+            ssl_context = self._ssl_context if self.judge.scheme == 'https' else None
+            target = path
+            dest_port = self.judge.port or (443 if ssl_context else 80)
+
+        sock = await open_socket(ip_addr, port)
+        try:
+            await negotiate(sock, protocol, host, dest_port)
+            reader, writer = await asyncio.open_connection(
+                sock=sock, ssl=ssl_context, server_hostname=host if ssl_context else None)
+        except BaseException:
+            sock.close()
+            raise
+
+        try:
+            writer.write((
+                f'GET {target} HTTP/1.0\r\n'
+                f'Host: {self.judge.netloc}\r\n'
+                'User-Agent: proxion\r\n'
+                'Accept: application/json\r\n'
+                'Connection: close\r\n'
+                '\r\n').encode())
+            await writer.drain()
+
+            data = b''
+            while chunk := await reader.read(self.max_response_size):
+                data += chunk
+                if len(data) > self.max_response_size:
+                    break
+        finally:
+            writer.close()
+
+        head, _, body = data.partition(b'\r\n\r\n')
+        status = head.split(b' ', 2)
+        if len(status) < 2 or not status[1].isdigit():
+            raise TunnelError('Not an HTTP response')
+        return int(status[1]), body
+
+
+def raise_open_files_limit(needed: int) -> None:
+    ''' Every concurrent check holds a socket, make sure we are allowed to open enough of them '''
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = needed + 64
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError):
+        pr(f'Could not raise open files limit to {cyan(wanted)}, checks may fail!', '!')
@@ -0,0 +1,138 @@
+from typing import Iterable, Dict, List, Optional
+
+from interutils import cyan, pr
+
+from proxion.util import (
+    Proxy,
+    ProxyDBCommitter,
+    GeoIP,
+)
+from proxion.util.proxy import PROTOCOLS
+from proxion import Defaults
+from proxion.checker.judge_parsers import judge_parsers
+from proxion.checker.latency import LatencyHistogram
+from proxion.checker.metrics import CheckerMetrics, MetricsExporter
+
+
+class BaseChecker:
+    '''
+    Common ground for the check engines:
+    argument validation, collecting results (and committing them into the DB)
+    and showing status of the collected results.
+
+    A check fetches the `judge` URL trough the proxy,
+    the response is parsed by the named judge parser (see `proxion.checker.judge_parsers`).
+    With a `geoip` DB the exit country is looked up offline from the exit IP the judge saw.
+
+    For grouped jobs (all the protocols of a proxy in one job):
+    `probe` first makes a single TCP connect and fails all the protocols of a dead port at once,
+    `first_success` stops checking a proxy at the first protocol that works.
+
+    With `adaptive_timeout` the timeout of a check follows the latencies of the working proxies
+    seen in this run and the proxy's own last latency, `timeout` being the upper bound.
+
+    Every check is counted in `metrics` (see `CheckerMetrics`) trough `on_check`,
+    given an `exporter` they are exported while checking.
+    '''
+
+    up: List[Proxy]
+    tally: Dict[str, int]
+    committer: Optional[ProxyDBCommitter]
+
+    def __init__(self, checklist: Iterable[Proxy],
+                 timeout: int = Defaults.checker_timeout,
+                 verbose: bool = False,
+                 committer: ProxyDBCommitter = None,
+                 judge: str = Defaults.checker_judge,
+                 judge_parser: str = Defaults.checker_judge_parser,
+                 geoip: GeoIP = None,
+                 probe: bool = False,
+                 first_success: bool = False,
+                 adaptive_timeout: bool = False,
+                 exporter: MetricsExporter = None):
+        if not checklist:
+            raise ValueError('No proxies to check!')
+        if not judge.startswith(('http://', 'https://')):
+            raise ValueError(f'Invalid judge URL: "{judge}"')
+        try:
+            self.parse_judge = judge_parsers[judge_parser]
+        except KeyError:
+            raise ValueError(f'Unknown judge parser: "{judge_parser}"')
+
+        self.timeout = timeout
+        self.verbose = verbose
+        self.committer = committer
+        self.judge_url = judge
+        self.geoip = geoip
+        self.probe = probe
+        self.first_success = first_success
+        self.adaptive_timeout = adaptive_timeout
+        self.latencies = LatencyHistogram()
+        self.up = []
+        self.tally = dict.fromkeys(PROTOCOLS, 0)
+        self.metrics = CheckerMetrics()
+        self.exporter = exporter
+        if exporter is not None:
+            exporter.attach(self.metrics, self.update_metrics)
+
+    def resolve_country(self, exit_ip: str, country: Optional[str]) -> Optional[str]:
+        ''' The exit country from the GeoIP DB, falling back to the one the judge reported '''
+        if self.geoip is not None:
+            return self.geoip.lookup(exit_ip) or country
+        return country
+
+    def base_timeout(self) -> float:
+        ''' The timeout learned from the latencies of this run so far '''
+        return self.latencies.timeout(self.timeout)
+
+    def check_timeout(self, proxy: Proxy) -> float:
+        ''' How long to wait for a check of this proxy '''
+        if not self.adaptive_timeout:
+            return self.timeout
+        timeout = self.base_timeout()
+        if proxy.last_lat:
+            # Don't cut off a proxy known to be slow but working
+            timeout = max(timeout, proxy.last_lat * Defaults.adaptive_hint_factor)
+        return min(max(timeout, Defaults.adaptive_min_timeout), self.timeout)
+
+    def on_result(self, pip: str, result: Optional[Proxy], checked_at: float) -> None:
+        ''' Handle the outcome of a single check, `result` is None if the check failed '''
+        if result is not None:
+            self.up.append(result)
+            self.latencies.add(result.last_lat)
+            for proto in result.protos:
+                self.tally[proto] += 1
+        if self.committer:
+            self.committer.add(pip, result, checked_at)
+
+    def on_check(self, pip: str, proto: str, outcome: str, duration: Optional[float]) -> None:
+        '''
+        Handle how a single check of `proto` ended (one of `CHECK_OUTCOMES`),
+        `duration` is None for the checks that weren't performed
+        '''
+        self.metrics.finish(proto, outcome, duration)
+
+    def update_metrics(self) -> None:
+        ''' Bring the gauges up to date, before the metrics are exported '''
+        self.metrics.timeout = self.base_timeout() if self.adaptive_timeout else self.timeout
+
+    def export_metrics(self, final: bool = False) -> None:
+        ''' Export the metrics if it's time to (always if `final`) '''
+        if self.exporter is not None:
+            self.exporter.maybe_write(final)
+
+    def commit_results(self) -> None:
+        ''' Commit whatever results are still pending '''
+        if not self.committer:
+            return
+        self.committer.commit()
+        pr(f'Committed {cyan(self.committer.committed)} proxies into the DB')
+
+    def show_status(self) -> None:
+        ''' Show status (using the live per-protocol tally of working proxies) '''
+        text = 'Working:'
+        for proto, count in self.tally.items():
+            if count:
+                text += f' {cyan(proto.upper())}:{cyan(count)}'
+        pr(text)
+        print()
@@ -1,102 +1,153 @@
-from random import choice
 from time import sleep, time
-from typing import Iterable, Dict, List, Tuple
-from json.decoder import JSONDecodeError
+from typing import Iterable, Iterator, Optional, Tuple
+from queue import Empty
+from threading import Thread
 import multiprocessing as mp
+import socket
 import os
 import urllib3
 
 import requests
+from requests.adapters import HTTPAdapter
 from termcolor import colored
 from interutils import cyan, pr
 
 from proxion.util import (
     Proxy,
+    GeoIP,
+    ProxyDBCommitter,
+    Profiler,
 )
+from proxion.util.proxy import PROTOCOLS
 from proxion import Defaults
 from proxion.checker import CheckerFilter
+from proxion.checker.checker_filter import Job, job_protocols
+from proxion.checker.base import BaseChecker
+from proxion.checker.metrics import MetricsExporter
 
 
 urllib3.disable_warnings()
 
 
-class ProxyChecker:
+class ProxyChecker(BaseChecker):
     '''
     Manages the whole process of checking:
 
     Proxy checked first receives an array of parameters
-    Then we aggregate shuffle and enqueue jobs by splitting every proxy from
+    Then we aggregate and shuffle jobs by splitting every proxy from
         the checklist into as many as 4 separate checks per proxy.
     A check is defined by target proxy's 'ip:port' and a protocol to check.
 
-    Then we spawn some child processes that will pop from the queue and run tests concurrently.
-    Meanwhile writing to a shared memory variable all the checks that we have done,
-    Allowing us to periodically show status of the checking process.
+    Then we spawn some child processes that will pop from the queue and run tests concurrently,
+    while a feeder thread streams the (lazily shuffled) jobs into it.
+    Every child keeps checking until it pops the stop sentinel, which the feeder enqueues
+    (one per child) after the last job, so all of them stay busy until the job list is exhausted.
+    Meanwhile every child counts the checks it has done in its own slot of a shared memory array,
+    Allowing us to periodically show status of the checking process without any locking.
+
+    Every check outcome is sent back over a results queue,
+    the parent collects them and (given a committer) commits them into the DB as they arrive.
+    Along with it come how the checks ended and how long they took, for the metrics,
+    the checks started are counted (per protocol) in another shared array the same way.
+
+    Each child keeps a single requests Session for all of its checks, so connection pools
+    (and their keep-alive connections) are reused instead of being rebuilt on every request.
+    With `reuse_connections` all the protocols of a proxy are checked back-to-back by the same child,
+    sharing that proxy's pool, which is released once the proxy is done
+    (implied by `probe` and `first_success`, see `BaseChecker`).
 
     '''
 
+    # Jobs queued per child ahead of time
+    queue_depth = 4
+
     def __init__(self, checklist: Iterable[Proxy],
                  max_threads: int = Defaults.checker_max_threads,
                  timeout: int = Defaults.checker_timeout,
                  checker_filter: CheckerFilter = None,
                  no_shuffle: bool = False,
-                 verbose: bool = False):
-
-        self.timeout = timeout
-        self.verbose = verbose
+                 verbose: bool = False,
+                 committer: ProxyDBCommitter = None,
+                 reuse_connections: bool = False,
+                 judge: str = Defaults.checker_judge,
+                 judge_parser: str = Defaults.checker_judge_parser,
+                 geoip: GeoIP = None,
+                 probe: bool = False,
+                 first_success: bool = False,
+                 adaptive_timeout: bool = False,
+                 exporter: MetricsExporter = None):
+        super().__init__(checklist, timeout, verbose, committer, judge, judge_parser, geoip,
+                         probe, first_success, adaptive_timeout, exporter)
 
         if max_threads < 1:
             raise ValueError(f'Invalid thread count: {max_threads}')
-        if not checklist:
-            raise ValueError('No proxies to check!')
 
-        # Build job queue based on filter options
-        self.queue = mp.Queue()
-        jobs_count = 0
-        for job in checker_filter.build_joblist(checklist, no_shuffle):
-            self.queue.put(job)
-            jobs_count += 1
+        with Profiler.phase('build jobs'):
+            jobs, jobs_count = checker_filter.stream_jobs(
+                checklist, no_shuffle, group=reuse_connections or probe or first_success)
 
         max_threads = min(max_threads, jobs_count)
         pr('Checking %s proxies (%s jobs) on %s threads' % (
             cyan(len(checklist)), cyan(jobs_count), cyan(max_threads)
         ))
 
+        # The jobs are fed (by a thread) while the children already check, trough a bounded queue
+        self.queue = mp.Queue(max_threads * self.queue_depth)
         self._terminate_flag = False
-        with mp.Manager() as manager:
-            self.up = manager.list()
-            self.jobs_done = manager.Value('i', 0)
-
-            procs = []
-            for _ in range(max_threads):
-                procs.append(p := mp.Process(
-                    target=self.worker, daemon=True))
-                p.start()
-            try:
+        self.results = mp.Queue()
+        # A checks counter per child, each written only by its own child (so no locking needed)
+        self.done_counters = mp.RawArray('q', max_threads)
+        self.started_counters = mp.RawArray('q', max_threads * len(PROTOCOLS))
+        # The adaptive timeout, learned by the parent (which sees all the results) for the children
+        self.shared_timeout = mp.RawValue('d', timeout)
+
+        procs = []
+        for slot in range(max_threads):
+            procs.append(p := mp.Process(
+                target=self.worker, args=(slot,), daemon=True))
+            p.start()
+        if self.exporter:
+            self.exporter.start()
+        Thread(target=self.feed_jobs, args=(jobs, max_threads), daemon=True).start()
+        try:
+            with Profiler.phase('check'):
                 self.handle_checker_loop(procs, jobs_count)
-            except KeyboardInterrupt:
-                self.handle_checker_interruption(procs, jobs_count)
-            finally:
-                pr('All children exited')
-                self.show_status()
-                # update_stats(time(), self.collect_results())
+        except KeyboardInterrupt:
+            self.handle_checker_interruption(procs, jobs_count)
+        finally:
+            pr('All children exited')
+            self.show_status()
+            self.commit_results()
+            self.export_metrics(final=True)
+
+    @property
+    def jobs_done(self) -> int:
+        return sum(self.done_counters)
 
     def handle_checker_loop(self, procs: Iterable[mp.Process], jobs_count: int):
         print_interval = 3
         last_print = time()
         while self.active_children(procs):
-            sleep(0.25)
+            self.collect_results(0.25)
+            if self.adaptive_timeout:
+                self.shared_timeout.value = self.latencies.timeout(self.timeout)
+            if self.committer:
+                self.committer.maybe_commit()
+            self.export_metrics()
             if self.verbose and time() - last_print > print_interval:
                 last_print = time()
+                jobs_done = self.jobs_done
                 pr('Jobs Progress: [%d/%d] = %d%%' % (
-                    self.jobs_done.value, jobs_count, self.jobs_done.value * 100 / jobs_count
+                    jobs_done, jobs_count, jobs_done * 100 / jobs_count
                 ), '*')
                 self.show_status()
+        self.collect_results()
 
     def handle_checker_interruption(self, procs: Iterable[mp.Process], jobs_count: int):
         print()
         pr('Interrupted, Killing children!', '!')
         self._terminate_flag = True
+        self.queue.cancel_join_thread()
         self.queue.close()
         for p in procs:
             p.kill()
@@ -108,87 +159,184 @@ class ProxyChecker:
             if time() - last_print > termination_print_interval:
                 last_print = time()
                 pr(f'Waiting for {cyan(n_alive)} children to exit', '*')
-                percent_done = 100 * \
-                    int(self.jobs_done.value) / jobs_count
-                pr(f'Jobs done: [{self.jobs_done.value}/{jobs_count}] = {percent_done}%', '*')
+                jobs_done = self.jobs_done
+                pr(f'Jobs done: [{jobs_done}/{jobs_count}] = {jobs_done * 100 // jobs_count}%', '*')
+
+        # Keep whatever was already checked, a killed child may leave a broken message behind
+        try:
+            self.collect_results()
+        except Exception:  # pylint: disable=broad-except
+            pr('Some results were lost while killing children', '!')
+
+    def collect_results(self, timeout: float = 0) -> None:
+        '''
+        Pass results sent by the children to `on_result`,
+        waiting up to `timeout` seconds for the first one to arrive.
+        '''
+        while True:
+            try:
+                pip, res, checked_at, checks = self.results.get(timeout=timeout)
+            except Empty:
+                return
+            timeout = 0
+            self.on_result(pip, res, checked_at)
+            for proto, outcome, duration in checks:
+                self.on_check(pip, proto, outcome, duration)
+
+    def update_metrics(self) -> None:
+        super().update_metrics()
+        # Sum up what the children started
+        metrics = self.metrics
+        slots = len(self.started_counters) // len(PROTOCOLS)
+        for i, proto in enumerate(PROTOCOLS):
+            metrics.started[proto] = sum(self.started_counters[slot * len(PROTOCOLS) + i]
+                                         for slot in range(slots))
+        metrics.queue_depth = max(sum(metrics.queued.values()) - sum(metrics.started.values()), 0)
 
     def active_children(self, procs: Iterable[mp.Process]) -> int:
         if not procs:
             return 0
         return list(map(lambda p: p.is_alive(), procs)).count(True)
 
-    def worker(self):
-        while not self.queue.empty():
-            if self._terminate_flag:
-                pr('Terminating child although queue is not empty yet', '!')
-                break
+    def feed_jobs(self, jobs: Iterator[Job], workers: int) -> None:
+        ''' Stream the jobs into the queue, followed by a stop sentinel (None) for every child '''
+        with Profiler.profiled('feeder'):
+            try:
+                for job in jobs:
+                    if self._terminate_flag:
+                        return
+                    self.queue.put(job)
+                    self.metrics.queue(job_protocols(job[1]))
+                for _ in range(workers):
+                    self.queue.put(None)
+            except ValueError:  # The queue got closed by an interruption
+                pass
+
+    def worker(self, slot: int):
+        with Profiler.profiled('worker'):
+            self.check_jobs(slot)
 
-            proxy, proto = self.queue.get()
+    def check_jobs(self, slot: int):
+        ''' Check the jobs popped from the queue until the stop sentinel '''
+        self.session = self.make_session()
+        done_counters = self.done_counters
+        started_counters = self.started_counters
+        started_slot = slot * len(PROTOCOLS)
+        proto_index = {proto: i for i, proto in enumerate(PROTOCOLS)}
+        for proxy, protos in iter(self.queue.get, None):
             proxy: Proxy
-            proto: str
+            protos = job_protocols(protos)
+
+            if self.probe and not self.probe_port(proxy):
+                # A dead port fails all of its protocols at once
+                for proto in protos:
+                    started_counters[started_slot + proto_index[proto]] += 1
+                done_counters[slot] += len(protos)
+                self.results.put((proxy.pip, None, time(), tuple((proto, 'dead', None) for proto in protos)))
+                continue
+
+            for i, proto in enumerate(protos, 1):
+                if self.verbose:
+                    pr(f'Thread {cyan(os.getpid())} checking: {cyan(proxy.pip)} ' +
+                       f'for proto: {cyan(proto)}', '*')
+
+                started_counters[started_slot + proto_index[proto]] += 1
+                _t = time()
+                res, outcome = self.perform_check(proxy.pip, proto, self.check_timeout(proxy))
+                checks = ((proto, outcome, time() - _t),)
+                done_counters[slot] += 1
+                skipped = res is not None and self.first_success and protos[i:]
+                if skipped:
+                    for other in skipped:
+                        started_counters[started_slot + proto_index[other]] += 1
+                    checks += tuple((other, 'skipped', None) for other in skipped)
+                    done_counters[slot] += len(skipped)
+                self.results.put((proxy.pip, res, time(), checks))
+                if res is not None:
+                    pr(f'Working {cyan(", ".join(res.protos))} proxy @ {colored(proxy.pip, "green")}')
+                if skipped:
+                    break
+            self.release_connections(proxy.pip)
+
+    def base_timeout(self) -> float:
+        # Children don't see the results, the parent shares what it learned
+        return self.shared_timeout.value
 
+    def probe_port(self, proxy: Proxy) -> bool:
+        ''' A cheap TCP connect to the proxy '''
+        try:
+            timeout = min(self.check_timeout(proxy), Defaults.checker_probe_timeout)
+            socket.create_connection((proxy.ip, proxy.port), timeout).close()
+            return True
+        except OSError:
             if self.verbose:
-                pr(f'Thread {cyan(os.getpid())} checking: {cyan(proxy.pip)} for proto: {cyan(proto)}', '*')
+                pr(f'{cyan(proxy.pip)} is dead, skipping', '*')
+            return False
+
+    @staticmethod
+    def make_session() -> requests.Session:
+        ''' A session for all the checks of a child, pools are kept per proxy URL '''
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=1, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.verify = False
+        return session
+
+    def release_connections(self, pip: str) -> None:
+        ''' Close and forget the pools of a proxy we are done with, so they don't pile up '''
+        for adapter in set(self.session.adapters.values()):
+            for url in [u for u in adapter.proxy_manager if u.endswith('//' + pip)]:
+                adapter.proxy_manager.pop(url).clear()
 
-            res = self.perform_check(proxy.pip, proto)
-            self.jobs_done.value += 1
-            if res is not None:
-                pr(f'Working {cyan(", ".join(res.protos))} proxy @ {colored(proxy.pip, "green")}')
-                self.up.append(res)
-                break
+    def perform_check(self, pip: str, protocol: str,
+                      timeout: float = None) -> Tuple[Optional[Proxy], str]:
+        '''
+        Check a protocol of the proxy.
 
-    def perform_check(self, pip: str, protocol: str) -> (Proxy, None):
+        returns -> (The working proxy or None, how the check ended: one of `CHECK_OUTCOMES`)
+        '''
         try:
-            proxies_dict = {
-                protocol if protocol == 'http' else 'https': protocol + '://' + pip
-            }
+            # HTTP proxies tunnel HTTPS with CONNECT, so both are reached over plain HTTP
+            proxy_url = ('http' if protocol in ('http', 'https') else protocol) + '://' + pip
+            proxies_dict = {'http': proxy_url, 'https': proxy_url}
+
+            # A plain HTTP proxy has to be checked with a plain HTTP request
+            url = self.judge_url
+            if protocol == 'http':
+                url = 'http://' + url.split('://', 1)[1]
 
             _t = time()
-            # Attempt to get our current IP (trough the proxy), expect JSON data!
-            resp = requests.get('https://ipinfo.io/', proxies=proxies_dict,
-                                timeout=self.timeout, verify=False)
+            # Attempt to get our current IP (trough the proxy) from the judge
+            resp = self.session.get(url, proxies=proxies_dict, timeout=timeout or self.timeout)
             latency = time() - _t
             try:
-                # Attempt to decode the received data
-                json = resp.json()
-                try:
-                    return Proxy(pip, (protocol,), time(), latency, json['country'])
-                except KeyError as err:
-                    pr(f'Result parsing "{err}" from:' + json, '*')
-            except JSONDecodeError as err:
+                # Attempt to parse the received data
+                exit_ip, country = self.parse_judge(resp.status_code, resp.content)
+                return Proxy(pip, (protocol,), time(), latency,
+                             self.resolve_country(exit_ip, country)), 'ok'
+            except (ValueError, KeyError, TypeError) as err:
                 # Any failure will be a sign of the proxy not forwarding us,
                 # but instead returning some custom data to us!
-                pr(f'Status Code: {resp.status_code}, Text: \n{resp.text}', '*')
-                pr(f'An JSON Decode error "{err}" occurred!', '*')
+                pr(f'Status Code: {resp.status_code}, Text: \n{resp.text[:512]}', '*')
+                pr(f'Result parsing error "{err!r}" occurred!', '*')
+                return None, 'parse'
 
         except (requests.ConnectTimeout, requests.ReadTimeout):
             pr(f'{cyan(pip)} -> {cyan(protocol)} timed out', '*')
+            return None, 'timeout'
+        except requests.exceptions.SSLError:
+            pr(f'{cyan(pip)} -> {cyan(protocol)} TLS error', '*')
+            return None, 'tls'
         except requests.ConnectionError:
             pr(f'{cyan(pip)} -> {cyan(protocol)} connection error', '*')
+            return None, 'connection'
         except requests.exceptions.InvalidSchema:
             pr('SOCKS dependencies unmet!', 'X')
+        except requests.RequestException as err:
+            pr(f'{cyan(pip)} -> {cyan(protocol)} {type(err).__name__}', '*')
         except ValueError as err:
-            if err.args[0] == 'check_hostname requires server_hostname':
+            if err.args and err.args[0] == 'check_hostname requires server_hostname':
                 pr(f'{cyan(pip)} -> {cyan(protocol)} TLS error, proxy is probably HTTP', '*')
-
-    def show_status(self) -> None:
-
-        def _sort_protocols(working: List[Proxy]) -> Dict[str, list]:
-            ''' Sort proxies by ProxyType'''
-            dic = {}
-            for proto in Defaults.checker_proxy_protocols:
-                dic.update({proto: []})
-
-            for proxion in working:
-                for proto in proxion.protos:
-                    dic[proto].append(proxion)
-            return dic
-
-        ''' Show status (using the collected results) '''
-        working = self.up
-        text = 'Working:'
-        for proto, proxies in _sort_protocols(working).items():
-            if proxies:
-                text += f' {cyan(proto.upper())}:{cyan(len(proxies))}'
-        pr(text)
-        print()
+                return None, 'tls'
+        return None, 'error'
@@ -1,39 +1,74 @@
-from typing import Tuple, List, Iterable, Union, Set
+from typing import Tuple, List, Dict, FrozenSet, Collection, Iterable, Iterator, Optional, Union, Set
 from string import digits
-from random import choice
+from random import randrange, shuffle
 from time import time
 
-from proxion.util import Proxy
+from proxion.util import Proxy, GeoIP, parse_time_string
+from proxion.util.proxy import PROTOCOLS
+from proxion.util.storage import Query
 from proxion import Defaults
 
 
-def parse_time_string(time_str: str) -> int:
-    time_map = {
-        's': 1,
-        'm': 60,
-        'h': 60 * 60,
-        'd': 60 * 60 * 24,
-        'w': 60 * 60 * 24 * 7,
-        'mo': 60 * 60 * 24 * 30,
-        'y': 60 * 60 * 24 * 365,
-    }
-    for frame in time_map:
-        if time_str.endswith(frame):
-            quantity = int(time_str.split(frame)[0])
-            return time_map[frame] * quantity
-    raise ValueError
+Job = Tuple[Proxy, Union[str, Tuple[str]]]
+
+
+def job_protocols(protos: Union[str, Tuple[str]]) -> Tuple[str]:
+    ''' A job checks either a single protocol or (when grouped) a tuple of them '''
+    return (protos,) if isinstance(protos, str) else protos
+
+
+def lazy_shuffle(items: list) -> Iterator:
+    '''
+    Yield the items in a random order (an incremental Fisher-Yates shuffle, consuming the list),
+    each item costs O(1) so the first one is out right away
+    '''
+    while items:
+        i = randrange(len(items))
+        items[i], items[-1] = items[-1], items[i]
+        yield items.pop()
+
+
+class ProtocolRanker:
+    '''
+    Orders the protocols to try on a proxy by how likely they are to work,
+    learned from the DB history: how many known proxies on the same port work with each protocol
+    (then over all the ports, then the `PROTOCOLS` order).
+    '''
+
+    def __init__(self, port_protocols: Dict[int, Dict[str, int]]):
+        self.port_protocols = port_protocols
+        self.overall: Dict[str, int] = {}
+        for counts in port_protocols.values():
+            for proto, count in counts.items():
+                self.overall[proto] = self.overall.get(proto, 0) + count
+        self._cache: Dict[Tuple[int, FrozenSet[str]], Tuple[str]] = {}
+
+    def rank(self, port: int, protos: FrozenSet[str]) -> Tuple[str]:
+        key = (port, protos)
+        try:
+            return self._cache[key]
+        except KeyError:
+            counts = self.port_protocols.get(port, {})
+            ranked = self._cache[key] = tuple(sorted(protos, key=lambda proto: (
+                -counts.get(proto, 0), -self.overall.get(proto, 0), PROTOCOLS.index(proto))))
+            return ranked
 
 
 class CheckerFilter:
     protocols: Set[str]  # = Defaults.checker_proxy_protocols,
     stale: int
     latency: int
-    exit_country: str
+    exit_country: Set[str]
     strict: bool
+    geoip: Optional[GeoIP]
+    ranker: Optional[ProtocolRanker]
+    min_reliability: Optional[float]
 
     def __init__(self, protocols: Set[str],
                  stale: str, latency: str,
-                 exit_country: str, strict: bool):
+                 exit_country: Iterable[str], strict: bool,
+                 geoip: GeoIP = None, ranker: ProtocolRanker = None,
+                 min_reliability: float = None):
 
         # Verify `protocols` are among the options
         if protocols:
@@ -52,65 +87,111 @@ class CheckerFilter:
 
         # Verify `exit_country` is in valid format
         if exit_country:
-            if not len(exit_country) != 2:
-                raise ValueError(
-                    f'Invalid exit country format: "{exit_country}" should be in XX notation (e.g. US, UK)')
+            if isinstance(exit_country, str):
+                exit_country = (exit_country,)
+            for country in exit_country:
+                if len(country) != 2:
+                    raise ValueError(
+                        f'Invalid exit country format: "{country}" should be in XX notation (e.g. US, UK)')
+            exit_country = {c.upper() for c in exit_country}
         self.exit_country = exit_country
 
         self.latency = latency
         self.strict = strict
-
-    def build_joblist(self, checklist, no_shuffle: bool) -> List[Tuple[Union[Proxy, str]]]:
-        '''Aggregate, randomize and enqueue jobs (checks)'''
-        jobs = []
+        if min_reliability is not None and not 0 <= min_reliability <= 1:
+            raise ValueError(f'Invalid reliability: "{min_reliability}" should be between 0 and 1')
+        self.min_reliability = min_reliability
+
+        self.geoip = geoip
+        self.ranker = ranker
+
+        self.query = Query(**self.query_args())
+
+    def query_args(self) -> dict:
+        '''
+        The filters as arguments for `ProxyDB.query`,
+        a negative latency means lower than and a positive one means higher than.
+
+        With a GeoIP DB the countries are matched by `country_matches` instead,
+        as proxies without an exit country may still be located by their IP.
+        '''
+        return {
+            'protos': self.protocols,
+            'countries': None if self.geoip else self.exit_country,
+            'max_latency': -self.latency if self.latency and self.latency < 0 else None,
+            'min_latency': self.latency if self.latency and self.latency > 0 else None,
+            'stale': self.stale,
+            'min_reliability': self.min_reliability,
+            'strict': self.strict,
+        }
+
+    def country_matches(self, proxy: Proxy) -> bool:
+        ''' Match the exit country, locating never checked proxies by their own IP '''
+        if not self.exit_country:
+            return True
+        country = proxy.exit_country
+        if not country and self.geoip is not None:
+            country = self.geoip.lookup(proxy.ip)
+        if not country:
+            return not self.strict
+        return country in self.exit_country
+
+    def iter_jobs(self, checklist: Iterable[Proxy], group: bool = False) -> Iterator[Job]:
+        '''
+        The jobs (checks) of the proxies matching the filter, in the checklist order
+
+        Every job is a proxy and a protocol to check,
+        with `group` a single job holds all the protocols to check for its proxy
+        (in the order of the `ranker` if given).
+        '''
+        now = time()
         for proxy in checklist:
             proxy: Proxy
 
-            # Filter exit_country:
-            if self.exit_country:
-                if not proxy.exit_country:
-                    if self.strict:
-                        continue
-                elif self.exit_country != proxy.exit_country:
-                    continue
-
-            # Filter latency:
-            if self.latency:
-                if not proxy.last_lat:
-                    if self.strict:
-                        continue
-                else:
-                    if self.latency < 0:
-                        if proxy.last_lat > -self.latency:
-                            continue
-                    elif proxy.last_lat < self.latency:
-                        continue
-
-            # Filter stale
-            if self.stale:
-                if not proxy.last_check:
-                    if self.strict:
-                        continue
-                elif time() < proxy.last_check + self.stale:
-                    print(
-                        'DBG skipping proxy because of lastcheck + stale > time()')
-                    continue
+            if not self.query.matches(proxy, now) or not self.country_matches(proxy):
+                continue
 
             # Filter protocols to check
-            protos_to_check = None
+            protos_to_check = set()
             if proxy.protos:
                 protos_to_check = proxy.protos
             elif not self.strict:
                 protos_to_check = Defaults.checker_proxy_protocols
 
             if self.protocols:
-                protos_to_check = set(protos_to_check & self.protocols)
-
-            for proto in protos_to_check:
-                # Randomize job list
-                pos = 0
-                jobs_count = len(jobs)
-                if not no_shuffle and jobs_count > 1:
-                    pos = choice(range(jobs_count))
-                jobs.insert(pos, (proxy, proto))
+                protos_to_check = protos_to_check & self.protocols
+
+            if not protos_to_check:
+                continue
+            if group:
+                if self.ranker is not None:
+                    yield proxy, self.ranker.rank(proxy.port, frozenset(protos_to_check))
+                else:
+                    yield proxy, tuple(p for p in PROTOCOLS if p in protos_to_check)
+            else:
+                for proto in protos_to_check:
+                    yield proxy, proto
+
+    def build_joblist(self, checklist: Iterable[Proxy], no_shuffle: bool,
+                      group: bool = False) -> List[Job]:
+        ''' Aggregate and randomize jobs (see `iter_jobs`) '''
+        jobs = list(self.iter_jobs(checklist, group))
+        if not no_shuffle:
+            shuffle(jobs)
         return jobs
+
+    def stream_jobs(self, checklist: Collection[Proxy], no_shuffle: bool,
+                    group: bool = False) -> Tuple[Iterator[Job], int]:
+        '''
+        Like `build_joblist` but lazier:
+        with `no_shuffle` the jobs are generated while being consumed (after a pass counting them,
+        which keeps none of them), otherwise the job list is built and shuffled while being consumed.
+
+        returns -> (jobs iterator, count of checks)
+        '''
+        if no_shuffle:
+            checks = sum(len(protos) if group else 1 for _, protos in self.iter_jobs(checklist, group))
+            return self.iter_jobs(checklist, group), checks
+        jobs = list(self.iter_jobs(checklist, group))
+        checks = sum(len(protos) for _, protos in jobs) if group else len(jobs)
+        return lazy_shuffle(jobs), checks
@@ -0,0 +1,128 @@
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import asyncio
+
+from interutils import cyan, pr
+
+from proxion.util import (
+    Proxy,
+    GeoIP,
+    ProxyDBCommitter,
+)
+from proxion import Defaults
+from proxion.checker import CheckerFilter
+from proxion.checker.async_checker import AsyncProxyChecker
+from proxion.checker.scheduler import RecheckScheduler
+from proxion.checker.metrics import MetricsExporter
+
+
+class ContinuousChecker(AsyncProxyChecker):
+    '''
+    Keeps rechecking the proxies indefinitely (until interrupted) on the async engine:
+
+    Every proxy (with all of its protocols as a single job) sits in a `RecheckScheduler`,
+    the `concurrency` coroutines pop whichever proxy is due next, check it,
+    record the round into its history and push it back with its next due time.
+    So working proxies are rechecked every `interval` while dead ones back off,
+    instead of sweeping the whole list every time.
+
+    `up` maps every working proxy to its protocols working as of its latest round
+    (the tally counts those), so the status shows the proxies working now.
+    '''
+
+    # Longest nap of an idle coroutine, so proxies pushed back by the others are noticed soon enough
+    idle_poll = 1
+
+    def __init__(self, checklist: Iterable[Proxy],
+                 concurrency: int = Defaults.checker_concurrency,
+                 timeout: int = Defaults.checker_timeout,
+                 checker_filter: CheckerFilter = None,
+                 no_shuffle: bool = False,
+                 verbose: bool = False,
+                 committer: ProxyDBCommitter = None,
+                 judge: str = Defaults.checker_judge,
+                 judge_parser: str = Defaults.checker_judge_parser,
+                 geoip: GeoIP = None,
+                 probe: bool = False,
+                 first_success: bool = False,
+                 adaptive_timeout: bool = False,
+                 interval: float = Defaults.recheck_interval,
+                 exporter: MetricsExporter = None):
+        self.interval = interval
+        self.rounds = 0
+        self.scheduler = None
+        super().__init__(checklist, concurrency, timeout, checker_filter, no_shuffle, verbose,
+                         committer, True, judge, judge_parser, geoip, probe, first_success,
+                         adaptive_timeout, exporter)
+
+    async def run(self, jobs: Iterable[Tuple[Proxy, Union[str, Tuple[str]]]],
+                  concurrency: int, jobs_count: int):
+        scheduler = self.scheduler = RecheckScheduler(jobs, self.interval)
+        # The checks run within BaseChecker.__init__, after it made `up` a list
+        self.up: Dict[str, List[str]] = {}
+        pr(f'Rechecking continuously, working proxies every {cyan(self.interval)} sec')
+        workers = [asyncio.create_task(self.recheck(scheduler)) for _ in range(concurrency)]
+        status = asyncio.create_task(self.handle_scheduler_status_loop(scheduler))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            status.cancel()
+
+    async def recheck(self, scheduler: RecheckScheduler):
+        while True:
+            job = scheduler.pop_due()
+            if job is None:
+                wait = scheduler.wait_time()
+                await asyncio.sleep(self.idle_poll if wait is None else min(wait, self.idle_poll))
+                continue
+
+            proxy, protos = job
+            self.metrics.queue(protos)
+            working = await self.check_job(proxy, protos)
+            self.rounds += 1
+            self.set_working(proxy.pip, [proto for res in working for proto in res.protos])
+
+            # Keep our copy in step with the DB (one history entry per round in both),
+            # it decides when the proxy is due again
+            checked_at = time()
+            if self.committer:
+                self.committer.add_round(proxy.pip, working, checked_at)
+            for res in working:
+                proxy.update(res)
+            proxy.record(bool(working), proxy.last_lat if working else None)
+            proxy.last_check = checked_at
+            scheduler.push(proxy, protos)
+
+    def on_result(self, pip: str, result: Optional[Proxy], checked_at: float) -> None:
+        # Only the latest round of a proxy counts, `set_working` keeps `up` and the tally,
+        # the whole round is committed by `recheck`
+        if result is not None:
+            self.latencies.add(result.last_lat)
+
+    def set_working(self, pip: str, protos: List[str]) -> None:
+        ''' Replace the working protocols of a proxy with those of its latest round '''
+        for proto in self.up.pop(pip, ()):
+            self.tally[proto] -= 1
+        if protos:
+            self.up[pip] = protos
+            for proto in protos:
+                self.tally[proto] += 1
+
+    async def handle_scheduler_status_loop(self, scheduler: RecheckScheduler):
+        print_interval = 3
+        while True:
+            await asyncio.sleep(print_interval)
+            if self.committer:
+                self.committer.maybe_commit()
+            self.export_metrics()
+            if self.verbose:
+                wait = scheduler.wait_time()
+                pr('Rounds done: %d, next proxy due in %s sec' % (
+                    self.rounds, 'N/A' if wait is None else '%.0f' % wait
+                ), '*')
+                self.show_status()
+
+    def update_metrics(self) -> None:
+        super().update_metrics()
+        # The checks of the proxies already due
+        self.metrics.queue_depth = self.scheduler.count_due() if self.scheduler else 0
@@ -0,0 +1,48 @@
+'''
+Parsers of proxy judge responses.
+
+A parser receives the HTTP status and body of a judge response (fetched trough the proxy)
+and returns the exit IP and (if the judge knows it) the exit country.
+Any response a parser can't make sense of is a sign of the proxy not forwarding us,
+so parsers raise (ValueError/KeyError/TypeError) instead of guessing.
+'''
+from typing import Callable, Dict, Optional, Tuple
+from json import loads
+
+from proxion.util import is_ip_address
+
+
+JudgeResult = Tuple[str, Optional[str]]
+
+
+def _assure_ip(ip_addr) -> str:
+    if not isinstance(ip_addr, str) or not is_ip_address(ip_addr):
+        raise ValueError(f'Judge returned an invalid IP: {ip_addr!r}')
+    return ip_addr
+
+
+def parse_ipinfo(status: int, body: bytes) -> JudgeResult:
+    ''' https://ipinfo.io/ : JSON, a country is required '''
+    json = loads(body)
+    return _assure_ip(json['ip']), json['country']
+
+
+def parse_json(status: int, body: bytes) -> JudgeResult:
+    ''' Any judge answering JSON with an "ip" (or "origin") field, like `proxion judge` '''
+    json = loads(body)
+    ip_addr = json['ip'] if 'ip' in json else json['origin']
+    return _assure_ip(ip_addr), json.get('country')
+
+
+def parse_plain(status: int, body: bytes) -> JudgeResult:
+    ''' Judges answering just the IP in plain text (e.g. https://api.ipify.org/) '''
+    if status != 200:
+        raise ValueError(f'Judge answered with status: {status}')
+    return _assure_ip(body.decode('ascii').strip()), None
+
+
+judge_parsers: Dict[str, Callable[[int, bytes], JudgeResult]] = {
+    'ipinfo': parse_ipinfo,
+    'json': parse_json,
+    'plain': parse_plain,
+}
@@ -0,0 +1,48 @@
+from math import log
+from typing import List, Optional
+
+from proxion import Defaults
+
+
+class LatencyHistogram:
+    '''
+    A running histogram of check latencies, in log-spaced buckets (each `growth` times wider),
+    so adding a latency and reading a percentile cost nothing whatever the run length.
+    '''
+
+    min_latency = 0.01
+    growth = 1.1
+
+    def __init__(self, max_latency: float = 120):
+        self.buckets: List[int] = [0] * (self.bucket(max_latency) + 1)
+        self.count = 0
+
+    def bucket(self, latency: float) -> int:
+        if latency <= self.min_latency:
+            return 0
+        return int(log(latency / self.min_latency, self.growth)) + 1
+
+    def add(self, latency: float) -> None:
+        self.buckets[min(self.bucket(latency), len(self.buckets) - 1)] += 1
+        self.count += 1
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        ''' The (upper bound of the bucket holding the) latency `fraction` of the checks are below '''
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= needed:
+                return self.min_latency * self.growth ** i
+        return self.min_latency * self.growth ** (len(self.buckets) - 1)
+
+    def timeout(self, default: float) -> float:
+        '''
+        A timeout covering (with a margin) the high percentile of the latencies seen so far,
+        `default` until there are enough of them
+        '''
+        if self.count < Defaults.adaptive_min_samples:
+            return default
+        return self.percentile(Defaults.adaptive_percentile) * Defaults.adaptive_margin
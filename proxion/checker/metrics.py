@@ -0,0 +1,218 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from pathlib import Path
+from threading import Thread
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from interutils import cyan, pr
+
+from proxion.util.proxy import PROTOCOLS
+from proxion import Defaults
+
+
+# How a check ended: working, the failures `perform_check` tells apart,
+# a dead port (by the probe) or skipped (the proxy already worked with `first_success`)
+CHECK_OUTCOMES = ('ok', 'timeout', 'connection', 'tls', 'parse', 'error', 'dead', 'skipped')
+# Outcomes of the checks actually sent to the judge, the ones with a duration
+PERFORMED_OUTCOMES = CHECK_OUTCOMES[:6]
+
+
+class Histogram:
+    ''' A Prometheus style histogram: counts per upper bound, plus the count and sum of the values '''
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        ''' (upper bound, values up to it) for every bucket, the last one being +Inf '''
+        buckets = []
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            buckets.append(('+Inf' if bound == float('inf') else f'{bound:g}', seen))
+        return buckets
+
+
+class CheckerMetrics:
+    '''
+    Counters and histograms of a check run, per protocol:
+    checks queued (handed to the workers), started and finished (by outcome),
+    and how long the performed checks took (by outcome, so it shows where the check time goes).
+    Plus the gauges the engine keeps up to date: checks waiting for a worker and the current timeout.
+
+    Every series exists from the start, so the metrics can be read (rendered) from another thread.
+    '''
+
+    duration_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.started_at = time()
+        self.queued: Dict[str, int] = dict.fromkeys(PROTOCOLS, 0)
+        self.started: Dict[str, int] = dict.fromkeys(PROTOCOLS, 0)
+        self.finished: Dict[Tuple[str, str], int] = {
+            (proto, outcome): 0 for proto in PROTOCOLS for outcome in CHECK_OUTCOMES}
+        self.durations: Dict[Tuple[str, str], Histogram] = {
+            (proto, outcome): Histogram(self.duration_buckets)
+            for proto in PROTOCOLS for outcome in PERFORMED_OUTCOMES}
+        self.queue_depth = 0
+        self.timeout = 0.0
+
+    def queue(self, protos: Iterable[str]) -> None:
+        for proto in protos:
+            self.queued[proto] += 1
+
+    def start(self, proto: str) -> None:
+        self.started[proto] += 1
+
+    def finish(self, proto: str, outcome: str, duration: Optional[float] = None) -> None:
+        self.finished[proto, outcome] += 1
+        if duration is not None:
+            self.durations[proto, outcome].observe(duration)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self.started.values()) - sum(self.finished.values())
+
+    def snapshot(self) -> dict:
+        ''' The metrics as a JSON-able dict (leaving out what never happened) '''
+        finished: Dict[str, Dict[str, int]] = {}
+        for (proto, outcome), count in self.finished.items():
+            if count:
+                finished.setdefault(proto, {})[outcome] = count
+        durations: Dict[str, Dict[str, dict]] = {}
+        for (proto, outcome), hist in self.durations.items():
+            if hist.count:
+                durations.setdefault(proto, {})[outcome] = {
+                    'count': hist.count, 'sum': round(hist.sum, 6),
+                    'buckets': dict(hist.cumulative())}
+        return {
+            'time': time(),
+            'uptime': time() - self.started_at,
+            'queued': {p: c for p, c in self.queued.items() if c},
+            'started': {p: c for p, c in self.started.items() if c},
+            'finished': finished,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'timeout': self.timeout,
+            'durations': durations,
+        }
+
+    def prometheus(self) -> str:
+        ''' The metrics in the Prometheus text exposition format '''
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f'# HELP proxion_{name} {help_text}')
+            lines.append(f'# TYPE proxion_{name} {kind}')
+
+        family('checks_queued_total', 'counter', 'Checks handed to the workers')
+        for proto, count in self.queued.items():
+            lines.append(f'proxion_checks_queued_total{{protocol="{proto}"}} {count}')
+        family('checks_started_total', 'counter', 'Checks started by the workers')
+        for proto, count in self.started.items():
+            lines.append(f'proxion_checks_started_total{{protocol="{proto}"}} {count}')
+        family('checks_finished_total', 'counter', 'Checks finished, by outcome')
+        for (proto, outcome), count in self.finished.items():
+            lines.append(f'proxion_checks_finished_total{{protocol="{proto}",outcome="{outcome}"}} {count}')
+
+        family('check_duration_seconds', 'histogram', 'How long the checks took, by outcome')
+        for (proto, outcome), hist in self.durations.items():
+            labels = f'protocol="{proto}",outcome="{outcome}"'
+            for bound, count in hist.cumulative():
+                lines.append(f'proxion_check_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'proxion_check_duration_seconds_sum{{{labels}}} {hist.sum:.6f}')
+            lines.append(f'proxion_check_duration_seconds_count{{{labels}}} {hist.count}')
+
+        family('checks_queue_depth', 'gauge', 'Checks waiting for a worker')
+        lines.append(f'proxion_checks_queue_depth {self.queue_depth}')
+        family('checks_in_flight', 'gauge', 'Checks started but not finished yet')
+        lines.append(f'proxion_checks_in_flight {self.in_flight}')
+        family('check_timeout_seconds', 'gauge', 'The current timeout of a check')
+        lines.append(f'proxion_check_timeout_seconds {self.timeout:g}')
+        family('uptime_seconds', 'gauge', 'Seconds since the checks started')
+        lines.append(f'proxion_uptime_seconds {time() - self.started_at:.3f}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    '''
+    Exports the metrics of a check run, serving them to Prometheus on `http://host:port/metrics`
+    and / or appending a snapshot of them as a JSON line to `jsonl_file` every `interval` seconds.
+
+    The checker attaches its metrics (and the callback refreshing its gauges),
+    starts the exporter once its workers run and exports from its status loop.
+    '''
+
+    def __init__(self, jsonl_file: Path = None, port: int = None,
+                 host: str = Defaults.metrics_host,
+                 interval: float = Defaults.metrics_interval):
+        if jsonl_file is None and port is None:
+            raise ValueError('Nowhere to export the metrics to')
+        self.jsonl_file = Path(jsonl_file) if jsonl_file else None
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.metrics = CheckerMetrics()
+        self.refresh: Callable[[], None] = lambda: None
+        self.server: Optional[ThreadingHTTPServer] = None
+        self._last_write = 0.0
+
+    def attach(self, metrics: CheckerMetrics, refresh: Callable[[], None]) -> None:
+        self.metrics = metrics
+        self.refresh = refresh
+
+    def start(self) -> None:
+        ''' Start serving the Prometheus endpoint (in a thread of its own) '''
+        if self.port is None or self.server is not None:
+            return
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                exporter.refresh()
+                body = exporter.metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        # Port 0 means any free port, remember which one we got
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        pr(f'Serving metrics on {cyan(f"http://{self.host}:{self.port}/metrics")}', '*')
+
+    def maybe_write(self, force: bool = False) -> bool:
+        ''' Append a snapshot to the JSON lines file, if it's time to '''
+        if self.jsonl_file is None or (not force and time() - self._last_write < self.interval):
+            return False
+        self._last_write = time()
+        self.refresh()
+        with self.jsonl_file.open('a') as file:
+            file.write(dumps(self.metrics.snapshot()) + '\n')
+        return True
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
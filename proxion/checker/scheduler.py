@@ -0,0 +1,81 @@
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+from typing import Iterable, List, Optional, Tuple
+
+from proxion.util import Proxy
+from proxion import Defaults
+from proxion.checker.checker_filter import Job
+
+
+class RecheckScheduler:
+    '''
+    Keeps the jobs (grouped, a proxy and its protocols) in a heap keyed by when they are due,
+    so the next proxy to recheck is popped in O(log n) instead of scanning the whole list.
+
+    A working proxy is due `interval` seconds after its last check (stretched for unreliable ones),
+    a dead one backs off exponentially with its consecutive failures, up to `max_interval`.
+    Never checked proxies are due right away.
+    '''
+
+    def __init__(self, jobs: Iterable[Job] = (),
+                 interval: float = Defaults.recheck_interval,
+                 backoff: float = Defaults.recheck_backoff,
+                 max_interval: float = Defaults.recheck_max_interval):
+        if interval <= 0:
+            raise ValueError(f'Invalid recheck interval: {interval}')
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self._seq = count()
+        self._heap: List[Tuple[float, int, Job]] = []
+        for proxy, protos in jobs:
+            self.push(proxy, protos)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @staticmethod
+    def failures(proxy: Proxy) -> int:
+        ''' How many of the latest check rounds failed in a row '''
+        streak = 0
+        for success in proxy.history:
+            if success:
+                break
+            streak += 1
+        if not streak and not proxy.checks and proxy.last_check and not proxy.protos:
+            # Checked before the history was kept, and it didn't work
+            streak = 1
+        return streak
+
+    def recheck_after(self, proxy: Proxy) -> float:
+        ''' Seconds between the last check of the proxy and its next one '''
+        failures = self.failures(proxy)
+        if failures:
+            return min(self.interval * self.backoff ** failures, self.max_interval)
+        return min(self.interval / proxy.reliability, self.max_interval)
+
+    def due(self, proxy: Proxy) -> float:
+        if not proxy.last_check:
+            return 0
+        return proxy.last_check + self.recheck_after(proxy)
+
+    def push(self, proxy: Proxy, protos: Tuple[str]) -> None:
+        heappush(self._heap, (self.due(proxy), next(self._seq), (proxy, protos)))
+
+    def pop_due(self, now: float = None) -> Optional[Job]:
+        ''' The most overdue job, None if none is due yet '''
+        if not self._heap or self._heap[0][0] > (time() if now is None else now):
+            return None
+        return heappop(self._heap)[2]
+
+    def count_due(self, now: float = None) -> int:
+        ''' How many checks (of the jobs' protocols) are due, in a pass over the jobs '''
+        now = time() if now is None else now
+        return sum(len(protos) for due, _, (_, protos) in self._heap if due <= now)
+
+    def wait_time(self, now: float = None) -> Optional[float]:
+        ''' Seconds until the next job is due, None when there are no jobs '''
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - (time() if now is None else now), 0)
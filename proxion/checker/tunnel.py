@@ -0,0 +1,144 @@
+'''
+Raw asyncio implementation of the proxy handshakes we check for.
+
+Every function here works on a plain non-blocking socket (using the `loop.sock_*` API),
+so once a tunnel is negotiated the socket can be handed to `asyncio.open_connection`
+(optionally wrapping it with TLS) for the actual request.
+'''
+import asyncio
+import socket
+from ipaddress import IPv4Address
+from struct import pack, unpack
+
+
+class TunnelError(Exception):
+    pass
+
+
+async def open_socket(host: str, port: int) -> socket.socket:
+    ''' Open a non-blocking TCP connection to `host:port` '''
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, (host, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    buff = b''
+    while len(buff) < size:
+        chunk = await loop.sock_recv(sock, size - len(buff))
+        if not chunk:
+            raise TunnelError('Connection closed during handshake')
+        buff += chunk
+    return buff
+
+
+async def recv_headers(sock: socket.socket, max_size: int = 16384) -> bytes:
+    '''
+    Read an HTTP response head (up to and including the empty line).
+    Nothing may follow the head of a CONNECT reply until we speak first,
+    so reading in chunks never swallows tunneled data.
+    '''
+    loop = asyncio.get_running_loop()
+    buff = b''
+    while b'\r\n\r\n' not in buff:
+        if len(buff) > max_size:
+            raise TunnelError('Response headers too long')
+        chunk = await loop.sock_recv(sock, 4096)
+        if not chunk:
+            raise TunnelError('Connection closed during handshake')
+        buff += chunk
+    return buff
+
+
+async def negotiate_http_connect(sock: socket.socket, host: str, port: int) -> None:
+    loop = asyncio.get_running_loop()
+    await loop.sock_sendall(sock, (
+        f'CONNECT {host}:{port} HTTP/1.1\r\n'
+        f'Host: {host}:{port}\r\n'
+        '\r\n').encode())
+    head = await recv_headers(sock)
+    status = head.split(b'\r\n', 1)[0].split()
+    if len(status) < 2 or not status[0].startswith(b'HTTP/') or status[1] != b'200':
+        raise TunnelError(f'CONNECT refused: {head[:64]!r}')
+
+
+async def negotiate_socks4(sock: socket.socket, host: str, port: int) -> None:
+    loop = asyncio.get_running_loop()
+    address = await resolve(host)
+    await loop.sock_sendall(sock, pack('>BBH', 4, 1, port) + IPv4Address(address).packed + b'\x00')
+    version, status = unpack('>BB', (await recv_exactly(sock, 8))[:2])
+    if version != 0:
+        raise TunnelError(f'Not a SOCKS4 reply (version={version})')
+    if status != 0x5a:
+        raise TunnelError(f'SOCKS4 request rejected (status={status:#x})')
+
+
+async def negotiate_socks5(sock: socket.socket, host: str, port: int) -> None:
+    loop = asyncio.get_running_loop()
+
+    # Greeting: offer only the "no authentication" method
+    await loop.sock_sendall(sock, b'\x05\x01\x00')
+    version, method = unpack('>BB', await recv_exactly(sock, 2))
+    if version != 5:
+        raise TunnelError(f'Not a SOCKS5 reply (version={version})')
+    if method != 0:
+        raise TunnelError('SOCKS5 proxy requires authentication')
+
+    # CONNECT request, let the proxy resolve the domain name
+    encoded = host.encode('idna')
+    await loop.sock_sendall(sock, pack('>BBBBB', 5, 1, 0, 3, len(encoded)) + encoded + pack('>H', port))
+    version, status, _, atyp = unpack('>BBBB', await recv_exactly(sock, 4))
+    if version != 5:
+        raise TunnelError(f'Not a SOCKS5 reply (version={version})')
+    if status != 0:
+        raise TunnelError(f'SOCKS5 request rejected (status={status:#x})')
+
+    # Drain the bound address
+    if atyp == 1:
+        await recv_exactly(sock, 4 + 2)
+    elif atyp == 4:
+        await recv_exactly(sock, 16 + 2)
+    elif atyp == 3:
+        length = (await recv_exactly(sock, 1))[0]
+        await recv_exactly(sock, length + 2)
+    else:
+        raise TunnelError(f'SOCKS5 reply has unknown address type: {atyp}')
+
+
+_negotiators = {
+    'https': negotiate_http_connect,
+    'socks4': negotiate_socks4,
+    'socks5': negotiate_socks5,
+}
+
+_resolved = {}
+
+
+async def resolve(host: str) -> str:
+    ''' Resolve (and cache) an IPv4 address for `host`, SOCKS4 can not resolve on its own '''
+    if host not in _resolved:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        _resolved[host] = infos[0][4][0]
+    return _resolved[host]
+
+
+async def negotiate(sock: socket.socket, protocol: str, host: str, port: int) -> None:
+    '''
+    Negotiate a tunnel to `host:port` trough an already connected proxy socket.
+    Plain 'http' proxies do not tunnel, the request is sent in absolute-form instead.
+    '''
+    if protocol == 'http':
+        return
+    try:
+        negotiator = _negotiators[protocol]
+    except KeyError:
+        raise ValueError(f'Unsupported protocol: "{protocol}"')
+    await negotiator(sock, host, port)
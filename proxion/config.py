@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
 from pathlib import Path
-from multiprocessing import cpu_count
 from typing import Set
+import os
 
 from termcolor import colored
 from interutils import pr, cyan
@@ -9,14 +9,51 @@ from interutils import pr, cyan
 
 class Defaults:
     store = Path().home().joinpath('.cache', 'proxion')
-    db_file = 'proxydb.json'
-    checker_max_threads = cpu_count() - 1
+    db_file = 'proxydb.sqlite'
+    legacy_db_file = 'proxydb.json'
+    checker_max_threads = max(1, (os.cpu_count() or 1) - 1)
     checker_proxy_protocols: Set[str] = set(
         {'socks5', 'socks4', 'https', 'http'})
     checker_timeout = 10
+    checker_engines = ('process', 'async')
+    checker_engine = 'process'
+    checker_concurrency = 1000
+    checker_probe_timeout = 3
+    adaptive_percentile = 0.95
+    adaptive_margin = 1.5
+    adaptive_min_samples = 20
+    adaptive_min_timeout = 1
+    adaptive_hint_factor = 3
+    recheck_interval = 600
+    recheck_backoff = 2
+    recheck_max_interval = 7 * 24 * 3600
+    checker_judge = 'https://ipinfo.io/'
+    checker_judge_parser = 'ipinfo'
+    judge_host = '127.0.0.1'
+    judge_port = 8899
+    gateway_host = '127.0.0.1'
+    gateway_port = 8898
+    gateway_strategies = ('round_robin', 'latency', 'random')
+    gateway_strategy = 'round_robin'
+    gateway_retries = 3
+    gateway_cooldown = 60
+    gateway_connect_timeout = 5
+    gateway_pool_size = 2
+    gateway_pool_idle = 30
+    gateway_reload_interval = 300
+    api_host = '127.0.0.1'
+    api_port = 8897
+    api_reload_interval = 1
+    metrics_host = '127.0.0.1'
+    metrics_interval = 10
+    commit_batch_size = 500
+    commit_interval = 30
+    ingest_batch_size = 10000
 
 
 class Config:
+    # Until `init` picks it
+    store = Defaults.store
 
     @classmethod
     def init(cls) -> int:
@@ -54,6 +91,10 @@ class Config:
 class Args:
     @classmethod
     def parse_arguments(cls):
+        return cls.build_parser().parse_args()
+
+    @classmethod
+    def build_parser(cls) -> ArgumentParser:
         parser = ArgumentParser()
 
         subparser = parser.add_subparsers(
@@ -66,6 +107,12 @@ class Args:
             'query', aliases=('q', 'Q'), help='Query the database for proxies'))
         cls.mode_check(subparser.add_parser(
             'check', aliases=('c', 'C'), help='Check proxies'))
+        cls.mode_judge(subparser.add_parser(
+            'judge', aliases=('j', 'J'), help='Run a local proxy judge'))
+        cls.mode_serve(subparser.add_parser(
+            'serve', aliases=('s', 'S'), help='Run a local rotating proxy over the checked proxies'))
+        cls.mode_api(subparser.add_parser(
+            'api', help='Run a local HTTP/JSON service answering proxy queries'))
 
         parser.add_argument('-v', '--verbose', action='store_true',
                             help='Show verbose info')
@@ -75,14 +122,19 @@ class Args:
         parser.add_argument('--db-file', type=str, default=Defaults.db_file,
                             help=f'The proxy-db file name (default: \
                                 {colored(Defaults.db_file, "green")})')
+        parser.add_argument('--profile', metavar='[file]', type=str,
+                            help='Profile the command (the worker processes included) into this file ' +
+                            '(pstats format, for snakeviz / gprof2dot / python -m pstats), ' +
+                            'with its phase timings as a Chrome trace in [file].trace.json')
 
-        return parser.parse_args()
+        return parser
 
     @classmethod
     def mode_modify(cls, args: ArgumentParser):
         args.add_argument(
             'proxies', nargs='+',
-            help='Either literal proxy(ies) or file(s) containing proxies line-by-line')
+            help="Either literal proxy(ies) or file(s) containing proxies line-by-line " +
+            "(may be gzip compressed, '-' reads from stdin)")
 
         sub_mode = args.add_mutually_exclusive_group()
         sub_mode.add_argument('-l', '--literal', action='store_const',
@@ -98,7 +150,8 @@ class Args:
                           help=f'Number of proxies to query (default: {cyan("all")})')
         args.add_argument('-ns', '--no-shuffle', action='store_true',
                           help="Don't shuffle array")
-        args.add_argument('-f', '--format', type=str, choices=('json', 'grep'), default='json',
+        args.add_argument('-f', '--format', type=str, default='json',
+                          choices=('json', 'jsonl', 'grep', 'csv'),
                           help=f'Format to return (default: {cyan("json")})')
         args.add_argument('--json-inline', action='store_true',
                           help='Print JSON format as a one-liner')
@@ -107,19 +160,64 @@ class Args:
         args.add_argument('-p', '--protocols',
                           choices=Defaults.checker_proxy_protocols,
                           type=str, nargs="+", help=f'Proxies protocols to get (default: {cyan("all")})')
+        args.add_argument('-c', '--country', type=str, nargs='+',
+                          help='Only get proxies exiting in these countries (e.g. US, UK)')
+        args.add_argument('-ml', '--max-latency', metavar='[sec]', type=float,
+                          help='Only get proxies with a latency up to that value')
+        args.add_argument('-fr', '--fresh', type=str,
+                          help='Only get proxies checked recently, use time suffix ' +
+                          '[s, m, h, d, w, mo, y] (e.g. 10m, 1d)')
+        args.add_argument('-mr', '--min-reliability', metavar='[0-1]', type=float,
+                          help='Only get proxies with at least this reliability score ' +
+                          '(their smoothed success rate over the recent checks)')
+        args.add_argument('-or', '--order', type=str,
+                          choices=('random', 'latency', 'last_check', 'reliability'),
+                          help=f'Order of the returned proxies (default: {cyan("random")}, ' +
+                          'or as stored with --no-shuffle), reliability puts the best proxies first')
         args.add_argument('-o', '--output', type=str,
                           help='Output file to write results into')
 
     @classmethod
     def mode_check(cls, args: ArgumentParser):
+        # Imported here, the checker package needs the Defaults above
+        from proxion.checker.judge_parsers import judge_parsers
+
         args.add_argument('-t', '--timeout', metavar='[sec]',
                           type=int, default=Defaults.checker_timeout,
                           help=f'How long to wait for a response (default: \
                               {colored(Defaults.checker_timeout, "green")})')
+        args.add_argument('-at', '--adaptive-timeout', action='store_true',
+                          help='Adapt the timeout of every check to the latencies of the working proxies ' +
+                          f'seen so far ({Defaults.adaptive_percentile:.0%}% of them, with a margin) ' +
+                          "and to the proxy's own last latency, never exceeding --timeout")
         args.add_argument('-m', '--max-threads',
                           type=int, default=Defaults.checker_max_threads,
                           help=f'How many threads should we run (default: \
                               {colored(Defaults.checker_max_threads, "green")})')
+        args.add_argument('-e', '--engine', type=str,
+                          choices=Defaults.checker_engines, default=Defaults.checker_engine,
+                          help='Run checks on a pool of processes or on a single asyncio event loop ' +
+                          f'(default: {colored(Defaults.checker_engine, "green")})')
+        args.add_argument('-c', '--concurrency', type=int, default=Defaults.checker_concurrency,
+                          help='How many checks should run at once with the async engine (default: ' +
+                          f'{colored(Defaults.checker_concurrency, "green")})')
+        args.add_argument('-rc', '--reuse-connections', action='store_true',
+                          help='Check all the protocols of a proxy back-to-back on the same worker, ' +
+                          "reusing the proxy's connection pool")
+        args.add_argument('-sm', '--smart', action='store_true',
+                          help='Probe every proxy with a TCP connect first and skip the dead ones, ' +
+                          'then try the protocols in the order most likely for its port (by DB history)')
+        args.add_argument('-fs', '--first-success', action='store_true',
+                          help='Stop checking a proxy at its first working protocol ' +
+                          '(enough for "is it alive")')
+        args.add_argument('-co', '--continuous', action='store_true',
+                          help='Keep rechecking the proxies as they become due (until interrupted) ' +
+                          'on the async engine: working proxies every --recheck-interval, ' +
+                          'dead ones backing off exponentially')
+        args.add_argument('-ri', '--recheck-interval', type=str,
+                          help='How often to recheck working proxies with --continuous, ' +
+                          'use time suffix [s, m, h, d, w, mo, y] ' +
+                          f'(default: {colored(Defaults.recheck_interval, "green")} sec)')
         args.add_argument('-ns', '--no-shuffle', action='store_true',
                           help="Don't shuffle proxy list after loading")
         args.add_argument('-p', '--protocols', type=str, nargs='+',
@@ -134,11 +232,102 @@ class Args:
                           'values lower than] (e.g. -90 , +150 )')
         args.add_argument('-ec', '--exit-country', type=str, nargs='+',
                           help='Filter proxies by exit country')
+        args.add_argument('-mr', '--min-reliability', metavar='[0-1]', type=float,
+                          help='Filter proxies by their reliability score ' +
+                          '(their smoothed success rate over the recent checks)')
+        args.add_argument('-or', '--order', type=str, default='random',
+                          choices=('random', 'latency', 'last_check', 'reliability'),
+                          help=f'Order to check the proxies in (default: {cyan("random")})')
         args.add_argument('-s', '--strict', action='store_true',
                           help="When filtering don't include proxies without a value," +
                           " only filter proxies that strictly have a value")
+        args.add_argument('-j', '--judge', metavar='[url]', type=str, default=Defaults.checker_judge,
+                          help='The URL we fetch trough the proxies to check them, ' +
+                          "use 'proxion judge' for a local one " +
+                          f'(default: {colored(Defaults.checker_judge, "green")})')
+        args.add_argument('-jp', '--judge-parser', type=str, default=Defaults.checker_judge_parser,
+                          choices=tuple(judge_parsers),
+                          help='How to read the judge responses: ipinfo.io JSON, any JSON with an "ip" ' +
+                          'field (like proxion judge) or a plain text IP ' +
+                          f'(default: {colored(Defaults.checker_judge_parser, "green")})')
+        args.add_argument('-g', '--geoip', metavar='[file]', type=str,
+                          help='Look up exit countries offline in this IP-range DB instead of trusting ' +
+                          'the judge: a CSV of "start,end,country" rows (e.g. DB-IP / IP2Location lite) ' +
+                          'or an .mmdb')
+        args.add_argument('--no-save', action='store_false', dest='save',
+                          help="Don't write check results back into the DB")
+        args.add_argument('-cb', '--commit-batch', metavar='[count]', type=int,
+                          default=Defaults.commit_batch_size,
+                          help='Commit results into the DB once that many are pending (default: ' +
+                          f'{colored(Defaults.commit_batch_size, "green")})')
+        args.add_argument('-ci', '--commit-interval', metavar='[sec]', type=int,
+                          default=Defaults.commit_interval,
+                          help='Commit pending results into the DB at least this often (default: ' +
+                          f'{colored(Defaults.commit_interval, "green")})')
+        args.add_argument('-mf', '--metrics-file', metavar='[file]', type=str,
+                          help='Append a JSON line of the check metrics (checks queued, started and ' +
+                          'finished per protocol and outcome, their durations, the queue depth) ' +
+                          'to this file every --metrics-interval')
+        args.add_argument('-mi', '--metrics-interval', metavar='[sec]', type=float,
+                          default=Defaults.metrics_interval,
+                          help='How often to write the metrics file (default: ' +
+                          f'{colored(Defaults.metrics_interval, "green")})')
+        args.add_argument('-mp', '--metrics-port', metavar='[port]', type=int,
+                          help='Serve the check metrics to Prometheus on ' +
+                          f'http://{Defaults.metrics_host}:[port]/metrics')
         sub_mode = args.add_mutually_exclusive_group()
         sub_mode.add_argument('-l', '--literal', type=str, nargs='+',
                               help='Pass as argument (one or more) proxies')
         sub_mode.add_argument('-f', '--file', type=str, nargs='+',
                               help='Pass as argument (one or more) files containing proxies')
+
+    @classmethod
+    def mode_judge(cls, args: ArgumentParser):
+        args.add_argument('-H', '--host', type=str, default=Defaults.judge_host,
+                          help=f'Address to listen on (default: {colored(Defaults.judge_host, "green")})')
+        args.add_argument('-P', '--port', type=int, default=Defaults.judge_port,
+                          help=f'Port to listen on (default: {colored(Defaults.judge_port, "green")})')
+        args.add_argument('--cert', type=str,
+                          help='Serve HTTPS using this certificate (PEM) file')
+        args.add_argument('--key', type=str,
+                          help='Private key file of the certificate (if not included in it)')
+
+    @classmethod
+    def mode_serve(cls, args: ArgumentParser):
+        args.add_argument('-H', '--host', type=str, default=Defaults.gateway_host,
+                          help=f'Address to listen on (default: {colored(Defaults.gateway_host, "green")})')
+        args.add_argument('-P', '--port', type=int, default=Defaults.gateway_port,
+                          help=f'Port to listen on (default: {colored(Defaults.gateway_port, "green")})')
+        args.add_argument('-s', '--strategy', type=str,
+                          choices=Defaults.gateway_strategies, default=Defaults.gateway_strategy,
+                          help='How to pick the upstream proxy of every request, latency picks the ' +
+                          f'lowest EWMA latency (default: {colored(Defaults.gateway_strategy, "green")})')
+        args.add_argument('-p', '--protocols', type=str, nargs='+',
+                          choices=Defaults.checker_proxy_protocols,
+                          help=f'Only use upstream proxies of these protocols (default: {cyan("all")})')
+        args.add_argument('-c', '--country', type=str, nargs='+',
+                          help='Only use upstream proxies exiting in these countries (e.g. US, UK), ' +
+                          'HTTP clients may pick one per request with an X-Proxion-Country header')
+        args.add_argument('-ml', '--max-latency', metavar='[sec]', type=float,
+                          help='Only use upstream proxies with a latency up to that value')
+        args.add_argument('-mr', '--min-reliability', metavar='[0-1]', type=float,
+                          help='Only use upstream proxies with at least this reliability score')
+        args.add_argument('-r', '--retries', type=int, default=Defaults.gateway_retries,
+                          help='How many other upstream proxies to try when one fails (default: ' +
+                          f'{colored(Defaults.gateway_retries, "green")})')
+        args.add_argument('-ps', '--pool-size', type=int, default=Defaults.gateway_pool_size,
+                          help='Spare connections to keep open to every upstream proxy in use (default: ' +
+                          f'{colored(Defaults.gateway_pool_size, "green")})')
+        args.add_argument('--no-save', action='store_false', dest='save',
+                          help="Don't record upstream failures into the DB")
+
+    @classmethod
+    def mode_api(cls, args: ArgumentParser):
+        args.add_argument('-H', '--host', type=str, default=Defaults.api_host,
+                          help=f'Address to listen on (default: {colored(Defaults.api_host, "green")})')
+        args.add_argument('-P', '--port', type=int, default=Defaults.api_port,
+                          help=f'Port to listen on (default: {colored(Defaults.api_port, "green")})')
+        args.add_argument('-ri', '--reload-interval', metavar='[sec]', type=float,
+                          default=Defaults.api_reload_interval,
+                          help='How often to look for changes of the DB file (default: ' +
+                          f'{colored(Defaults.api_reload_interval, "green")})')
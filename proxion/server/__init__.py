@@ -0,0 +1,15 @@
+from typing import TYPE_CHECKING
+
+from proxion.util import lazy_exports
+
+if TYPE_CHECKING:
+    from .judge import JudgeServer
+    from .gateway import GatewayServer, UpstreamSelector
+    from .api import ApiServer
+
+__getattr__ = lazy_exports(__name__, {
+    'JudgeServer': '.judge',
+    'GatewayServer': '.gateway',
+    'UpstreamSelector': '.gateway',
+    'ApiServer': '.api',
+})
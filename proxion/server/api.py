@@ -0,0 +1,226 @@
+from io import StringIO
+from json import dumps
+from pathlib import Path
+from random import sample
+from time import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+from zlib import crc32
+import asyncio
+
+from interutils import pr, cyan
+
+from proxion.util import Proxy, ProxyDB, ProxyPool
+from proxion.util.output import writers
+from proxion import Defaults
+from proxion.server.http import HTTPRequest, read_request, build_response
+
+
+content_types = {
+    'json': 'application/json',
+    'jsonl': 'application/x-ndjson',
+    'grep': 'text/plain',
+    'csv': 'text/csv',
+}
+
+
+class ApiQuery:
+    '''
+    The query string options of a `/proxies` request, like the ones of `proxion query`:
+    num, protocols, format, info, country, max_latency and shuffle
+    (repeated or comma separated values for protocols and country).
+    '''
+
+    def __init__(self, query: str):
+        params = parse_qs(query)
+
+        def get(name: str, default: str = None) -> Optional[str]:
+            return params[name][-1] if name in params else default
+
+        def get_list(name: str) -> List[str]:
+            return [val for vals in params.get(name, ()) for val in vals.split(',') if val]
+
+        try:
+            self.num = int(get('num', '0'))
+            self.max_latency = float(get('max_latency')) if 'max_latency' in params else None
+        except ValueError as err:
+            raise ValueError(f'Invalid number: {err}')
+        if self.num < 0:
+            raise ValueError(f'Invalid num: {self.num}')
+
+        self.protocols = set(get_list('protocols'))
+        for proto in self.protocols:
+            if proto not in Defaults.checker_proxy_protocols:
+                raise ValueError(f'Invalid protocol requested: "{proto}"')
+        self.countries = [c.upper() for c in get_list('country')]
+
+        self.format = get('format', 'json')
+        if self.format not in writers:
+            raise ValueError(f'Invalid format: "{self.format}"')
+        self.info = get('info', '1') not in ('0', 'false', 'no')
+        self.shuffle = get('shuffle', '1') not in ('0', 'false', 'no')
+
+    @property
+    def key(self) -> tuple:
+        ''' Identifies the response (of a query without shuffle) '''
+        return (self.num, frozenset(self.protocols), tuple(sorted(self.countries)),
+                self.max_latency, self.format, self.info)
+
+
+class ApiServer:
+    '''
+    A local HTTP/JSON service answering proxy queries from memory:
+
+    GET /proxies?num=10&protocols=socks5&country=US&max_latency=2&format=json&info=0
+    GET /health
+
+    Random picks (the default) are drawn from a `ProxyPool`.
+    With `shuffle=0` the proxies come in the DB order, such responses are cached
+    and tagged with an ETag, so a client sending it back in If-None-Match gets a 304 instead.
+
+    The DB file is polled (at most every `reload_interval` seconds),
+    only when it changed the pool is reloaded and the cached responses dropped.
+    '''
+
+    request_timeout = 10
+    max_cached = 1024
+
+    def __init__(self, host: str, port: int, db_file: Path,
+                 reload_interval: float = Defaults.api_reload_interval,
+                 verbose: bool = False):
+        self.host = host
+        self.port = port
+        self.db_file = Path(db_file)
+        self.reload_interval = reload_interval
+        self.verbose = verbose
+        self.pool = ProxyPool()
+        self.generation = 0
+        self.served = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._cache: Dict[tuple, Tuple[str, bytes]] = {}
+        self._db_state = self.db_state()
+        self._last_poll = time()
+
+    def db_state(self) -> tuple:
+        ''' Modification times and sizes of the DB files (SQLite writes go to the WAL first) '''
+        state = []
+        for path in (self.db_file, self.db_file.with_name(self.db_file.name + '-wal')):
+            try:
+                stat = path.stat()
+                state.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def maybe_reload(self) -> bool:
+        ''' Reload the pool if the DB changed since we loaded it '''
+        if time() - self._last_poll < self.reload_interval:
+            return False
+        self._last_poll = time()
+        state = self.db_state()
+        if state == self._db_state:
+            return False
+        self._db_state = state
+        # Reopening the DB reloads the pool as well
+        ProxyDB(self.db_file)
+        self._cache = {}
+        self.generation += 1
+        if self.verbose:
+            pr(f'DB changed, reloaded {cyan(len(self.pool))} proxies', '*')
+        return True
+
+    async def start(self) -> asyncio.AbstractServer:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # Port 0 means any free port, remember which one we got
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    def run(self) -> None:
+        ''' Serve until interrupted '''
+        async def _serve():
+            async with await self.start():
+                pr(f'API listening on {cyan(f"http://{self.host}:{self.port}/proxies")} '
+                   f'with {cyan(len(self.pool))} proxies')
+                await self.server.serve_forever()
+        try:
+            asyncio.run(_serve())
+        except KeyboardInterrupt:
+            print()
+            pr(f'API stopped after serving {cyan(self.served)} requests', '*')
+        finally:
+            self.pool.close()
+
+    def pick(self, query: ApiQuery) -> List[Proxy]:
+        if not query.shuffle:
+            return list(ProxyDB.query(query.protocols, query.countries, query.max_latency,
+                                      limit=query.num))
+        if len(query.countries) <= 1:
+            country = query.countries[0] if query.countries else None
+            return self.pool.random(query.num, query.protocols, country, query.max_latency)
+        proxies = [proxy for country in set(query.countries)
+                   for proxy in self.pool.random(0, query.protocols, country, query.max_latency)]
+        return sample(proxies, min(query.num, len(proxies)) if query.num else len(proxies))
+
+    def render(self, query: ApiQuery) -> bytes:
+        stream = StringIO()
+        with writers[query.format](stream, query.info) as writer:
+            for proxy in self.pick(query):
+                writer.write(proxy)
+        return stream.getvalue().encode()
+
+    def respond(self, request: HTTPRequest) -> bytes:
+        if request.method != 'GET':
+            return build_response(405, keep_alive=request.keep_alive, headers={'Allow': 'GET'})
+
+        url = urlsplit(request.target)
+        if url.path == '/health':
+            body = dumps({'proxies': len(self.pool), 'generation': self.generation}).encode()
+            return build_response(200, body, keep_alive=request.keep_alive)
+        if url.path != '/proxies':
+            return build_response(404, keep_alive=request.keep_alive)
+
+        try:
+            query = ApiQuery(url.query)
+        except ValueError as err:
+            body = dumps({'error': str(err)}).encode()
+            return build_response(400, body, keep_alive=request.keep_alive)
+
+        content_type = content_types[query.format]
+        if query.shuffle:
+            return build_response(200, self.render(query), content_type,
+                                  {'Cache-Control': 'no-store'}, request.keep_alive)
+
+        cached = self._cache.get(query.key)
+        if cached is None:
+            body = self.render(query)
+            etag = f'"{crc32(body):08x}-{len(body):x}"'
+            if len(self._cache) >= self.max_cached:
+                self._cache = {}
+            cached = self._cache[query.key] = (etag, body)
+        etag, body = cached
+        if request.header('If-None-Match') == etag:
+            return build_response(304, content_type=content_type, headers={'ETag': etag},
+                                  keep_alive=request.keep_alive)
+        return build_response(200, body, content_type, {'ETag': etag}, request.keep_alive)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), self.request_timeout)
+                except ValueError:
+                    writer.write(build_response(400, keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                self.served += 1
+                self.maybe_reload()
+                writer.write(self.respond(request))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,436 @@
+from collections import deque
+from ipaddress import IPv4Address, IPv6Address
+from random import randrange
+from struct import unpack
+from time import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+import asyncio
+import socket
+
+from interutils import pr, cyan
+
+from proxion.util import Proxy, ProxyDBCommitter
+from proxion import Defaults
+from proxion.checker.tunnel import open_socket, negotiate, TunnelError
+from proxion.server.http import HTTPRequest, parse_request, build_response
+
+
+# The protocols able to tunnel any TCP connection, in order of preference
+TUNNEL_PROTOCOLS = ('socks5', 'https', 'socks4')
+
+
+def upstream_protocol(proxy: Proxy, plain_http: bool = False) -> Optional[str]:
+    ''' How to reach a destination trough the proxy, plain HTTP requests may go to HTTP proxies as well '''
+    protos = proxy.protos
+    if plain_http and 'http' in protos:
+        return 'http'
+    for proto in TUNNEL_PROTOCOLS:
+        if proto in protos:
+            return proto
+    return None
+
+
+def latency_key(proxy: Proxy) -> float:
+    ''' The EWMA latency, the last one for proxies without a history '''
+    latency = proxy.ewma_lat if proxy.ewma_lat is not None else proxy.last_lat
+    return float('inf') if latency is None else latency
+
+
+class UpstreamSelector:
+    '''
+    Picks the upstream proxy of every request by a strategy:
+    round_robin - each proxy in turn,
+    latency - the one with the lowest EWMA latency,
+    random - any of them.
+
+    The proxies are also grouped by their exit country, so a request may ask for one.
+    A proxy that failed is left out for `cooldown` seconds.
+    '''
+
+    strategies = Defaults.gateway_strategies
+
+    def __init__(self, proxies: Iterable[Proxy],
+                 strategy: str = Defaults.gateway_strategy,
+                 cooldown: float = Defaults.gateway_cooldown):
+        if strategy not in self.strategies:
+            raise ValueError(f'Unknown upstream strategy: "{strategy}"')
+        self.strategy = strategy
+        self.cooldown = cooldown
+
+        self.groups: Dict[Optional[str], List[Proxy]] = {None: []}
+        for proxy in proxies:
+            if upstream_protocol(proxy, True) is None:
+                continue
+            self.groups[None].append(proxy)
+            if proxy.exit_country:
+                self.groups.setdefault(proxy.exit_country, []).append(proxy)
+        if strategy == 'latency':
+            for group in self.groups.values():
+                group.sort(key=latency_key)
+
+        self.cooling: Dict[str, float] = {}
+        self._cursors: Dict[Optional[str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.groups[None])
+
+    def pick(self, country: str = None, plain_http: bool = False,
+             exclude: Set[str] = frozenset()) -> Optional[Proxy]:
+        '''
+        The next upstream to use (exiting in `country` if given),
+        skipping the `exclude`d proxies, the cooling ones and the ones that can't carry the request
+        '''
+        key = country.upper() if country else None
+        group = self.groups.get(key)
+        if not group:
+            return None
+
+        size = len(group)
+        if self.strategy == 'round_robin':
+            start = self._cursors.get(key, 0)
+        elif self.strategy == 'random':
+            start = randrange(size)
+        else:
+            start = 0
+
+        now = time()
+        for i in range(size):
+            proxy = group[(start + i) % size]
+            pip = proxy.pip
+            if pip in exclude or self.cooling.get(pip, 0) > now:
+                continue
+            if upstream_protocol(proxy, plain_http) is None:
+                continue
+            if self.strategy == 'round_robin':
+                self._cursors[key] = (start + i + 1) % size
+            return proxy
+        return None
+
+    def failed(self, proxy: Proxy) -> None:
+        self.cooling[proxy.pip] = time() + self.cooldown
+
+
+def is_alive(sock: socket.socket) -> bool:
+    ''' An idle connection is still usable if the peer didn't close it (nor sent anything) '''
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+class UpstreamPool:
+    '''
+    Keeps up to `size` spare connections to every upstream proxy in use, opened ahead of time,
+    so a request only waits for the handshake trough the proxy, not for the connection to it.
+    A spare idle for more than `max_idle` seconds (or closed by the proxy) is dropped.
+    '''
+
+    def __init__(self, size: int = Defaults.gateway_pool_size,
+                 max_idle: float = Defaults.gateway_pool_idle,
+                 timeout: float = Defaults.gateway_connect_timeout):
+        self.size = size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle: Dict[str, Deque[Tuple[socket.socket, float]]] = {}
+        self.reused = 0
+        self._refills: Set[asyncio.Task] = set()
+
+    async def connect(self, proxy: Proxy) -> socket.socket:
+        ''' A connection to the proxy, a spare one if we have it '''
+        spares = self.idle.get(proxy.pip)
+        now = time()
+        sock = None
+        while spares and sock is None:
+            spare, opened_at = spares.popleft()
+            if now - opened_at < self.max_idle and is_alive(spare):
+                sock = spare
+                self.reused += 1
+            else:
+                spare.close()
+        if sock is None:
+            sock = await asyncio.wait_for(open_socket(proxy.ip, proxy.port), self.timeout)
+        self.refill(proxy)
+        return sock
+
+    def refill(self, proxy: Proxy) -> None:
+        ''' Open another spare connection to the proxy in the background '''
+        if len(self.idle.get(proxy.pip, ())) < self.size:
+            task = asyncio.ensure_future(self._open_spare(proxy))
+            self._refills.add(task)
+            task.add_done_callback(self._refills.discard)
+
+    async def _open_spare(self, proxy: Proxy) -> None:
+        try:
+            sock = await asyncio.wait_for(open_socket(proxy.ip, proxy.port), self.timeout)
+        except (asyncio.TimeoutError, OSError):
+            return
+        spares = self.idle.setdefault(proxy.pip, deque())
+        if len(spares) >= self.size:
+            sock.close()
+        else:
+            spares.append((sock, time()))
+
+    def prune(self) -> None:
+        ''' Close the spares idle for too long '''
+        expired = time() - self.max_idle
+        for pip in list(self.idle):
+            spares = self.idle[pip]
+            while spares and spares[0][1] < expired:
+                spares.popleft()[0].close()
+            if not spares:
+                del self.idle[pip]
+
+    def discard(self, proxy: Proxy) -> None:
+        for sock, _ in self.idle.pop(proxy.pip, ()):
+            sock.close()
+
+    def close(self) -> None:
+        for task in self._refills:
+            task.cancel()
+        for spares in self.idle.values():
+            for sock, _ in spares:
+                sock.close()
+        self.idle = {}
+
+
+class GatewayServer:
+    '''
+    A local rotating proxy in front of the checked proxies:
+    accepts HTTP (CONNECT and absolute-form requests) and SOCKS5 clients on the same port,
+    tunnels every request trough an upstream proxy picked by an `UpstreamSelector`
+    and relays the bytes both ways.
+
+    If an upstream fails, the request is retried on another one (up to `retries` times),
+    the failed upstream cools down and (given a committer) the failure is recorded into the DB.
+
+    The upstreams are loaded from `source` (e.g. a ProxyDB query),
+    reloaded every `reload_interval` seconds to pick up the latest check results.
+    HTTP clients may ask for an exit country with the `country_header` header.
+    '''
+
+    request_timeout = 10
+    buffer_size = 65536
+    country_header = 'X-Proxion-Country'
+
+    def __init__(self, host: str, port: int,
+                 source: Callable[[], Iterable[Proxy]],
+                 strategy: str = Defaults.gateway_strategy,
+                 committer: ProxyDBCommitter = None,
+                 retries: int = Defaults.gateway_retries,
+                 pool_size: int = Defaults.gateway_pool_size,
+                 reload_interval: float = Defaults.gateway_reload_interval,
+                 verbose: bool = False):
+        if strategy not in UpstreamSelector.strategies:
+            raise ValueError(f'Unknown upstream strategy: "{strategy}"')
+        if retries < 0:
+            raise ValueError(f'Invalid retries count: {retries}')
+        self.host = host
+        self.port = port
+        self.source = source
+        self.strategy = strategy
+        self.committer = committer
+        self.retries = retries
+        self.reload_interval = reload_interval
+        self.verbose = verbose
+        self.pool = UpstreamPool(pool_size)
+        self.selector = UpstreamSelector((), strategy)
+        self.served = 0
+        self.failures = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._maintenance: Optional[asyncio.Task] = None
+
+    def reload(self) -> int:
+        ''' Load the upstreams from the source, keeping the cooling ones aside '''
+        selector = UpstreamSelector(self.source(), self.strategy)
+        selector.cooling = self.selector.cooling
+        self.selector = selector
+        return len(selector)
+
+    async def start(self) -> asyncio.AbstractServer:
+        self.reload()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # Port 0 means any free port, remember which one we got
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._maintenance = asyncio.ensure_future(self.maintain())
+        return self.server
+
+    def stop(self) -> None:
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+        self.pool.close()
+        if self.committer:
+            self.committer.commit()
+
+    def run(self) -> None:
+        ''' Serve until interrupted '''
+        async def _serve():
+            async with await self.start():
+                pr(f'Gateway listening on {cyan(f"{self.host}:{self.port}")} '
+                   f'with {cyan(len(self.selector))} upstream proxies ({cyan(self.strategy)})')
+                await self.server.serve_forever()
+        try:
+            asyncio.run(_serve())
+        except KeyboardInterrupt:
+            print()
+        finally:
+            self.stop()
+            pr(f'Gateway stopped after serving {cyan(self.served)} requests, '
+               f'{cyan(self.failures)} upstream failures', '*')
+
+    async def maintain(self) -> None:
+        ''' Commit the recorded failures, drop expired spares and reload the upstreams periodically '''
+        last_reload = time()
+        while True:
+            await asyncio.sleep(1)
+            self.pool.prune()
+            if self.committer:
+                self.committer.maybe_commit()
+            if self.reload_interval and time() - last_reload >= self.reload_interval:
+                last_reload = time()
+                count = self.reload()
+                if self.verbose:
+                    pr(f'Reloaded {cyan(count)} upstream proxies', '*')
+
+    def upstream_failed(self, proxy: Proxy, err: BaseException) -> None:
+        self.failures += 1
+        self.selector.failed(proxy)
+        self.pool.discard(proxy)
+        if self.committer:
+            self.committer.add(proxy.pip, None, time())
+        if self.verbose:
+            pr(f'Upstream {cyan(proxy.pip)} failed: {type(err).__name__}', '*')
+
+    async def open_upstream(self, host: str, port: int, country: str = None,
+                            plain_http: bool = False) -> Optional[tuple]:
+        '''
+        Open a tunnel to `host:port` trough an upstream proxy, on failure try another one.
+
+        returns -> (upstream reader, upstream writer, protocol) or None if all the tries failed
+        '''
+        tried = set()
+        for _ in range(self.retries + 1):
+            proxy = self.selector.pick(country, plain_http, tried)
+            if proxy is None:
+                break
+            tried.add(proxy.pip)
+            protocol = upstream_protocol(proxy, plain_http)
+            sock = None
+            try:
+                sock = await self.pool.connect(proxy)
+                await asyncio.wait_for(negotiate(sock, protocol, host, port), self.pool.timeout)
+                reader, writer = await asyncio.open_connection(sock=sock, limit=self.buffer_size)
+                return reader, writer, protocol
+            except (asyncio.TimeoutError, OSError, TunnelError, ValueError) as err:
+                if sock is not None:
+                    sock.close()
+                self.upstream_failed(proxy, err)
+        return None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        upstream_writer = None
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), self.request_timeout)
+            if first == b'\x05':
+                upstream = await self.handle_socks5(reader, writer)
+            else:
+                head = first + await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.request_timeout)
+                upstream = await self.handle_http(parse_request(head), writer)
+            if upstream is None:
+                return
+            self.served += 1
+            upstream_reader, upstream_writer = upstream
+            await asyncio.gather(self.pipe(reader, upstream_writer), self.pipe(upstream_reader, writer))
+        except ValueError:
+            writer.write(build_response(400, keep_alive=False))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, TunnelError):
+            pass
+        finally:
+            if upstream_writer is not None:
+                upstream_writer.close()
+            writer.close()
+
+    async def handle_http(self, request: HTTPRequest, writer: asyncio.StreamWriter) -> Optional[tuple]:
+        country = request.header(self.country_header)
+        if request.method == 'CONNECT':
+            host, _, port = request.target.rpartition(':')
+            upstream = await self.open_upstream(host.strip('[]'), int(port), country)
+            if upstream is None:
+                writer.write(build_response(502, keep_alive=False))
+                return None
+            writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            return upstream[:2]
+
+        url = urlsplit(request.target)
+        if url.scheme != 'http' or not url.hostname:
+            raise ValueError(f'Not a proxy request: {request.target!r}')
+        upstream = await self.open_upstream(url.hostname, url.port or 80, country, plain_http=True)
+        if upstream is None:
+            writer.write(build_response(502, keep_alive=False))
+            return None
+        upstream_reader, upstream_writer, protocol = upstream
+
+        # HTTP proxies get the request as is, trough a tunnel it goes in origin-form
+        target = request.target
+        if protocol != 'http':
+            target = (url.path or '/') + ('?' + url.query if url.query else '')
+        head = f'{request.method} {target} {request.version}\r\n'
+        for key, val in request.headers.items():
+            if key.lower().startswith('proxy-') or key.lower() in ('connection', self.country_header.lower()):
+                continue
+            head += f'{key}: {val}\r\n'
+        # One request per upstream, the next one may go elsewhere
+        upstream_writer.write((head + 'Connection: close\r\n\r\n').encode('latin-1'))
+        return upstream_reader, upstream_writer
+
+    async def handle_socks5(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> Optional[tuple]:
+        async def read(size: int) -> bytes:
+            return await asyncio.wait_for(reader.readexactly(size), self.request_timeout)
+
+        def reply(status: int) -> None:
+            writer.write(bytes((5, status, 0, 1)) + bytes(6))
+
+        # Greeting: we only accept "no authentication"
+        methods = await read((await read(1))[0])
+        if 0 not in methods:
+            writer.write(b'\x05\xff')
+            return None
+        writer.write(b'\x05\x00')
+
+        version, command, _, atyp = await read(4)
+        if version != 5 or command != 1:
+            reply(0x07)  # Command not supported
+            return None
+        if atyp == 1:
+            host = str(IPv4Address(await read(4)))
+        elif atyp == 3:
+            host = (await read((await read(1))[0])).decode('idna')
+        elif atyp == 4:
+            host = str(IPv6Address(await read(16)))
+        else:
+            reply(0x08)  # Address type not supported
+            return None
+        port = unpack('>H', await read(2))[0]
+
+        upstream = await self.open_upstream(host, port)
+        if upstream is None:
+            reply(0x01)  # General failure
+            return None
+        reply(0x00)
+        return upstream[:2]
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        ''' Relay until EOF, then pass the EOF on '''
+        try:
+            while data := await reader.read(self.buffer_size):
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
@@ -0,0 +1,86 @@
+'''
+The bare minimum of HTTP/1.x our local servers need, on top of asyncio streams.
+'''
+from typing import Dict, Optional
+from http import HTTPStatus
+import asyncio
+
+
+class HTTPRequest:
+    method: str
+    target: str
+    version: str
+    headers: Dict[str, str]
+
+    def __init__(self, method: str, target: str, version: str, headers: Dict[str, str]):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def header(self, name: str, default: str = None) -> Optional[str]:
+        ''' Case insensitive header lookup '''
+        name = name.lower()
+        for key, val in self.headers.items():
+            if key.lower() == name:
+                return val
+        return default
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = (self.header('Connection') or '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+async def read_request(reader: asyncio.StreamReader, max_size: int = 16384) -> Optional[HTTPRequest]:
+    '''
+    Read a request head, returns None if the client closed the connection.
+    Raises ValueError on malformed requests.
+    '''
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as err:
+        if not err.partial.strip():
+            return None
+        raise ValueError('Incomplete request')
+    except asyncio.LimitOverrunError:
+        raise ValueError('Request head too long')
+    if len(head) > max_size:
+        raise ValueError('Request head too long')
+    return parse_request(head)
+
+
+def parse_request(head: bytes) -> HTTPRequest:
+    ''' Parse a request head (up to and including the empty line), raises ValueError if malformed '''
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise ValueError(f'Malformed request line: {lines[0]!r}')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        key, sep, val = line.partition(':')
+        if not sep:
+            raise ValueError(f'Malformed header: {line!r}')
+        headers[key.strip()] = val.strip()
+    return HTTPRequest(method, target, version, headers)
+
+
+def build_response(status: int, body: bytes = b'',
+                   content_type: str = 'application/json',
+                   headers: Dict[str, str] = None,
+                   keep_alive: bool = True) -> bytes:
+    head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+    all_headers = {
+        'Content-Type': content_type,
+        'Content-Length': str(len(body)),
+        'Connection': 'keep-alive' if keep_alive else 'close',
+    }
+    all_headers.update(headers or {})
+    for key, val in all_headers.items():
+        head += f'{key}: {val}\r\n'
+    return (head + '\r\n').encode('latin-1') + body
@@ -0,0 +1,98 @@
+from typing import Optional
+from json import dumps
+import asyncio
+import ssl
+
+from interutils import pr, cyan
+
+from proxion.server.http import read_request, build_response
+
+
+class JudgeServer:
+    '''
+    A local proxy judge: answers every request with a JSON echo of the caller's IP and headers,
+    so proxy checks don't depend on (and don't get rate-limited by) a remote service.
+
+    The response is in a form of:
+    {
+        "ip": "1.2.3.4",
+        "port": 54321,
+        "method": "GET",
+        "path": "/",
+        "headers": {"Host": "judge.local:8899", ...}
+    }
+    '''
+
+    request_timeout = 10
+
+    def __init__(self, host: str, port: int, ssl_context: ssl.SSLContext = None,
+                 verbose: bool = False):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.verbose = verbose
+        self.served = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        scheme = 'https' if self.ssl_context else 'http'
+        return f'{scheme}://{self.host}:{self.port}/'
+
+    async def start(self) -> asyncio.AbstractServer:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, ssl=self.ssl_context)
+        # Port 0 means any free port, remember which one we got
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    def run(self) -> None:
+        ''' Serve until interrupted '''
+        async def _serve():
+            async with await self.start():
+                pr(f'Judge listening on {cyan(self.url)}')
+                await self.server.serve_forever()
+        try:
+            asyncio.run(_serve())
+        except KeyboardInterrupt:
+            print()
+            pr(f'Judge stopped after serving {cyan(self.served)} requests', '*')
+
+    def describe(self, request, peer: tuple) -> dict:
+        return {
+            'ip': peer[0],
+            'port': peer[1],
+            'method': request.method,
+            'path': request.target,
+            'headers': request.headers,
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), self.request_timeout)
+                except ValueError:
+                    writer.write(build_response(400, keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                self.served += 1
+                if self.verbose:
+                    pr(f'Judging {cyan(peer[0])}: {request.method} {request.target}', '*')
+                body = dumps(self.describe(request, peer)).encode()
+                writer.write(build_response(200, body, keep_alive=request.keep_alive))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_ssl_context(cert: str, key: str = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
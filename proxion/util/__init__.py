@@ -1,7 +1,26 @@
+from typing import TYPE_CHECKING
+
 from .common import (
     InvalidProxyFormatError,
     is_proxy_format,
     is_ip_address,
+    parse_time_string,
+    parse_proxy,
+    is_proxy_list,
+    lazy_exports,
 )
-from .proxy import Proxy, parse_proxies_file
-from .proxydb import ProxyDB
+from .proxy import Proxy, ProxyListReader, parse_proxies_file
+
+if TYPE_CHECKING:
+    from .proxydb import ProxyDB, ProxyDBCommitter
+    from .geoip import GeoIP
+    from .pool import ProxyPool
+    from .profiler import Profiler
+
+__getattr__ = lazy_exports(__name__, {
+    'ProxyDB': '.proxydb',
+    'ProxyDBCommitter': '.proxydb',
+    'GeoIP': '.geoip',
+    'ProxyPool': '.pool',
+    'Profiler': '.profiler',
+})
@@ -2,6 +2,12 @@ from site import USER_BASE
 from ipaddress import AddressValueError, IPv4Address
 from pathlib import Path
 from random import choice
+from importlib import import_module
+from typing import Callable, Dict, Optional, TextIO
+import gzip
+import io
+import re
+import sys
 
 from termcolor import cprint
 from interutils import clear
@@ -19,24 +25,91 @@ def is_ip_address(ip_addr: str) -> bool:
         return False
 
 
+_octet = r'(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+_proxy_re = re.compile(r'\s*(%s\.%s\.%s\.%s):([0-9]{1,5})\s*' % ((_octet,) * 4))
+
+
+def parse_proxy(line: str) -> Optional[str]:
+    '''
+    Fast (precompiled) validation of a single 'ip:port' line,
+    returns the proxy in a normalized form or None if it's invalid
+    '''
+    match = _proxy_re.fullmatch(line)
+    if match is None:
+        return None
+    port = int(match.group(6))
+    if port > 65535:
+        return None
+    return f'{match.group(1)}:{port}'
+
+
 def is_proxy_format(pip: str) -> bool:
     ''' Check that the given proxy is a string and has a valid address + port '''
 
     if not isinstance(pip, str):
         return False
+    return parse_proxy(pip) is not None
 
-    pts = pip.strip().split(':')
-    if len(pts) != 2:
-        return False
-    ip_addr, port = pts
 
-    try:
-        port = int(port)
-    except ValueError:
-        return False
-    if port < 0 or port > 65535:
-        return False
-    if not is_ip_address(ip_addr):
-        return False
+class _BorrowedTextIOWrapper(io.TextIOWrapper):
+    ''' Text over a binary stream we don't own (the stdin): closing it leaves the stream open '''
+
+    _borrowed = True
+
+    def close(self) -> None:
+        if self._borrowed:
+            self._borrowed = False
+            self.detach()
+
+
+def open_proxy_list(source: str) -> TextIO:
+    '''
+    Open a proxy list for streaming line by line: '-' is the stdin (left open when closed),
+    gzip compressed files are detected by their magic bytes.
+    '''
+    if str(source) == '-':
+        return _BorrowedTextIOWrapper(sys.stdin.buffer, errors='replace')
+
+    raw = Path(source).open('rb')
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        # A GzipFile doesn't close the file object it was given
+        raw.close()
+        raw = gzip.open(source, 'rb')
+    return io.TextIOWrapper(raw, errors='replace')
+
+
+def is_proxy_list(source: str) -> bool:
+    return str(source) == '-' or Path(source).is_file()
+
+
+def parse_time_string(time_str: str) -> int:
+    time_map = {
+        's': 1,
+        'm': 60,
+        'h': 60 * 60,
+        'd': 60 * 60 * 24,
+        'w': 60 * 60 * 24 * 7,
+        'mo': 60 * 60 * 24 * 30,
+        'y': 60 * 60 * 24 * 365,
+    }
+    for frame in time_map:
+        if time_str.endswith(frame):
+            quantity = int(time_str.split(frame)[0])
+            return time_map[frame] * quantity
+    raise ValueError
+
 
-    return True
+def lazy_exports(package: str, exports: Dict[str, str]) -> Callable:
+    '''
+    A package `__getattr__` (PEP 562) importing its `exports` (name -> relative module) on first use,
+    so importing the package doesn't import every one of its modules (and their dependencies)
+    '''
+    def __getattr__(name: str):
+        try:
+            module = exports[name]
+        except KeyError:
+            raise AttributeError(f'module {package!r} has no attribute {name!r}') from None
+        value = getattr(import_module(module, package), name)
+        setattr(sys.modules[package], name, value)
+        return value
+    return __getattr__
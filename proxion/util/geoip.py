@@ -0,0 +1,162 @@
+from array import array
+from bisect import bisect_right
+from csv import reader as csv_reader
+from hashlib import sha1
+from importlib import import_module
+from pathlib import Path
+from socket import inet_aton
+from struct import Struct
+from sys import intern
+from typing import Iterable, Iterator, Optional, TextIO, Tuple
+import gzip
+import mmap
+
+from proxion.config import Config
+
+
+def ip_to_int(ip_addr: str) -> int:
+    return int.from_bytes(inet_aton(ip_addr), 'big')
+
+
+def _parse_ip(value: str) -> int:
+    ''' Range bounds come either dotted (DB-IP) or as integers (IP2Location) '''
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    if value.count('.') != 3:
+        raise ValueError(f'Not an IPv4 address: "{value}"')
+    return ip_to_int(value)
+
+
+def _open_csv(path: Path) -> TextIO:
+    ''' Open a CSV for the csv module, gzip compressed ones are detected by their magic bytes '''
+    with open(path, 'rb') as raw:
+        compressed = raw.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_ranges_csv(path: Path) -> Iterator[Tuple[int, int, str]]:
+    '''
+    Read `start,end,country[,...]` rows out of an IP-range CSV (may be gzip compressed),
+    skipping headers, IPv6 ranges and unknown countries (e.g. "-", "ZZ")
+    '''
+    with _open_csv(path) as stream:
+        for row in csv_reader(stream):
+            if len(row) < 3:
+                continue
+            try:
+                start, end = _parse_ip(row[0]), _parse_ip(row[1])
+            except (ValueError, OSError):
+                continue
+            country = row[2].strip().upper()
+            if len(country) != 2 or not country.isalpha() or country == 'ZZ' or end > 0xffffffff:
+                continue
+            yield start, end, country
+
+
+class GeoIP:
+    '''
+    Offline IPv4 -> country lookups.
+
+    A CSV of IP ranges is compiled once into an index file next to it (`<csv>.idx`),
+    or in the store directory if it can't be written there (e.g. a system-wide GeoIP DB):
+    the sorted range starts, ends and country codes as flat arrays.
+    The index is memory-mapped, so loading is instant, the pages are shared by the checker processes
+    and a lookup is a binary search over the starts.
+
+    MaxMind `.mmdb` files are read with the `maxminddb` package (if installed).
+    '''
+
+    magic = b'PXGEOIP1'
+    header = Struct('=8sI')
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._reader = None
+        if self.path.suffix == '.mmdb':
+            try:
+                maxminddb = import_module('maxminddb')
+            except ImportError:
+                raise ValueError('Reading .mmdb files requires the "maxminddb" package')
+            self._reader = maxminddb.open_database(str(self.path), maxminddb.MODE_MMAP)
+            return
+
+        self._open_index(self.compiled_index(self.path))
+
+    @classmethod
+    def compiled_index(cls, path: Path) -> Path:
+        ''' The up to date index of a CSV, compiled first if there is none '''
+        modified = path.stat().st_mtime
+        candidates = (cls.index_path(path), cls.store_index_path(path))
+        for index in candidates:
+            if index.is_file() and index.stat().st_mtime >= modified:
+                return index
+        for index in candidates:
+            try:
+                index.parent.mkdir(parents=True, exist_ok=True)
+                cls.compile(read_ranges_csv(path), index)
+                return index
+            except OSError as err:
+                error = err
+        raise error
+
+    def _open_index(self, index: Path) -> None:
+        with index.open('rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = self.header.unpack_from(self._map)
+        if magic != self.magic:
+            raise ValueError(f'Not a GeoIP index: "{index}"')
+        view = memoryview(self._map)[self.header.size:]
+        self._starts = view[:count * 4].cast('I')
+        self._ends = view[count * 4:count * 8].cast('I')
+        self._countries = view[count * 8:count * 10]
+        self.count = count
+
+    @staticmethod
+    def index_path(path: Path) -> Path:
+        return path.with_name(path.name + '.idx')
+
+    @staticmethod
+    def store_index_path(path: Path) -> Path:
+        ''' Where the index goes if it can't be next to the CSV, named after the whole CSV path '''
+        digest = sha1(str(path.resolve()).encode()).hexdigest()[:12]
+        return Config.store / 'geoip' / f'{path.name}-{digest}.idx'
+
+    @classmethod
+    def compile(cls, ranges: Iterable[Tuple[int, int, str]], index: Path) -> int:
+        ''' Write the ranges sorted by their start into an index file, returns the count of ranges '''
+        starts, ends, countries = array('I'), array('I'), bytearray()
+        for start, end, country in sorted(ranges):
+            starts.append(start)
+            ends.append(end)
+            countries += country.encode('ascii')
+        tmp = index.with_name(index.name + '.tmp')
+        with tmp.open('wb') as file:
+            file.write(cls.header.pack(cls.magic, len(starts)))
+            starts.tofile(file)
+            ends.tofile(file)
+            file.write(countries)
+        tmp.replace(index)
+        return len(starts)
+
+    def lookup(self, ip_addr: str) -> Optional[str]:
+        ''' The country (2-letter code) of an IPv4 address, None if not in any range '''
+        if self._reader is not None:
+            record = self._reader.get(ip_addr) or {}
+            country = (record.get('country') or record.get('registered_country') or {}).get('iso_code')
+            return intern(country) if country else None
+
+        addr = ip_to_int(ip_addr)
+        i = bisect_right(self._starts, addr) - 1
+        if i < 0 or addr > self._ends[i]:
+            return None
+        return intern(bytes(self._countries[i * 2:i * 2 + 2]).decode('ascii'))
+
+    # Pickled into spawned checker processes by path, the index is mapped again there
+    def __getstate__(self) -> dict:
+        return {'path': self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['path'])
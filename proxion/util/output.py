@@ -0,0 +1,127 @@
+from abc import ABC, abstractmethod
+from typing import TextIO, Dict, Type
+from time import time
+from json import dumps
+import csv
+
+from proxion.util import Proxy
+
+
+class ProxyWriter(ABC):
+    '''
+    Writes proxies into a text stream one by one, as they are read from the DB.
+
+    The stream is flushed after the first proxy and then at most every `flush_interval` seconds,
+    so a consumer reading from a pipe sees results right away without a flush per line.
+    '''
+
+    flush_interval = 0.1
+
+    def __init__(self, stream: TextIO, info: bool = True):
+        self.stream = stream
+        self.info = info
+        self.count = 0
+        self._last_flush = 0
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, *_):
+        self.end()
+        self.stream.flush()
+
+    def begin(self) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+    def write(self, proxy: Proxy) -> None:
+        self.write_proxy(proxy)
+        self.count += 1
+        if time() - self._last_flush > self.flush_interval:
+            self.stream.flush()
+            self._last_flush = time()
+
+    @abstractmethod
+    def write_proxy(self, proxy: Proxy) -> None:
+        raise NotImplementedError
+
+
+class JSONWriter(ProxyWriter):
+    ''' A JSON array, formatted exactly like `json.dumps` of the whole list would be '''
+
+    def __init__(self, stream: TextIO, info: bool = True, inline: bool = False):
+        super().__init__(stream, info)
+        self.inline = inline
+
+    def begin(self) -> None:
+        self.stream.write('[')
+
+    def end(self) -> None:
+        if self.count and not self.inline:
+            self.stream.write('\n')
+        self.stream.write(']\n')
+
+    def write_proxy(self, proxy: Proxy) -> None:
+        item = proxy.serialize() if self.info else proxy.pip
+        if self.inline:
+            self.stream.write((', ' if self.count else '') + dumps(item))
+        else:
+            text = dumps(item, indent=4).replace('\n', '\n    ')
+            self.stream.write((',\n    ' if self.count else '\n    ') + text)
+
+
+class JSONLinesWriter(ProxyWriter):
+    ''' One JSON document per line '''
+
+    def write_proxy(self, proxy: Proxy) -> None:
+        item = proxy.serialize() if self.info else proxy.pip
+        self.stream.write(dumps(item) + '\n')
+
+
+class GrepWriter(ProxyWriter):
+    ''' One proxy per line, followed by its info as `,key:value` pairs '''
+
+    def write_proxy(self, proxy: Proxy) -> None:
+        line = proxy.pip
+        if self.info:
+            for key, val in proxy.serialize()[proxy.pip].items():
+                line += f' ,{key}:{val}'
+        self.stream.write(line + '\n')
+
+
+class CSVWriter(ProxyWriter):
+    '''
+    A CSV table with a header row, protocols are separated by a space,
+    the history is summarized by the EWMA latency and the reliability score
+    '''
+
+    def __init__(self, stream: TextIO, info: bool = True):
+        super().__init__(stream, info)
+        self.writer = csv.writer(stream)
+
+    def begin(self) -> None:
+        self.writer.writerow(['pip', 'protos', 'last_check', 'last_lat', 'exit_country',
+                              'ewma_lat', 'reliability'] if self.info else ['pip'])
+
+    def write_proxy(self, proxy: Proxy) -> None:
+        if not self.info:
+            self.writer.writerow([proxy.pip])
+            return
+        info = proxy.serialize()[proxy.pip]
+        history = info.get('history', {})
+        self.writer.writerow([proxy.pip, ' '.join(sorted(info['protos']))] +
+                             ['' if info[key] is None else info[key]
+                              for key in ('last_check', 'last_lat', 'exit_country')] +
+                             ['' if history.get(key) is None else history[key]
+                              for key in ('ewma_lat', 'reliability')])
+
+
+writers: Dict[str, Type[ProxyWriter]] = {
+    'json': JSONWriter,
+    'jsonl': JSONLinesWriter,
+    'grep': GrepWriter,
+    'csv': CSVWriter,
+}
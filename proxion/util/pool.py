@@ -0,0 +1,174 @@
+from bisect import bisect_left, bisect_right
+from random import randrange
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from proxion.util.proxy import Proxy, protos_to_mask
+from proxion.util.proxydb import ProxyDB
+
+
+def sample_indices(total: int) -> Iterator[int]:
+    '''
+    Yield the indices of `range(total)` in a random order, each one in O(1)
+    (a Fisher-Yates shuffle of a virtual list, only the swapped slots are stored)
+    '''
+    swaps: Dict[int, int] = {}
+    for i in range(total):
+        j = randrange(i, total)
+        yield swaps.get(j, j)
+        swaps[j] = swaps.get(i, i)
+
+
+class _Bucket:
+    ''' Proxies in a list for O(1) random access, removal swaps the last one into the gap '''
+    __slots__ = ('items', 'pos')
+
+    def __init__(self):
+        self.items: List[Proxy] = []
+        self.pos: Dict[str, int] = {}
+
+    def add(self, pip: str, proxy: Proxy) -> None:
+        self.pos[pip] = len(self.items)
+        self.items.append(proxy)
+
+    def remove(self, pip: str) -> None:
+        i = self.pos.pop(pip)
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.pos[last.pip] = i
+
+
+class ProxyPool:
+    '''
+    A long-lived in-memory view of the ProxyDB for services picking proxies at high rates.
+
+    The proxies are indexed by their exit country, protocols (the exact combination)
+    and latency bucket (`latency_buckets` upper bounds, then slower, then never measured),
+    so `random` only visits the few buckets matching a query and draws from them directly,
+    without a pass over the whole DB.
+
+    Unless given the `proxies` to hold, the pool loads the ProxyDB and follows its
+    `update_one`/`remove_one` (and friends) calls, updating the indexes incrementally.
+    The index keys of every proxy are remembered as it's added, so a proxy changed by its owner
+    since then is still found (and moved) when it's put again.
+    '''
+
+    latency_buckets = (0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+    def __init__(self, proxies: Iterable[Proxy] = None):
+        self._watching = proxies is None
+        self.reload(proxies)
+        if self._watching:
+            ProxyDB.watch(self)
+
+    def close(self) -> None:
+        ''' Stop following the ProxyDB '''
+        if self._watching:
+            ProxyDB.unwatch(self)
+            self._watching = False
+
+    def reload(self, proxies: Iterable[Proxy] = None) -> None:
+        ''' Rebuild the indexes from `proxies` (default: the whole ProxyDB) '''
+        self._proxies: Dict[str, Proxy] = {}
+        # pip -> the index keys the proxy was added under
+        self._keys_of: Dict[str, List[Tuple[Optional[str], Tuple[int, int]]]] = {}
+        # country (None for all of them) -> (protocols mask, latency bucket) -> proxies
+        self._index: Dict[Optional[str], Dict[Tuple[int, int], _Bucket]] = {None: {}}
+        for proxy in ProxyDB.storage.iterate() if proxies is None else proxies:
+            self.on_update(proxy)
+
+    def __len__(self) -> int:
+        return len(self._proxies)
+
+    def __contains__(self, pip: str) -> bool:
+        return pip in self._proxies
+
+    def get(self, pip: str) -> Proxy:
+        return self._proxies[pip]
+
+    def latency_bucket(self, latency: Optional[float]) -> int:
+        if latency is None:
+            return len(self.latency_buckets) + 1
+        return bisect_left(self.latency_buckets, latency)
+
+    def _keys(self, proxy: Proxy) -> Iterator[Tuple[Optional[str], Tuple[int, int]]]:
+        key = (proxy.proto_mask, self.latency_bucket(proxy.last_lat))
+        yield None, key
+        if proxy.exit_country:
+            yield proxy.exit_country.upper(), key
+
+    def on_update(self, proxy: Proxy) -> None:
+        ''' Add the proxy, replacing the one with the same address '''
+        pip = proxy.pip
+        if pip in self._proxies:
+            self.on_remove(pip)
+        self._proxies[pip] = proxy
+        keys = self._keys_of[pip] = list(self._keys(proxy))
+        for country, key in keys:
+            buckets = self._index.setdefault(country, {})
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _Bucket()
+            bucket.add(pip, proxy)
+
+    def on_remove(self, pip: str) -> None:
+        if self._proxies.pop(pip, None) is None:
+            return
+        for country, key in self._keys_of.pop(pip):
+            buckets = self._index[country]
+            bucket = buckets[key]
+            bucket.remove(pip)
+            if not bucket.items:
+                del buckets[key]
+
+    def random(self, n: int = 1, protos: Iterable[str] = None,
+               country: str = None, max_latency: float = None) -> List[Proxy]:
+        '''
+        Up to `n` distinct random proxies (all of the matching ones for 0),
+        working with any of `protos`, exiting in `country` and not slower than `max_latency`
+        (which leaves out the never measured ones).
+        '''
+        buckets = self._index.get(country.upper() if country else None)
+        if not buckets:
+            return []
+        mask = protos_to_mask(protos) if protos else 0
+
+        matching: List[List[Proxy]] = []
+        partial: List[List[Proxy]] = []
+        for (proto_mask, lat_bucket), bucket in buckets.items():
+            if mask and not proto_mask & mask:
+                continue
+            if max_latency is not None:
+                if lat_bucket > len(self.latency_buckets):
+                    continue
+                lower = self.latency_buckets[lat_bucket - 1] if lat_bucket else 0
+                upper = self.latency_buckets[lat_bucket] if lat_bucket < len(self.latency_buckets) \
+                    else float('inf')
+                if lower >= max_latency:
+                    continue
+                if upper > max_latency:
+                    # Only some of this bucket is fast enough, keep it last and check every proxy
+                    partial.append(bucket.items)
+                    continue
+            matching.append(bucket.items)
+        checked = len(matching)
+        matching += partial
+
+        # Draw from the matching buckets as if they were a single list
+        offsets = []
+        total = 0
+        for items in matching:
+            offsets.append(total)
+            total += len(items)
+        checked_from = offsets[checked] if partial else total
+
+        picked = []
+        for i in sample_indices(total):
+            if n and len(picked) >= n:
+                break
+            b = bisect_right(offsets, i) - 1
+            proxy = matching[b][i - offsets[b]]
+            if i >= checked_from and proxy.last_lat > max_latency:
+                continue
+            picked.append(proxy)
+        return picked
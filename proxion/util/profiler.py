@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+from pathlib import Path
+from threading import get_ident
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Dict, List, Optional
+import os
+
+from interutils import pr, cyan
+
+if TYPE_CHECKING:
+    from cProfile import Profile
+
+
+class Profiler:
+    '''
+    The `--profile` mode: profiles a whole command with cProfile and times its phases.
+
+    Code marks its phases (loading the DB, building the job list, checking, saving ...)
+    with `Profiler.phase(name)`, phases may nest and every one is charged only the time
+    not spent in the nested ones, whatever is left is reported as "other".
+    Code running in threads or worker processes of its own wraps them with `Profiler.profiled(name)`,
+    their profiles (the worker processes dump theirs into a temporary directory) are merged at `stop`.
+
+    `stop` writes the merged profile to the output file (pstats format, for snakeviz, gprof2dot,
+    `python -m pstats` ...) and the phases and workers as a Chrome trace next to it
+    (`<output>.trace.json`, for Perfetto or chrome://tracing).
+
+    All of it is a no-op unless `start` was called (the profiling modules are only imported then).
+    '''
+
+    enabled = False
+    output: Path = None
+    totals: Dict[str, float] = {}
+    _profile: 'Profile' = None
+    _profiles: List['Profile'] = []
+    _spans: List[dict] = []
+    _stack: list = []
+    _pid = 0
+    _tid = 0
+    _started = 0.0
+    _worker_dir: Path = None
+
+    @classmethod
+    def start(cls, output: Path) -> None:
+        from cProfile import Profile
+        from tempfile import mkdtemp
+
+        cls.enabled = True
+        cls.output = Path(output)
+        cls.totals = {}
+        cls._profiles = []
+        cls._spans = []
+        cls._stack = []
+        cls._pid = os.getpid()
+        cls._tid = get_ident()
+        cls._worker_dir = Path(mkdtemp(prefix='proxion-profile-'))
+        cls._started = perf_counter()
+        cls._profile = Profile()
+        cls._profile.enable()
+
+    @classmethod
+    def _span(cls, name: str, started: float, ended: float, tid: int = 0) -> dict:
+        ''' A Chrome trace event (in microseconds since the start) '''
+        return {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': (started - cls._started) * 1e6, 'dur': (ended - started) * 1e6}
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name: str):
+        ''' Time a phase of the command (only the main thread's phases count) '''
+        if not cls.enabled or get_ident() != cls._tid or os.getpid() != cls._pid or \
+                (cls._stack and cls._stack[-1][0] == name):
+            yield
+            return
+
+        started = perf_counter()
+        if cls._stack:
+            # Pause the phase we are nested in
+            outer, outer_started = cls._stack[-1]
+            cls.totals[outer] = cls.totals.get(outer, 0) + started - outer_started
+        cls._stack.append([name, started])
+        try:
+            yield
+        finally:
+            ended = perf_counter()
+            _, resumed = cls._stack.pop()
+            cls.totals[name] = cls.totals.get(name, 0) + ended - resumed
+            if cls._stack:
+                cls._stack[-1][1] = ended
+            cls._spans.append(cls._span(name, started, ended))
+
+    @classmethod
+    @contextmanager
+    def profiled(cls, name: str):
+        ''' Profile a thread or a (forked) worker process, the main profile doesn't see them '''
+        if not cls.enabled:
+            yield
+            return
+        from cProfile import Profile
+        from json import dumps
+
+        in_child = os.getpid() != cls._pid
+        if in_child:
+            # Forked while the parent was profiling, leave that to the parent
+            cls._profile.disable()
+        profile = Profile()
+        started = perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            span = cls._span(name, started, perf_counter(), get_ident() if not in_child else 0)
+            if in_child:
+                prefix = cls._worker_dir / f'{name}-{os.getpid()}'
+                profile.dump_stats(str(prefix) + '.prof')
+                Path(str(prefix) + '.json').write_text(dumps(span))
+            else:
+                cls._profiles.append(profile)
+                cls._spans.append(span)
+
+    @classmethod
+    def stop(cls) -> Optional[Path]:
+        ''' Merge the profiles, write them and the trace, and show the phases '''
+        if not cls.enabled:
+            return None
+        from json import dumps, loads
+        import pstats
+        import shutil
+
+        cls._profile.disable()
+        cls.enabled = False
+        elapsed = perf_counter() - cls._started
+
+        stats = pstats.Stats(cls._profile)
+        for profile in cls._profiles:
+            stats.add(profile)
+        spans = list(cls._spans)
+        for prof_file in sorted(cls._worker_dir.glob('*.prof')):
+            stats.add(str(prof_file))
+            spans.append(loads(prof_file.with_suffix('.json').read_text()))
+        workers = len(list(cls._worker_dir.glob('*.prof')))
+        shutil.rmtree(cls._worker_dir, ignore_errors=True)
+        stats.dump_stats(str(cls.output))
+
+        spans.append(cls._span('total', cls._started, cls._started + elapsed))
+        trace_file = cls.output.with_name(cls.output.name + '.trace.json')
+        trace_file.write_text(dumps({
+            'traceEvents': spans, 'displayTimeUnit': 'ms',
+            'otherData': {'started': time() - elapsed, 'phases': cls.totals}}))
+
+        pr(f'Profiled {cyan("%.3f" % elapsed)} sec' + (f' and {cyan(workers)} workers' if workers else ''))
+        other = elapsed - sum(cls.totals.values())
+        for name, seconds in sorted({**cls.totals, 'other': other}.items(), key=lambda i: -i[1]):
+            pr(f'  {name:<12} {cyan("%8.3f" % seconds)} sec {seconds * 100 / elapsed:5.1f}%')
+        pr(f'Profile saved to {cyan(str(cls.output))} (trace: {cyan(str(trace_file))})')
+        return cls.output
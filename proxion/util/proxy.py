@@ -1,10 +1,13 @@
 from time import time
 from pathlib import Path
-from typing import Set
+from typing import Iterable, Iterator, List, Set, Dict, FrozenSet, Optional, Tuple
+from socket import inet_aton, inet_ntoa
+from struct import pack, unpack
+from sys import intern
 
-from interutils import pr
+from interutils import pr, cyan
 
-from .common import is_proxy_format, InvalidProxyFormatError
+from .common import is_proxy_format, InvalidProxyFormatError, parse_proxy, open_proxy_list
 
 
 def assure_proxy_format(pip: str) -> None:
@@ -13,58 +16,280 @@ def assure_proxy_format(pip: str) -> None:
             f'Invalid proxy supplied: ProxyIP={pip}')
 
 
+PROTOCOLS = ('socks5', 'socks4', 'https', 'http')
+_proto_bits = {proto: 1 << i for i, proto in enumerate(PROTOCOLS)}
+_masks: Dict[str, int] = {}
+
+
+def protos_to_mask(protos: Iterable[str]) -> int:
+    mask = 0
+    for proto in protos:
+        try:
+            mask |= _proto_bits[proto]
+        except KeyError:
+            raise ValueError(f'Unknown protocol: "{proto}"')
+    return mask
+
+
+_mask_protos = tuple(frozenset(proto for proto in PROTOCOLS if mask & _proto_bits[proto])
+                     for mask in range(1 << len(PROTOCOLS)))
+
+
+def mask_to_protos(mask: int) -> FrozenSet[str]:
+    return _mask_protos[mask]
+
+
+def joined_protos_to_mask(protos: str) -> int:
+    ''' Convert comma separated protocols (as stored in a DB) into a mask, caching every combination '''
+    try:
+        return _masks[protos]
+    except KeyError:
+        mask = _masks[protos] = protos_to_mask(protos.split(',')) if protos else 0
+        return mask
+
+
+def pack_pip(pip: str) -> int:
+    ''' Pack a well formed 'ip:port' into a single int: (IPv4 << 16) | port '''
+    ip_addr, port = pip.split(':')
+    return int.from_bytes(inet_aton(ip_addr), 'big') << 16 | int(port)
+
+
+def unpack_pip(addr: int) -> str:
+    return f'{inet_ntoa((addr >> 16).to_bytes(4, "big"))}:{addr & 0xffff}'
+
+
 class Proxy:
     '''
     A definition of a proxy with info.
+
+    Stored compactly, as DBs hold millions of these:
+    no per-instance __dict__, the address and port packed into a single int,
+    the protocols as a bitmask (of `PROTOCOLS`) and the country as an interned string
+    (so all the proxies of a country share it).
+
+    The history of the last `history_size` check rounds is kept as ring buffers:
+    the outcomes as bits of an int (bit 0 is the latest, the count above them)
+    and the latencies of the successful ones as little-endian uint16 milliseconds (latest first),
+    along with an EWMA of the latency.
     '''
-    pip: str
-    protos: Set[str]
-    last_check: int
-    last_lat: int
-    exit_country: str
+    __slots__ = ('_addr', '_protos', 'last_check', 'last_lat', '_country',
+                 '_outcomes', '_latencies', 'ewma_lat')
+
+    history_size = 16
+    ewma_alpha = 0.3
+
+    last_check: float
+    last_lat: float
+    ewma_lat: Optional[float]
 
     def __init__(self, pip: str,
                  protos: Set[str] = None,
                  last_check: int = None,
                  last_lat: int = None,
                  exit_country: str = None):
-        assure_proxy_format(pip)
-        self.pip = pip
-        if protos:
-            self.protos = set(protos)
-        else:
-            self.protos = set()
+        normalized = parse_proxy(pip) if isinstance(pip, str) else None
+        if normalized is None:
+            raise InvalidProxyFormatError(
+                f'Invalid proxy supplied: ProxyIP={pip}')
+        self._addr = pack_pip(normalized)
+        self._protos = protos_to_mask(protos) if protos else 0
         self.last_check = last_check
         self.last_lat = last_lat
         self.exit_country = exit_country
+        self._outcomes = 0
+        self._latencies = b''
+        self.ewma_lat = None
+
+    @classmethod
+    def trusted(cls, pip: str,
+                proto_mask: int = 0,
+                last_check: float = None,
+                last_lat: float = None,
+                exit_country: str = None,
+                outcomes: int = 0,
+                latencies: bytes = None,
+                ewma_lat: float = None):
+        '''
+        Fast-path constructor for data we already validated (e.g. loaded from the DB),
+        skips the address validation
+        '''
+        proxy = cls.__new__(cls)
+        proxy._addr = pack_pip(pip)
+        proxy._protos = proto_mask
+        proxy.last_check = last_check
+        proxy.last_lat = last_lat
+        proxy._country = intern(exit_country) if exit_country else exit_country
+        proxy._outcomes = outcomes
+        proxy._latencies = latencies or b''
+        proxy.ewma_lat = ewma_lat
+        return proxy
+
+    @property
+    def pip(self) -> str:
+        return unpack_pip(self._addr)
+
+    @property
+    def ip(self) -> str:
+        return inet_ntoa((self._addr >> 16).to_bytes(4, 'big'))
+
+    @property
+    def port(self) -> int:
+        return self._addr & 0xffff
+
+    @property
+    def protos(self) -> FrozenSet[str]:
+        return mask_to_protos(self._protos)
+
+    @protos.setter
+    def protos(self, protos: Iterable[str]) -> None:
+        self._protos = protos_to_mask(protos) if protos else 0
+
+    @property
+    def proto_mask(self) -> int:
+        return self._protos
+
+    @property
+    def exit_country(self) -> str:
+        return self._country
+
+    @exit_country.setter
+    def exit_country(self, country: str) -> None:
+        self._country = intern(country) if country else country
+
+    @property
+    def outcomes(self) -> int:
+        ''' The packed outcomes ring buffer (as stored) '''
+        return self._outcomes
+
+    @property
+    def packed_latencies(self) -> bytes:
+        ''' The packed latencies ring buffer (as stored) '''
+        return self._latencies
+
+    @property
+    def checks(self) -> int:
+        ''' How many check rounds the history holds '''
+        return self._outcomes >> self.history_size
+
+    @property
+    def successes(self) -> int:
+        return bin(self._outcomes & ((1 << self.history_size) - 1)).count('1')
+
+    @property
+    def history(self) -> Tuple[bool]:
+        ''' The outcomes of the recent check rounds, latest first '''
+        return tuple(bool(self._outcomes >> i & 1) for i in range(self.checks))
+
+    @property
+    def latencies(self) -> Tuple[float]:
+        ''' The latencies of the recent successful check rounds, latest first '''
+        return tuple(ms / 1000 for ms in unpack(f'<{len(self._latencies) // 2}H', self._latencies))
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        checks = self.checks
+        return self.successes / checks if checks else None
+
+    @property
+    def reliability(self) -> float:
+        '''
+        The success rate smoothed towards 1/2 for short histories (Laplace's rule of succession),
+        so a proxy that worked 15 out of 16 times ranks above one that worked once out of once
+        '''
+        return (self.successes + 1) / (self.checks + 2)
+
+    @classmethod
+    def pack_history(cls, history: Iterable[bool], latencies: Iterable[float]) -> Tuple[int, bytes]:
+        ''' Pack outcomes and latencies (latest first) into the ring buffers '''
+        history = list(history)[:cls.history_size]
+        bits = 0
+        for i, success in enumerate(history):
+            bits |= bool(success) << i
+        packed = b''.join(pack('<H', min(int(lat * 1000 + 0.5), 0xffff)) for lat in latencies)
+        return len(history) << cls.history_size | bits, packed[:cls.history_size * 2]
+
+    def record(self, success: bool, latency: float = None) -> None:
+        ''' Push the outcome (and latency if successful) of a check round into the history '''
+        size = self.history_size
+        checks = min(self.checks + 1, size)
+        bits = ((self._outcomes << 1) | bool(success)) & ((1 << size) - 1)
+        self._outcomes = checks << size | bits
+        if success and latency is not None:
+            self._latencies = (self.pack_history((), (latency,))[1] + self._latencies)[:size * 2]
+            self.ewma_lat = latency if self.ewma_lat is None else \
+                self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.ewma_lat
 
     def serialize(self) -> dict:
-        return {
-            self.pip: {
-                'protos': list(self.protos),
-                'last_check': self.last_check,
-                'last_lat': self.last_lat,
-                'exit_country': self.exit_country,
-            }
+        info = {
+            'protos': [proto for proto in PROTOCOLS if self._protos & _proto_bits[proto]],
+            'last_check': self.last_check,
+            'last_lat': self.last_lat,
+            'exit_country': self._country,
         }
+        if self._outcomes:
+            info['history'] = {
+                'outcomes': ''.join('1' if ok else '0' for ok in self.history),
+                'latencies': list(self.latencies),
+                'ewma_lat': self.ewma_lat,
+                'reliability': self.reliability,
+            }
+        return {self.pip: info}
 
     def get_check_delta(self) -> int:
         return time() - self.last_check
 
     def update(self, other):
-        if self.pip != other.pip:
+        if self._addr != other._addr:
             raise ValueError('Can not update proxy with a different proxy IP!')
-        self.protos.update(other.protos)
+        self._protos |= other._protos
         self.last_check = other.last_check
         self.last_lat = other.last_lat
-        self.exit_country = other.exit_country
+        self._country = other._country
+
+
+class ProxyListReader:
+    '''
+    Streams the valid, unique proxies out of one or more proxy lists (see `open_proxy_list`),
+    counting the invalid lines instead of complaining about each one.
+    '''
+
+    def __init__(self, sources: Iterable[str]):
+        self.sources = sources
+        self.rejected = 0
+        self.duplicates = 0
+        self._seen: Set[str] = set()
+
+    def __iter__(self) -> Iterator[str]:
+        for source in self.sources:
+            with open_proxy_list(source) as stream:
+                for line in stream:
+                    pip = parse_proxy(line)
+                    if pip is None:
+                        if line.strip():
+                            self.rejected += 1
+                    elif pip in self._seen:
+                        self.duplicates += 1
+                    else:
+                        self._seen.add(pip)
+                        yield pip
+
+    def batches(self, size: int) -> Iterator[List[str]]:
+        batch = []
+        for pip in self:
+            batch.append(pip)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def report(self, source: str) -> None:
+        if self.rejected:
+            pr(f'Skipped {cyan(self.rejected)} invalid lines in: {cyan(str(source))}', '!')
 
 
 def parse_proxies_file(path: Path) -> list:
-    buff = []
-    for line in path.read_text().splitlines():
-        try:
-            buff.append(Proxy(line))
-        except InvalidProxyFormatError:
-            pr(f'Invalid proxy line: {line} in file: {str(path)}', '!')
+    reader = ProxyListReader([path])
+    buff = [Proxy(pip) for pip in reader]
+    reader.report(path)
     return buff
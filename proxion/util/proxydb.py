@@ -1,48 +1,83 @@
-from typing import Iterable, List
+from typing import Iterable, Iterator, List, Dict, Optional, Set, Tuple
 from random import shuffle
+from time import time
 from pathlib import Path
 from threading import Lock
 
-from interutils import DictConfig
+from interutils import pr, cyan
 
-from proxion.util import Proxy
+from proxion.util import Proxy, ProxyListReader
+from proxion.util.profiler import Profiler
+from proxion.util.storage import (
+    Query,
+    Storage,
+    JSONStorage,
+    get_storage_backend,
+    migrate,
+    deserialize,
+)
+from proxion.config import Defaults
 
 
 class ProxyDB:
     '''
     This is a low level db interface, expect exceptions to rise
 
-    The ProxyDB is in a form of:
-    {
-        '0.0.0.0:00000': {
-            'type': 'https',
-            'last_check': None,
-            'latency': 90,
-        },
-        '1.2.3.4:54321': {
-            'type': 'socks',
-            'last_check': time.time(),
-            'latency': 320,
-        }
-    }
+    The proxies are kept by a storage backend (see `proxion.util.storage`),
+    picked by the DB file's extension: `.json` files are handled by the original
+    whole-file JSON storage and anything else by the indexed SQLite storage.
+
+    When a new SQLite DB is created next to a legacy JSON DB, the proxies are migrated from it.
     '''
 
+    storage: Storage = None
+    # Followers of the changes (e.g. a ProxyPool), see `watch`
+    listeners: list = []
+
     @classmethod
     def __init__(cls, db_file_path: Path):
+        db_file_path = Path(db_file_path)
+        # An unknown format must not cost us the DB already open
+        backend = get_storage_backend(db_file_path)
         lock = Lock()
         lock.acquire()
-        cls.dict_config = DictConfig(db_file_path, {}, quiet=True)
+        if cls.storage is not None:
+            cls.storage.close()
+        is_new = not db_file_path.exists()
+        cls.storage = backend(db_file_path)
         lock.release()
         cls._l = lock
 
+        legacy = db_file_path.with_name(Defaults.legacy_db_file)
+        if is_new and backend is not JSONStorage and legacy.is_file():
+            count = migrate(JSONStorage(legacy), cls.storage)
+            pr(f'Migrated {cyan(count)} proxies from {cyan(str(legacy))}', '*')
+        for listener in cls.listeners:
+            listener.reload()
+
+    @classmethod
+    def watch(cls, listener) -> None:
+        '''
+        Let `listener` follow the changes: its `on_update(proxy)` / `on_remove(pip)` are called
+        for every proxy put into / removed from the DB and `reload()` when another DB is opened
+        '''
+        cls.listeners.append(listener)
+
+    @classmethod
+    def unwatch(cls, listener) -> None:
+        cls.listeners.remove(listener)
+
     @classmethod
     def update_one(cls, proxy: Proxy, save: bool = True) -> int:
         if not proxy:
             return
 
-        cls.dict_config.update(proxy.serialize())
-        if save:
-            cls._save_state()
+        with Profiler.phase('save'):
+            cls.storage.put(proxy)
+            for listener in cls.listeners:
+                listener.on_update(proxy)
+            if save:
+                cls._save_state()
         return 1
 
     @classmethod
@@ -50,11 +85,14 @@ class ProxyDB:
         if not proxies:
             return
 
-        count = 0
-        for proxy in proxies:
-            count += cls.update_one(proxy, save=False)
-
-        cls._save_state()
+        if cls.listeners:
+            proxies = list(proxies)
+        with Profiler.phase('save'):
+            count = cls.storage.put_many(proxies)
+            for listener in cls.listeners:
+                for proxy in proxies:
+                    listener.on_update(proxy)
+            cls._save_state()
         return count
 
     @classmethod
@@ -62,9 +100,12 @@ class ProxyDB:
         if not proxy:
             return
 
-        cls.dict_config.pop(proxy.pip)
-        if save:
-            cls._save_state()
+        with Profiler.phase('save'):
+            cls.storage.delete(proxy.pip)
+            for listener in cls.listeners:
+                listener.on_remove(proxy.pip)
+            if save:
+                cls._save_state()
         return 1
 
     @classmethod
@@ -73,54 +114,185 @@ class ProxyDB:
             return
 
         count = 0
-        for proxy in proxies:
-            count += cls.remove_one(proxy, save=False)
+        with Profiler.phase('save'):
+            for proxy in proxies:
+                count += cls.remove_one(proxy, save=False)
+
+            cls._save_state()
+        return count
+
+    @classmethod
+    def ingest(cls, reader: ProxyListReader, remove: bool = False,
+               batch_size: int = Defaults.ingest_batch_size) -> int:
+        '''
+        Add (or remove) the proxies streamed by the reader batch by batch.
+        Proxies already in the DB are not added again, so their stats are kept.
 
-        cls._save_state()
+        returns -> int: Count of proxies added/removed
+        '''
+        count = 0
+        batches = reader.batches(batch_size)
+        while True:
+            with Profiler.phase('read list'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            known = cls.known(batch)
+            if remove:
+                count += cls.remove_some([Proxy(pip) for pip in batch if pip in known]) or 0
+            else:
+                count += cls.update_some([Proxy(pip) for pip in batch if pip not in known]) or 0
         return count
 
     @classmethod
     def _save_state(cls):
         cls._l.acquire()
-        cls.dict_config.save()
+        cls.storage.commit()
         cls._l.release()
 
     @classmethod
     def is_in(cls, pip: str) -> bool:
-        return pip in cls.dict_config
+        return cls.storage.contains(pip)
+
+    @classmethod
+    def known(cls, pips: Iterable[str]) -> Set[str]:
+        ''' Get which of the given proxies are already in the DB '''
+        return cls.storage.contains_many(pips)
 
     @classmethod
     def get_proxy(cls, pip: str) -> Proxy:
-        return deserialize(pip, cls.dict_config[pip])
+        return cls.storage.get(pip)
 
     @classmethod
     def get_proxy_dict(cls):
-        return dict(cls.dict_config)
+        dic = {}
+        for proxy in cls.storage.iterate():
+            dic.update(proxy.serialize())
+        return dic
 
     @classmethod
     def get_proxies(cls, do_shuffle: bool = True) -> List[Proxy]:
         '''
         Get proxies from DB in deserialized form (Proxy struct)
         '''
-        temp = cls.get_proxy_dict()
+        lst = list(cls.storage.iterate())
         if do_shuffle:
-            try:
-                shuffle(temp)
-            except KeyError:
-                pass
-        lst = []
-        for key, val in temp.items():
-            lst.append(deserialize(key, val))
+            shuffle(lst)
         return lst
 
+    @classmethod
+    def query(cls, protos: Iterable[str] = None,
+              countries: Iterable[str] = None,
+              max_latency: float = None,
+              min_latency: float = None,
+              fresh: int = None,
+              stale: int = None,
+              strict: bool = True,
+              order: str = None,
+              limit: int = 0,
+              min_reliability: float = None) -> Iterator[Proxy]:
+        '''
+        Lazily get the proxies matching the given filters,
+        the storage backend evaluates them (in the index where possible).
+
+        fresh -> Only proxies checked in the last `fresh` seconds
+        stale -> Only proxies not checked in the last `stale` seconds
+        strict -> Filter out proxies missing a filtered value (instead of letting them pass)
+        order -> One of `Query.orders` (default: storage order)
+        limit -> Stop after that many proxies (default: all)
+        min_reliability -> Only proxies with at least that reliability score (see `Proxy.reliability`)
+        '''
+        return cls.storage.query(Query(protos, countries, max_latency, min_latency,
+                                       fresh, stale, strict, order, limit, min_reliability))
+
+    @classmethod
+    def port_protocols(cls) -> Dict[int, Dict[str, int]]:
+        ''' How many known proxies work with every protocol, per port (e.g. {1080: {'socks5': 120}}) '''
+        return cls.storage.port_protocols()
+
+
+class ProxyDBCommitter:
+    '''
+    Collects check results and commits them to the ProxyDB in batches,
+    once `batch_size` proxies are pending or `interval` seconds have passed since the last commit.
+
+    Working proxies are merged into their DB entry (or added if missing),
+    failed checks only refresh `last_check` of proxies which are already in the DB.
+    Either way the round (all the pending checks of a proxy) is recorded into its history,
+    unless its rounds were queued with `add_round`: then each of them is recorded on its own.
+    '''
+
+    def __init__(self, batch_size: int = Defaults.commit_batch_size,
+                 interval: int = Defaults.commit_interval):
+        if batch_size < 1:
+            raise ValueError(f'Invalid commit batch size: {batch_size}')
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending: Dict[str, Proxy] = {}
+        # pip -> (success, latency) of every round queued with `add_round`
+        self.rounds: Dict[str, List[Tuple[bool, Optional[float]]]] = {}
+        self.committed = 0
+        self._last_commit = time()
+
+    def add(self, pip: str, result: Optional[Proxy], checked_at: float) -> None:
+        '''
+        Queue a single check result (`result` is None when the check failed)
+        '''
+        self._merge(pip, result, checked_at)
+        self.maybe_commit()
+
+    def add_round(self, pip: str, results: List[Proxy], checked_at: float) -> None:
+        '''
+        Queue a whole round of checks of a proxy (`results` of its working protocols, if any),
+        so that a proxy checked a few times before a commit gets every round recorded
+        '''
+        for result in results or [None]:
+            self._merge(pip, result, checked_at)
+        self.rounds.setdefault(pip, []).append((bool(results), results[-1].last_lat if results else None))
+        self.maybe_commit()
+
+    def _merge(self, pip: str, result: Optional[Proxy], checked_at: float) -> None:
+        pending = self.pending.get(pip)
+        if result is not None:
+            if pending is None:
+                self.pending[pip] = result
+            else:
+                pending.update(result)
+        elif pending is None:
+            self.pending[pip] = Proxy(pip, last_check=checked_at)
+        else:
+            pending.last_check = max(pending.last_check or 0, checked_at)
+
+    def maybe_commit(self) -> int:
+        if len(self.pending) >= self.batch_size or time() - self._last_commit >= self.interval:
+            return self.commit()
+        return 0
+
+    def commit(self) -> int:
+        ''' Write all the pending results into the DB '''
+        self._last_commit = time()
+        if not self.pending:
+            return 0
 
-def deserialize(pip: str, info: dict) -> Proxy:
-    proxy = Proxy(pip)
-    for key, val in info.items():
-        if key == 'protos':
-            if val:
-                val = set(val)
+        batch = []
+        for pip, result in self.pending.items():
+            rounds = self.rounds.get(pip) or [(bool(result.protos), result.last_lat)]
+            if ProxyDB.is_in(pip):
+                proxy = ProxyDB.get_proxy(pip)
+                if result.protos:
+                    proxy.update(result)
+                else:
+                    proxy.last_check = result.last_check
+            elif result.protos:
+                proxy = result
             else:
-                val = set()
-        proxy.__setattr__(key, val)
-    return proxy
+                continue
+            for success, latency in rounds:
+                proxy.record(success, latency)
+            batch.append(proxy)
+        self.pending = {}
+        self.rounds = {}
+
+        if batch:
+            self.committed += ProxyDB.update_some(batch)
+        return len(batch)
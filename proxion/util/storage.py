@@ -0,0 +1,530 @@
+from abc import ABC, abstractmethod
+from typing import Iterator, Iterable, Type, Optional, Set, List, Dict
+from pathlib import Path
+from random import random, shuffle
+from heapq import nsmallest, heappush, heapreplace
+from time import time
+import sqlite3
+
+from interutils import DictConfig
+
+from proxion.util import Proxy
+from proxion.util.proxy import protos_to_mask, joined_protos_to_mask
+
+
+class Query:
+    '''
+    Filters, ordering and limit of a ProxyDB query.
+
+    Without `strict`, proxies missing the value a filter looks at (e.g. never checked) pass that filter.
+    '''
+
+    orders = ('random', 'latency', 'last_check', 'reliability')
+
+    protos: Optional[Set[str]]
+    proto_mask: int
+    countries: Optional[Set[str]]
+    max_latency: Optional[float]
+    min_latency: Optional[float]
+    fresh: Optional[int]
+    stale: Optional[int]
+    min_reliability: Optional[float]
+    strict: bool
+    order: Optional[str]
+    limit: int
+
+    def __init__(self, protos: Iterable[str] = None,
+                 countries: Iterable[str] = None,
+                 max_latency: float = None,
+                 min_latency: float = None,
+                 fresh: int = None,
+                 stale: int = None,
+                 strict: bool = True,
+                 order: str = None,
+                 limit: int = 0,
+                 min_reliability: float = None):
+        if order is not None and order not in self.orders:
+            raise ValueError(f'Invalid query order: "{order}"')
+        if isinstance(countries, str):
+            countries = (countries,)
+
+        self.protos = set(protos) if protos else None
+        self.proto_mask = protos_to_mask(self.protos) if protos else 0
+        self.countries = {c.upper() for c in countries} if countries else None
+        self.max_latency = max_latency
+        self.min_latency = min_latency
+        self.fresh = fresh
+        self.stale = stale
+        self.min_reliability = min_reliability
+        self.strict = strict
+        self.order = order
+        self.limit = limit
+
+    def matches(self, proxy: Proxy, now: float = None) -> bool:
+        ''' Evaluate the filters on a single proxy '''
+        if self.protos:
+            if not proxy.proto_mask:
+                if self.strict:
+                    return False
+            elif not proxy.proto_mask & self.proto_mask:
+                return False
+
+        if self.countries:
+            if not proxy.exit_country:
+                if self.strict:
+                    return False
+            elif proxy.exit_country not in self.countries:
+                return False
+
+        if self.max_latency is not None or self.min_latency is not None:
+            if proxy.last_lat is None:
+                if self.strict:
+                    return False
+            elif self.max_latency is not None and proxy.last_lat > self.max_latency:
+                return False
+            elif self.min_latency is not None and proxy.last_lat < self.min_latency:
+                return False
+
+        if self.fresh or self.stale:
+            if not proxy.last_check:
+                if self.strict:
+                    return False
+            else:
+                now = now or time()
+                if self.fresh and proxy.last_check < now - self.fresh:
+                    return False
+                if self.stale and proxy.last_check >= now - self.stale:
+                    return False
+
+        if self.min_reliability is not None:
+            if not proxy.checks:
+                if self.strict:
+                    return False
+            elif proxy.reliability < self.min_reliability:
+                return False
+        return True
+
+    def apply(self, proxies: Iterable[Proxy]) -> Iterator[Proxy]:
+        '''
+        Lazily run the query over any stream of proxies.
+        With a limit, ordering only ever keeps `limit` proxies in memory.
+        '''
+        now = time()
+        matching = (p for p in proxies if self.matches(p, now))
+
+        if self.order is None:
+            count = 0
+            for proxy in matching:
+                yield proxy
+                count += 1
+                if count == self.limit:
+                    return
+            return
+
+        if self.order == 'random':
+            if self.limit:
+                # Keep a uniform random sample of `limit` proxies by random keys
+                heap = []
+                for proxy in matching:
+                    key = random()
+                    if len(heap) < self.limit:
+                        heappush(heap, (key, id(proxy), proxy))
+                    elif key > heap[0][0]:
+                        heapreplace(heap, (key, id(proxy), proxy))
+                selected = [item[2] for item in heap]
+            else:
+                selected = list(matching)
+            shuffle(selected)
+            yield from selected
+            return
+
+        key = {
+            'latency': self.latency_key,
+            'last_check': self.last_check_key,
+            'reliability': self.reliability_key,
+        }[self.order]
+        if self.limit:
+            yield from nsmallest(self.limit, matching, key=key)
+        else:
+            yield from sorted(matching, key=key)
+
+    @staticmethod
+    def latency_key(proxy: Proxy) -> tuple:
+        return (proxy.last_lat is None, proxy.last_lat or 0)
+
+    @staticmethod
+    def last_check_key(proxy: Proxy) -> float:
+        return -(proxy.last_check or 0)
+
+    @staticmethod
+    def reliability_key(proxy: Proxy) -> tuple:
+        return (-proxy.reliability, proxy.ewma_lat is None, proxy.ewma_lat or 0)
+
+
+class Storage(ABC):
+    '''
+    The interface of a ProxyDB storage backend.
+
+    Changes made with `put` and `delete` are only guaranteed to be persisted after `commit`.
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @abstractmethod
+    def put(self, proxy: Proxy) -> None:
+        ''' Insert or replace a proxy '''
+        raise NotImplementedError
+
+    def put_many(self, proxies: Iterable[Proxy]) -> int:
+        count = 0
+        for proxy in proxies:
+            self.put(proxy)
+            count += 1
+        return count
+
+    @abstractmethod
+    def delete(self, pip: str) -> None:
+        ''' Delete a proxy, raises KeyError if it's not stored '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, pip: str) -> Proxy:
+        ''' Get a proxy, raises KeyError if it's not stored '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def contains(self, pip: str) -> bool:
+        raise NotImplementedError
+
+    def contains_many(self, pips: Iterable[str]) -> Set[str]:
+        ''' Get which of the given proxies are stored '''
+        return {pip for pip in pips if self.contains(pip)}
+
+    @abstractmethod
+    def iterate(self) -> Iterator[Proxy]:
+        ''' Lazily iterate over all the stored proxies '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def query(self, query: Query) -> Iterator[Proxy]:
+        ''' Lazily iterate over the proxies matching a query '''
+        return query.apply(self.iterate())
+
+    def port_protocols(self) -> Dict[int, Dict[str, int]]:
+        ''' Count the proxies known to work with every protocol, per port '''
+        counts: Dict[int, Dict[str, int]] = {}
+        for proxy in self.iterate():
+            if proxy.proto_mask:
+                port_counts = counts.setdefault(proxy.port, {})
+                for proto in proxy.protos:
+                    port_counts[proto] = port_counts.get(proto, 0) + 1
+        return counts
+
+    @abstractmethod
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JSONStorage(Storage):
+    '''
+    The original storage: a single JSON file, rewritten as a whole on every commit.
+
+    It's in a form of:
+    {
+        '1.2.3.4:54321': {
+            'protos': ['socks5'],
+            'last_check': time.time(),
+            'last_lat': 0.32,
+            'exit_country': 'US',
+        },
+    }
+
+    The file is only parsed on first use, so opening the DB costs nothing.
+    '''
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._dict_config: Optional[DictConfig] = None
+
+    @property
+    def dict_config(self) -> DictConfig:
+        if self._dict_config is None:
+            self._dict_config = DictConfig(self.path, {}, quiet=True)
+        return self._dict_config
+
+    def put(self, proxy: Proxy) -> None:
+        self.dict_config.update(proxy.serialize())
+
+    def delete(self, pip: str) -> None:
+        self.dict_config.pop(pip)
+
+    def get(self, pip: str) -> Proxy:
+        return deserialize(pip, self.dict_config[pip])
+
+    def contains(self, pip: str) -> bool:
+        return pip in self.dict_config
+
+    def iterate(self) -> Iterator[Proxy]:
+        for pip, info in list(self.dict_config.items()):
+            yield deserialize(pip, info)
+
+    def count(self) -> int:
+        return len(self.dict_config)
+
+    def commit(self) -> None:
+        # Nothing could have changed if it was never loaded
+        if self._dict_config is not None:
+            self._dict_config.save()
+
+
+class SQLiteStorage(Storage):
+    '''
+    An indexed SQLite database (in WAL mode):
+    single proxy changes and filtered lookups don't have to touch the whole DB.
+
+    Protocols are kept in a comma separated column for cheap reads,
+    and mirrored into the indexed `protos` table for lookups by protocol.
+    The check history is stored packed (see `Proxy`), with its derived reliability indexed.
+
+    Older DBs are upgraded by the `migrations` above their `user_version` in a single transaction
+    (a failed upgrade leaves the DB as it was),
+    opening an up to date DB only reads its version (no write transaction),
+    a DB of a newer version (from a newer proxion) is refused rather than written to.
+    '''
+
+    schema_version = 2
+    schema = '''
+        CREATE TABLE IF NOT EXISTS proxies (
+            pip TEXT PRIMARY KEY,
+            protos TEXT NOT NULL DEFAULT '',
+            last_check REAL,
+            last_lat REAL,
+            exit_country TEXT,
+            outcomes INTEGER NOT NULL DEFAULT 0,
+            latencies BLOB,
+            ewma_lat REAL,
+            reliability REAL NOT NULL DEFAULT 0.5
+        );
+        CREATE TABLE IF NOT EXISTS protos (
+            proto TEXT NOT NULL,
+            pip TEXT NOT NULL,
+            PRIMARY KEY (proto, pip)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS protos_pip ON protos (pip);
+        CREATE INDEX IF NOT EXISTS proxies_exit_country ON proxies (exit_country);
+        CREATE INDEX IF NOT EXISTS proxies_last_check ON proxies (last_check);
+        CREATE INDEX IF NOT EXISTS proxies_last_lat ON proxies (last_lat);
+        CREATE INDEX IF NOT EXISTS proxies_reliability ON proxies (reliability);
+    '''
+    migrations = {
+        2: '''
+            ALTER TABLE proxies ADD COLUMN outcomes INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE proxies ADD COLUMN latencies BLOB;
+            ALTER TABLE proxies ADD COLUMN ewma_lat REAL;
+            ALTER TABLE proxies ADD COLUMN reliability REAL NOT NULL DEFAULT 0.5;
+        ''',
+    }
+    columns = 'pip, protos, last_check, last_lat, exit_country, outcomes, latencies, ewma_lat, reliability'
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > self.schema_version:
+            self.conn.close()
+            raise ValueError(f'The proxy DB "{self.path}" is of a newer version ({version}) '
+                             'than this proxion supports, upgrade proxion')
+        if version == self.schema_version:
+            return
+        try:
+            self.upgrade()
+        except sqlite3.Error:
+            self.conn.close()
+            raise
+
+    def upgrade(self) -> None:
+        ''' Create or upgrade the schema, all at once or not at all '''
+        # executescript() commits first, so the statements are run one by one in our own transaction
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            # Another process may have upgraded it meanwhile
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'proxies'").fetchone()
+            if exists:
+                for target in sorted(self.migrations):
+                    if max(version, 1) < target:
+                        self.execute_statements(self.migrations[target])
+            self.execute_statements(self.schema)
+            self.conn.execute(f'PRAGMA user_version={self.schema_version}')
+
+    def execute_statements(self, script: str) -> None:
+        ''' Execute the `;` separated statements of `script` (in the current transaction) '''
+        for statement in script.split(';'):
+            if statement.strip():
+                self.conn.execute(statement)
+
+    def put(self, proxy: Proxy) -> None:
+        protos = sorted(proxy.protos)
+        self.conn.execute(
+            f'INSERT OR REPLACE INTO proxies ({self.columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (proxy.pip, ','.join(protos), proxy.last_check, proxy.last_lat, proxy.exit_country,
+             proxy.outcomes, proxy.packed_latencies or None, proxy.ewma_lat, proxy.reliability))
+        self.conn.execute('DELETE FROM protos WHERE pip = ?', (proxy.pip,))
+        self.conn.executemany('INSERT INTO protos (proto, pip) VALUES (?, ?)',
+                              ((proto, proxy.pip) for proto in protos))
+
+    def delete(self, pip: str) -> None:
+        if not self.conn.execute('DELETE FROM proxies WHERE pip = ?', (pip,)).rowcount:
+            raise KeyError(pip)
+        self.conn.execute('DELETE FROM protos WHERE pip = ?', (pip,))
+
+    def get(self, pip: str) -> Proxy:
+        row = self.conn.execute(
+            f'SELECT {self.columns} FROM proxies WHERE pip = ?', (pip,)).fetchone()
+        if row is None:
+            raise KeyError(pip)
+        return self.from_row(row)
+
+    def contains(self, pip: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM proxies WHERE pip = ?', (pip,)).fetchone() is not None
+
+    def contains_many(self, pips: Iterable[str]) -> Set[str]:
+        pips = list(pips)
+        found = set()
+        # Stay below SQLite's limit of bound variables per statement
+        for i in range(0, len(pips), 900):
+            chunk = pips[i:i + 900]
+            found.update(row[0] for row in self.conn.execute(
+                f'SELECT pip FROM proxies WHERE pip IN ({", ".join("?" * len(chunk))})', chunk))
+        return found
+
+    def iterate(self) -> Iterator[Proxy]:
+        for row in self.conn.execute(f'SELECT {self.columns} FROM proxies'):
+            yield self.from_row(row)
+
+    def count(self) -> int:
+        return self.conn.execute('SELECT count(*) FROM proxies').fetchone()[0]
+
+    def query(self, query: Query) -> Iterator[Proxy]:
+        ''' Evaluate the query in SQL, so only the matching rows are read '''
+        where: List[str] = []
+        params: list = []
+
+        def add_filter(clause: str, column: str, *values, empty: str = None) -> None:
+            # Missing like `Query.matches` sees it: NULL or else falsy (the `empty` value)
+            if not query.strict:
+                clause = f'({column} IS NULL OR {clause})' if empty is None else \
+                    f'({column} IS NULL OR {column} = {empty} OR {clause})'
+            elif empty is not None:
+                clause = f'({column} != {empty} AND {clause})'
+            where.append(clause)
+            params.extend(values)
+
+        def placeholders(values: Iterable) -> str:
+            return ', '.join('?' * len(values))
+
+        if query.protos:
+            protos = sorted(query.protos)
+            clause = f'pip IN (SELECT pip FROM protos WHERE proto IN ({placeholders(protos)}))'
+            if not query.strict:
+                clause = f"(protos = '' OR {clause})"
+            where.append(clause)
+            params.extend(protos)
+        if query.countries:
+            countries = sorted(query.countries)
+            add_filter(f'exit_country IN ({placeholders(countries)})', 'exit_country', *countries,
+                       empty="''")
+        if query.max_latency is not None:
+            add_filter('last_lat <= ?', 'last_lat', query.max_latency)
+        if query.min_latency is not None:
+            add_filter('last_lat >= ?', 'last_lat', query.min_latency)
+        now = time()
+        if query.fresh:
+            add_filter('last_check >= ?', 'last_check', now - query.fresh, empty='0')
+        if query.stale:
+            add_filter('last_check < ?', 'last_check', now - query.stale, empty='0')
+        if query.min_reliability is not None:
+            # Proxies never checked have no history (rather than a NULL)
+            where.append('(outcomes > 0 AND reliability >= ?)' if query.strict else
+                         '(outcomes = 0 OR reliability >= ?)')
+            params.append(query.min_reliability)
+
+        sql = f'SELECT {self.columns} FROM proxies'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += {
+            None: '',
+            'random': ' ORDER BY random()',
+            'latency': ' ORDER BY last_lat IS NULL, last_lat',
+            'last_check': ' ORDER BY last_check IS NULL, last_check DESC',
+            'reliability': ' ORDER BY reliability DESC, ewma_lat IS NULL, ewma_lat',
+        }[query.order]
+        if query.limit:
+            sql += ' LIMIT ?'
+            params.append(query.limit)
+
+        for row in self.conn.execute(sql, params):
+            yield self.from_row(row)
+
+    def port_protocols(self) -> Dict[int, Dict[str, int]]:
+        counts: Dict[int, Dict[str, int]] = {}
+        for port, proto, count in self.conn.execute(
+                "SELECT CAST(substr(pip, instr(pip, ':') + 1) AS INTEGER) AS port, proto, count(*) "
+                'FROM protos GROUP BY port, proto'):
+            counts.setdefault(port, {})[proto] = count
+        return counts
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @staticmethod
+    def from_row(row: tuple) -> Proxy:
+        pip, protos, last_check, last_lat, exit_country, outcomes, latencies, ewma_lat, _ = row
+        return Proxy.trusted(pip, joined_protos_to_mask(protos), last_check, last_lat, exit_country,
+                             outcomes, latencies, ewma_lat)
+
+
+storage_backends = {
+    '.json': JSONStorage,
+    '.sqlite': SQLiteStorage,
+    '.sqlite3': SQLiteStorage,
+    '.db': SQLiteStorage,
+}
+
+
+def get_storage_backend(path: Path) -> Type[Storage]:
+    ''' Pick a storage backend by the DB file's extension '''
+    try:
+        return storage_backends[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f'Unknown proxy DB format: "{path}" ' +
+                         f'(expected one of: {", ".join(storage_backends)})')
+
+
+def migrate(source: Storage, destination: Storage) -> int:
+    ''' Copy all proxies from one storage into another '''
+    count = destination.put_many(source.iterate())
+    destination.commit()
+    return count
+
+
+def deserialize(pip: str, info: dict) -> Proxy:
+    history = info.get('history') or {}
+    outcomes, latencies = Proxy.pack_history((c == '1' for c in history.get('outcomes', '')),
+                                             history.get('latencies', ()))
+    return Proxy.trusted(pip, protos_to_mask(info.get('protos') or ()),
+                         info.get('last_check'), info.get('last_lat'), info.get('exit_country'),
+                         outcomes, latencies, history.get('ewma_lat'))
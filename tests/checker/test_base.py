@@ -0,0 +1,12 @@
+from proxion.util import Proxy
+from proxion.checker.base import BaseChecker
+
+
+def test_on_result_tally():
+    checker = BaseChecker([Proxy('1.1.1.1:80')])
+    checker.on_result('1.1.1.1:80', Proxy('1.1.1.1:80', ['http'], 1, 0.1), 1)
+    checker.on_result('1.1.1.1:80', Proxy('1.1.1.1:80', ['https'], 1, 0.1), 1)
+    checker.on_result('2.2.2.2:80', None, 1)
+    checker.on_result('3.3.3.3:80', Proxy('3.3.3.3:80', ['http'], 1, 0.1), 1)
+    assert checker.tally == {'socks5': 0, 'socks4': 0, 'https': 1, 'http': 2}
+    assert len(checker.up) == 3
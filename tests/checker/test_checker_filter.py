@@ -0,0 +1,52 @@
+from proxion.checker.checker_filter import *
+
+
+def test_build_joblist():
+    checklist = [Proxy('1.1.1.1:80', ['http', 'https']), Proxy('2.2.2.2:1080')]
+    pcf = CheckerFilter(set(), None, None, None, False)
+
+    jobs = pcf.build_joblist(checklist, no_shuffle=True)
+    assert sorted((p.pip, proto) for p, proto in jobs) == sorted(
+        [('1.1.1.1:80', 'http'), ('1.1.1.1:80', 'https')] +
+        [('2.2.2.2:1080', proto) for proto in Defaults.checker_proxy_protocols])
+
+    # Grouped jobs hold all the protocols of a proxy in a stable order
+    jobs = pcf.build_joblist(checklist, no_shuffle=True, group=True)
+    assert sorted((p.pip, protos) for p, protos in jobs) == [
+        ('1.1.1.1:80', ('https', 'http')),
+        ('2.2.2.2:1080', ('socks5', 'socks4', 'https', 'http')),
+    ]
+
+    # Strictly filtering by protocol skips proxies with unknown protocols
+    pcf = CheckerFilter({'socks5'}, None, None, None, True)
+    assert pcf.build_joblist(checklist, no_shuffle=True) == []
+
+
+def test_stream_jobs():
+    checklist = [Proxy('1.1.1.1:80', ['http', 'https']), Proxy('2.2.2.2:1080')]
+    pcf = CheckerFilter(set(), None, None, None, False)
+
+    # Unshuffled, the jobs are generated as they are consumed
+    jobs, count = pcf.stream_jobs(checklist, no_shuffle=True)
+    assert not isinstance(jobs, list) and count == 6
+    assert list(jobs) == pcf.build_joblist(checklist, no_shuffle=True)
+    jobs, count = pcf.stream_jobs(checklist, no_shuffle=True, group=True)
+    assert count == 6 and [p.pip for p, _ in jobs] == ['1.1.1.1:80', '2.2.2.2:1080']
+
+    jobs, count = pcf.stream_jobs(checklist, no_shuffle=False)
+    assert count == 6 and sorted((p.pip, proto) for p, proto in jobs) == sorted(
+        (p.pip, proto) for p, proto in pcf.build_joblist(checklist, no_shuffle=True))
+
+
+def test_protocol_ranker():
+    ranker = ProtocolRanker({1080: {'socks4': 5, 'socks5': 3}, 8080: {'http': 9}})
+    checklist = [Proxy('1.1.1.1:1080'), Proxy('2.2.2.2:3128'), Proxy('3.3.3.3:8080', ['https', 'socks5'])]
+    pcf = CheckerFilter(set(), None, None, None, False, ranker=ranker)
+
+    # Per port history first, then over all the ports, then the default order
+    jobs = dict((p.pip, protos) for p, protos in pcf.build_joblist(checklist, no_shuffle=True, group=True))
+    assert jobs == {
+        '1.1.1.1:1080': ('socks4', 'socks5', 'http', 'https'),
+        '2.2.2.2:3128': ('http', 'socks4', 'socks5', 'https'),
+        '3.3.3.3:8080': ('socks5', 'https'),
+    }
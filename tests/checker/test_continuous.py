@@ -0,0 +1,53 @@
+from collections import Counter
+from time import time
+import asyncio
+
+from proxion.util import Proxy, ProxyDB, ProxyDBCommitter
+from proxion.checker import CheckerFilter
+from proxion.checker.continuous import ContinuousChecker
+
+
+class ScriptedChecker(ContinuousChecker):
+    ''' Only 1.1.1.1:80 works (for HTTP), interrupted once `stop_after` rounds are done '''
+
+    idle_poll = 0.01
+    stop_after = 6
+
+    def __init__(self, *args, **kwargs):
+        self.rounds_of = Counter()
+        super().__init__(*args, **kwargs)
+
+    async def perform_check(self, pip, protocol, timeout=None):
+        if self.rounds >= self.stop_after:
+            # Like a ^C, from the event loop itself rather than from within a task
+            asyncio.get_running_loop().call_soon(self.interrupt)
+            await asyncio.sleep(1)
+        if pip == '1.1.1.1:80' and protocol == 'http':
+            return Proxy(pip, [protocol], time(), 0.1), 'ok'
+        return None, 'connection'
+
+    def set_working(self, pip, protos):
+        self.rounds_of[pip] += 1
+        super().set_working(pip, protos)
+
+    @staticmethod
+    def interrupt():
+        raise KeyboardInterrupt
+
+
+def test_continuous_checker_rounds(tmp_path):
+    ProxyDB(tmp_path / 'proxydb.sqlite')
+    # All the rounds land in a single commit, at the end
+    committer = ProxyDBCommitter(batch_size=100, interval=3600)
+    checker = ScriptedChecker([Proxy('1.1.1.1:80'), Proxy('2.2.2.2:80')], 2, 1,
+                              CheckerFilter(set(), 0, 0, None, False), committer=committer, interval=0.05)
+    assert checker.rounds >= ScriptedChecker.stop_after
+    # Only the latest round of every proxy counts, however many were done
+    assert checker.up == {'1.1.1.1:80': ['http']}
+    assert checker.tally == {'socks5': 0, 'socks4': 0, 'https': 0, 'http': 1}
+
+    # Every round recorded on its own
+    rounds = checker.rounds_of['1.1.1.1:80']
+    assert rounds > 1
+    assert ProxyDB.get_proxy('1.1.1.1:80').history == (True,) * rounds
+    assert not ProxyDB.is_in('2.2.2.2:80')
@@ -0,0 +1,30 @@
+from proxion.util import Proxy
+from proxion.checker.base import BaseChecker
+from proxion.checker.latency import LatencyHistogram
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(0.95) is None
+    assert histogram.timeout(10) == 10
+
+    for i in range(100):
+        histogram.add(0.1 + i / 100)  # 0.1 - 1.09
+    assert 0.95 <= histogram.percentile(0.5) / 0.6 <= 1.1
+    assert 1.0 <= histogram.percentile(0.95) <= 1.2
+    histogram.add(1000)  # Way over the max latency, lands in the last bucket
+    assert histogram.percentile(1) >= 120
+
+
+def test_adaptive_check_timeout():
+    checker = BaseChecker([Proxy('1.1.1.1:80')], timeout=10, adaptive_timeout=True)
+    fast, slow = Proxy('1.1.1.1:80'), Proxy('2.2.2.2:80', last_lat=2.5)
+    assert checker.check_timeout(fast) == 10
+
+    for _ in range(50):
+        checker.on_result('3.3.3.3:80', Proxy('3.3.3.3:80', ['http'], 1, 0.2), 1)
+    assert 0.3 <= checker.base_timeout() <= 0.35
+    # Never below the floor, slow proxies keep their hint, never above the user's timeout
+    assert checker.check_timeout(fast) == 1
+    assert checker.check_timeout(slow) == 7.5
+    assert checker.check_timeout(Proxy('4.4.4.4:80', last_lat=9)) == 10
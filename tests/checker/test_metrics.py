@@ -0,0 +1,53 @@
+from json import loads
+from urllib.request import urlopen
+
+from proxion.util import Proxy
+from proxion.checker.base import BaseChecker
+from proxion.checker.metrics import CheckerMetrics, MetricsExporter
+
+
+def test_checker_metrics():
+    metrics = CheckerMetrics()
+    metrics.queue(('http', 'socks5'))
+    metrics.start('http')
+    metrics.start('socks5')
+    metrics.finish('http', 'ok', 0.2)
+    assert metrics.in_flight == 1
+    metrics.finish('socks5', 'timeout', 10)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['queued'] == {'http': 1, 'socks5': 1}
+    assert snapshot['finished'] == {'http': {'ok': 1}, 'socks5': {'timeout': 1}}
+    assert snapshot['in_flight'] == 0
+    assert snapshot['durations']['http']['ok']['buckets']['0.25'] == 1
+    assert snapshot['durations']['http']['ok']['buckets']['0.1'] == 0
+
+    text = metrics.prometheus()
+    assert 'proxion_checks_queued_total{protocol="http"} 1' in text
+    assert 'proxion_checks_finished_total{protocol="socks5",outcome="timeout"} 1' in text
+    assert 'proxion_check_duration_seconds_bucket{protocol="socks5",outcome="timeout",le="5"} 0' in text
+    assert 'proxion_check_duration_seconds_bucket{protocol="socks5",outcome="timeout",le="10"} 1' in text
+    assert 'proxion_check_duration_seconds_count{protocol="http",outcome="ok"} 1' in text
+
+
+def test_metrics_exporter(tmp_path):
+    jsonl_file = tmp_path / 'metrics.jsonl'
+    exporter = MetricsExporter(jsonl_file, 0, interval=60)
+    checker = BaseChecker([Proxy('1.1.1.1:80')], timeout=5, exporter=exporter)
+    checker.metrics.start('https')
+    checker.on_check('1.1.1.1:80', 'https', 'tls', 0.5)
+
+    exporter.start()
+    try:
+        text = urlopen(f'http://127.0.0.1:{exporter.port}/metrics').read().decode()
+        assert 'proxion_checks_finished_total{protocol="https",outcome="tls"} 1' in text
+        assert 'proxion_check_timeout_seconds 5' in text
+    finally:
+        exporter.close()
+
+    assert exporter.maybe_write()
+    assert not exporter.maybe_write()  # Not yet
+    checker.export_metrics(final=True)
+    lines = jsonl_file.read_text().splitlines()
+    assert len(lines) == 2
+    assert loads(lines[-1])['finished'] == {'https': {'tls': 1}}
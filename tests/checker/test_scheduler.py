@@ -0,0 +1,49 @@
+from proxion.checker.scheduler import RecheckScheduler
+from proxion.util import Proxy
+
+
+def _proxy(pip: str, last_check: float = None, history: str = '') -> Proxy:
+    proxy = Proxy(pip, ['http'] if '1' in history else None, last_check)
+    for success in reversed(history):
+        proxy.record(success == '1', 0.1)
+    return proxy
+
+
+def test_recheck_after():
+    scheduler = RecheckScheduler(interval=100, backoff=2, max_interval=1000)
+    assert scheduler.recheck_after(_proxy('1.1.1.1:80', 1, '1' * 8)) == 100 / 0.9
+    # Unreliable proxies are rechecked less often
+    assert scheduler.recheck_after(_proxy('1.1.1.1:80', 1, '1010')) > 100 / 0.9
+    # Dead ones back off exponentially with their consecutive failures
+    assert scheduler.recheck_after(_proxy('1.1.1.1:80', 1, '01')) == 200
+    assert scheduler.recheck_after(_proxy('1.1.1.1:80', 1, '0001')) == 800
+    assert scheduler.recheck_after(_proxy('1.1.1.1:80', 1, '0' * 16)) == 1000
+    # Checked before the history was kept
+    assert scheduler.recheck_after(Proxy('1.1.1.1:80', None, 1)) == 200
+
+
+def test_scheduler_order():
+    jobs = [(_proxy('1.1.1.1:80', 1000, '1'), ('http',)),
+            (_proxy('2.2.2.2:80'), ('http', 'socks5')),
+            (_proxy('3.3.3.3:80', 900, '0'), ('http',)),
+            (_proxy('4.4.4.4:80', 1010, '1'), ('http',))]
+    scheduler = RecheckScheduler(jobs, interval=100)
+    assert len(scheduler) == 4
+    assert scheduler.count_due(0) == 2
+    assert scheduler.count_due(2000) == 5
+
+    # Never checked proxies are due right away
+    proxy, protos = scheduler.pop_due(0)
+    assert (proxy.pip, protos) == ('2.2.2.2:80', ('http', 'socks5'))
+    assert scheduler.pop_due(0) is None
+    assert scheduler.wait_time(0) == 1100
+
+    assert [scheduler.pop_due(2000)[0].pip for _ in range(3)] == ['3.3.3.3:80', '1.1.1.1:80', '4.4.4.4:80']
+    assert scheduler.pop_due(2000) is None
+    assert scheduler.wait_time() is None
+
+    # A proxy pushed back is due again after its last check
+    proxy.record(True, 0.1)
+    proxy.last_check = 2000
+    scheduler.push(proxy, protos)
+    assert scheduler.wait_time(2000) == 100 / proxy.reliability
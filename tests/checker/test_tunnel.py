@@ -0,0 +1,71 @@
+import asyncio
+from struct import pack
+
+from pytest import raises
+
+from proxion.checker.tunnel import *
+
+
+async def _serve_once(handler):
+    ''' Start a one-shot local server and return a connected (proxy) socket to it '''
+    server = await asyncio.start_server(handler, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, await open_socket('127.0.0.1', port)
+
+
+def test_negotiate_socks5():
+    async def handler(reader, writer):
+        assert await reader.readexactly(3) == b'\x05\x01\x00'
+        writer.write(b'\x05\x00')
+        head = await reader.readexactly(5)
+        assert head[:4] == b'\x05\x01\x00\x03'
+        assert await reader.readexactly(head[4] + 2) == b'example.com' + pack('>H', 443)
+        writer.write(b'\x05\x00\x00\x01' + bytes(4) + pack('>H', 0))
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server, sock = await _serve_once(handler)
+        async with server:
+            await negotiate(sock, 'socks5', 'example.com', 443)
+            sock.close()
+
+    asyncio.run(run())
+
+
+def test_negotiate_socks4_rejected():
+    async def handler(reader, writer):
+        assert (await reader.readexactly(9))[:4] == b'\x04\x01' + pack('>H', 80)
+        writer.write(b'\x00\x5b' + bytes(6))
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server, sock = await _serve_once(handler)
+        async with server:
+            with raises(TunnelError):
+                await negotiate(sock, 'socks4', '127.0.0.1', 80)
+            sock.close()
+
+    asyncio.run(run())
+
+
+def test_negotiate_http_connect():
+    async def handler(reader, writer):
+        assert await reader.readline() == b'CONNECT example.com:443 HTTP/1.1\r\n'
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server, sock = await _serve_once(handler)
+        async with server:
+            await negotiate(sock, 'https', 'example.com', 443)
+            sock.close()
+
+            # Unknown protocols are refused before touching the socket
+            with raises(ValueError):
+                await negotiate(sock, 'gopher', 'example.com', 443)
+
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+import asyncio
+from json import loads
+from time import sleep
+
+from proxion.util import Proxy, ProxyDB
+from proxion.server import ApiServer
+
+
+async def get(port: int, target: str, headers: str = '') -> tuple:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {target} HTTP/1.1\r\nConnection: close\r\n{headers}\r\n'.encode())
+    head, _, body = (await reader.read()).partition(b'\r\n\r\n')
+    writer.close()
+    lines = head.decode().split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines[1:])
+    return int(lines[0].split(' ')[1]), headers, body
+
+
+def test_api(tmp_path):
+    db_file = tmp_path / 'proxydb.json'
+    ProxyDB(db_file)
+    ProxyDB.update_some([Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'),
+                         Proxy('2.2.2.2:1080', ['socks5'], 1, 2.5, 'BB'),
+                         Proxy('3.3.3.3:1080', ['socks5'], 1, 0.2, 'AA')])
+
+    async def run():
+        api = ApiServer('127.0.0.1', 0, db_file, reload_interval=0)
+        async with await api.start():
+            status, _, body = await get(api.port, '/proxies?num=2&protocols=socks5,http&info=0')
+            assert status == 200
+            assert len(set(loads(body))) == 2
+
+            status, _, body = await get(api.port, '/proxies?country=aa&max_latency=1&protocols=socks5')
+            assert list(loads(body)[0]) == ['3.3.3.3:1080']
+
+            status, _, body = await get(api.port, '/proxies?format=grep&info=0&protocols=socks5&country=AA,BB')
+            assert sorted(body.decode().split()) == ['2.2.2.2:1080', '3.3.3.3:1080']
+
+            # Responses in the DB order are cached, with an ETag
+            status, headers, body = await get(api.port, '/proxies?shuffle=0&info=0')
+            assert loads(body) == ['1.1.1.1:80', '2.2.2.2:1080', '3.3.3.3:1080']
+            etag = headers['ETag']
+            status, _, body = await get(api.port, '/proxies?shuffle=0&info=0', f'If-None-Match: {etag}\r\n')
+            assert (status, body) == (304, b'')
+
+            # Until the DB changes
+            sleep(0.01)
+            ProxyDB.remove_one(Proxy('2.2.2.2:1080'))
+            status, headers, body = await get(api.port, '/proxies?shuffle=0&info=0', f'If-None-Match: {etag}\r\n')
+            assert status == 200
+            assert loads(body) == ['1.1.1.1:80', '3.3.3.3:1080']
+            assert headers['ETag'] != etag
+            assert api.generation == 1
+
+            assert (await get(api.port, '/proxies?protocols=ftp'))[0] == 400
+            assert (await get(api.port, '/proxies?num=x'))[0] == 400
+            assert (await get(api.port, '/nothing'))[0] == 404
+            status, _, body = await get(api.port, '/health')
+            assert loads(body) == {'proxies': 2, 'generation': 1}
+        api.pool.close()
+
+    asyncio.run(asyncio.wait_for(run(), 20))
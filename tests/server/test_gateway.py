@@ -0,0 +1,101 @@
+import asyncio
+from json import loads
+
+from proxion.util import Proxy
+from proxion.server import JudgeServer, GatewayServer, UpstreamSelector
+from proxion.checker.tunnel import open_socket, negotiate_socks5
+
+
+async def socks5_proxy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    ''' A minimal SOCKS5 proxy (no authentication, domain names only) '''
+    await reader.readexactly(3)
+    writer.write(b'\x05\x00')
+    head = await reader.readexactly(5)
+    dest = await reader.readexactly(head[4] + 2)
+    up_reader, up_writer = await asyncio.open_connection(dest[:-2].decode(), int.from_bytes(dest[-2:], 'big'))
+    writer.write(b'\x05\x00\x00\x01' + bytes(6))
+
+    async def pipe(src, dst):
+        while data := await src.read(65536):
+            dst.write(data)
+            await dst.drain()
+        dst.close()
+    await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+
+
+async def read_response(reader: asyncio.StreamReader) -> dict:
+    head = (await reader.readuntil(b'\r\n\r\n')).decode().lower()
+    assert head.startswith('http/1.1 200')
+    length = int(head.split('content-length:')[1].split('\r\n')[0])
+    return loads(await reader.readexactly(length))
+
+
+def test_selector_strategies():
+    proxies = [Proxy('1.1.1.1:80', ['socks5'], 1, 0.5, 'AA'), Proxy('2.2.2.2:80', ['http'], 1, 0.1, 'BB'),
+               Proxy('3.3.3.3:80', ['https'], 1, 0.3, 'AA'), Proxy('4.4.4.4:80')]
+
+    selector = UpstreamSelector(proxies, 'round_robin')
+    assert len(selector) == 3
+    assert [selector.pick().pip for _ in range(4)] == ['1.1.1.1:80', '3.3.3.3:80', '1.1.1.1:80', '3.3.3.3:80']
+    # Plain HTTP requests may go to HTTP proxies as well
+    assert [selector.pick(plain_http=True).pip for _ in range(2)] == ['1.1.1.1:80', '2.2.2.2:80']
+    assert selector.pick('bb') is None
+    assert selector.pick('bb', plain_http=True).pip == '2.2.2.2:80'
+
+    selector = UpstreamSelector(proxies, 'latency')
+    assert selector.pick(plain_http=True).pip == '2.2.2.2:80'
+    assert selector.pick().pip == '3.3.3.3:80'
+    selector.failed(proxies[2])
+    assert selector.pick().pip == '1.1.1.1:80'
+    assert selector.pick(exclude={'1.1.1.1:80'}) is None
+
+
+def test_gateway():
+    async def run():
+        judge = JudgeServer('127.0.0.1', 0)
+        upstream = await asyncio.start_server(socks5_proxy, '127.0.0.1', 0)
+        dead = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+        upstreams = [Proxy(f'127.0.0.1:{server.sockets[0].getsockname()[1]}', ['socks5'])
+                     for server in (dead, upstream)]
+        gateway = GatewayServer('127.0.0.1', 0, lambda: upstreams)
+
+        async with await judge.start(), upstream, await gateway.start():
+            # HTTP CONNECT, the dead upstream is tried first and the request is retried on the other
+            reader, writer = await asyncio.open_connection('127.0.0.1', gateway.port)
+            writer.write(f'CONNECT localhost:{judge.port} HTTP/1.1\r\n\r\n'.encode())
+            assert (await reader.readuntil(b'\r\n\r\n')).startswith(b'HTTP/1.1 200')
+            writer.write(b'GET /connect HTTP/1.1\r\nHost: judge\r\n\r\n')
+            assert (await read_response(reader))['path'] == '/connect'
+            writer.close()
+            assert gateway.failures == 1
+            assert upstreams[0].pip in gateway.selector.cooling
+
+            # Plain HTTP, trough a tunnel in origin-form
+            reader, writer = await asyncio.open_connection('127.0.0.1', gateway.port)
+            writer.write(f'GET http://localhost:{judge.port}/plain?a=1 HTTP/1.1\r\n'
+                         'Proxy-Connection: keep-alive\r\n\r\n'.encode())
+            echo = await read_response(reader)
+            assert echo['path'] == '/plain?a=1'
+            assert echo['headers']['Connection'] == 'close'
+            assert 'Proxy-Connection' not in echo['headers']
+            writer.close()
+
+            # SOCKS5
+            sock = await open_socket('127.0.0.1', gateway.port)
+            await negotiate_socks5(sock, 'localhost', judge.port)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            writer.write(b'GET /socks HTTP/1.1\r\nHost: judge\r\n\r\n')
+            assert (await read_response(reader))['path'] == '/socks'
+            writer.close()
+
+            # No upstream left for the country
+            reader, writer = await asyncio.open_connection('127.0.0.1', gateway.port)
+            writer.write(f'CONNECT localhost:{judge.port} HTTP/1.1\r\nX-Proxion-Country: US\r\n\r\n'.encode())
+            assert (await reader.readuntil(b'\r\n\r\n')).startswith(b'HTTP/1.1 502')
+            writer.close()
+
+            assert gateway.served == 3
+            assert gateway.pool.reused >= 1
+            gateway.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 20))
@@ -0,0 +1,43 @@
+import asyncio
+from json import loads
+
+from pytest import raises
+
+from proxion.server import JudgeServer
+from proxion.checker.judge_parsers import judge_parsers
+
+
+def test_judge_echo():
+    async def run():
+        judge = JudgeServer('127.0.0.1', 0)
+        async with await judge.start():
+            reader, writer = await asyncio.open_connection('127.0.0.1', judge.port)
+            for _ in range(2):  # Keep-alive
+                writer.write(b'GET /test HTTP/1.1\r\nHost: judge\r\nX-Forwarded-For: 1.2.3.4\r\n\r\n')
+                assert (await reader.readline()).startswith(b'HTTP/1.1 200')
+                headers = (await reader.readuntil(b'\r\n\r\n')).decode().lower()
+                length = int(headers.split('content-length:')[1].split('\r\n')[0])
+                body = await reader.readexactly(length)
+                echo = loads(body)
+                assert echo['ip'] == '127.0.0.1'
+                assert echo['path'] == '/test'
+                assert echo['headers']['X-Forwarded-For'] == '1.2.3.4'
+                assert judge_parsers['json'](200, body) == ('127.0.0.1', None)
+            writer.close()
+        assert judge.served == 2
+
+    asyncio.run(run())
+
+
+def test_judge_parsers():
+    assert judge_parsers['ipinfo'](200, b'{"ip": "1.2.3.4", "country": "US"}') == ('1.2.3.4', 'US')
+    assert judge_parsers['json'](200, b'{"origin": "1.2.3.4"}') == ('1.2.3.4', None)
+    assert judge_parsers['plain'](200, b'1.2.3.4\n') == ('1.2.3.4', None)
+    with raises(KeyError):
+        judge_parsers['ipinfo'](200, b'{"ip": "1.2.3.4"}')
+    with raises(ValueError):
+        judge_parsers['json'](200, b'<html>Blocked</html>')
+    with raises(ValueError):
+        judge_parsers['plain'](403, b'1.2.3.4')
+    with raises(ValueError):
+        judge_parsers['plain'](200, b'not an ip')
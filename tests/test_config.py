@@ -0,0 +1,12 @@
+from argparse import _SubParsersAction
+
+from proxion.config import Args
+
+
+def test_help_of_every_mode():
+    # argparse %-formats the help texts, a stray % breaks --help
+    parser = Args.build_parser()
+    assert parser.format_help()
+    subparsers = next(action for action in parser._actions if isinstance(action, _SubParsersAction))
+    for mode, subparser in subparsers.choices.items():
+        assert subparser.format_help(), mode
@@ -0,0 +1,28 @@
+from json import loads
+from pathlib import Path
+import os
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+# Only the modes checking or serving should import those (see benchmarks/bench_startup.py)
+HEAVY_MODULES = ('requests', 'urllib3', 'asyncio', 'multiprocessing', 'ssl', 'cProfile')
+
+
+def imported_by(tmp_path: Path, *argv: str) -> list:
+    ''' The heavy modules imported by running `proxion *argv` '''
+    (tmp_path / '.cache' / 'proxion').mkdir(parents=True, exist_ok=True)
+    code = ('import json, sys\n'
+            f'sys.argv = ["proxion", *{list(argv)!r}]\n'
+            'from proxion import main\n'
+            'main()\n'
+            f'print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))')
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                         env=dict(os.environ, HOME=str(tmp_path), PYTHONPATH=str(ROOT)))
+    return loads(out.stdout.splitlines()[-1])
+
+
+def test_lightweight_modes(tmp_path):
+    assert imported_by(tmp_path, 'add', '1.2.3.4:80') == []
+    assert imported_by(tmp_path, 'query', '-n', '1', '-f', 'grep') == []
+    assert imported_by(tmp_path, '--db-file', 'proxydb.json', 'query', '-n', '1') == []
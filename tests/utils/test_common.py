@@ -23,3 +23,11 @@ def test_is_ip_addr():
     assert is_ip_address('256.255.255.255') == False
     assert is_ip_address('-1.1.1.1') == False
     assert is_ip_address('a1.1.1.1') == False
+
+
+def test_parse_proxy():
+    assert parse_proxy('1.1.1.1:80') == '1.1.1.1:80'
+    assert parse_proxy(' 1.1.1.1:0080\n') == '1.1.1.1:80'
+    assert parse_proxy('01.1.1.1:80') is None
+    assert parse_proxy('1.1.1.1:80:80') is None
+    assert parse_proxy('1.1.1.1') is None
@@ -0,0 +1,69 @@
+import gzip
+import pickle
+
+from proxion.util import Proxy
+from proxion.util.geoip import *
+from proxion.checker import CheckerFilter
+from proxion.config import Config
+
+RANGES = '''ip_start,ip_end,country
+8.8.8.0,8.8.8.255,US
+"16777472","16778239","CN"
+1.0.0.0,1.0.0.255,AU
+2001:200::,2001:200:ffff::,JP
+9.0.0.0,9.0.0.255,-
+'''
+
+
+def test_geoip_lookup(tmp_path):
+    path = tmp_path / 'geoip.csv'
+    path.write_text(RANGES)
+    geoip = GeoIP(path)
+    assert geoip.count == 3
+    assert GeoIP.index_path(path).is_file()
+    assert geoip.lookup('1.0.0.0') == 'AU'
+    assert geoip.lookup('1.0.1.5') == 'CN'
+    assert geoip.lookup('8.8.8.255') == 'US'
+    assert geoip.lookup('8.8.9.0') is None
+    assert geoip.lookup('0.0.0.1') is None
+    assert geoip.lookup('9.0.0.1') is None
+
+    # Reopening (and unpickling in a worker) maps the compiled index
+    assert GeoIP(path).lookup('8.8.8.8') == 'US'
+    assert pickle.loads(pickle.dumps(geoip)).lookup('1.0.0.7') == 'AU'
+
+    # Gzip compressed CSVs work too
+    path = tmp_path / 'geoip.csv.gz'
+    path.write_bytes(gzip.compress(RANGES.encode()))
+    assert GeoIP(path).lookup('1.0.1.5') == 'CN'
+
+
+def test_checker_filter_geoip(tmp_path):
+    path = tmp_path / 'geoip.csv'
+    path.write_text(RANGES)
+    checklist = [Proxy(pip, ['http'], exit_country=country) for pip, country in (
+        ('8.8.8.8:80', None), ('1.0.0.1:80', None), ('1.0.0.2:80', 'US'), ('5.5.5.5:80', None))]
+
+    pcf = CheckerFilter({'http'}, None, None, ['us'], True, GeoIP(path))
+    assert pcf.query_args()['countries'] is None
+    jobs = pcf.build_joblist(checklist, no_shuffle=True)
+    assert sorted(p.pip for p, _ in jobs) == ['1.0.0.2:80', '8.8.8.8:80']
+
+    # Proxies GeoIP can't locate pass a non-strict filter
+    pcf = CheckerFilter({'http'}, None, None, ['us'], False, GeoIP(path))
+    jobs = pcf.build_joblist(checklist, no_shuffle=True)
+    assert sorted(p.pip for p, _ in jobs) == ['1.0.0.2:80', '5.5.5.5:80', '8.8.8.8:80']
+
+
+def test_geoip_read_only_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'geoip.csv'
+    path.write_text(RANGES)
+    # The index can't be written next to the CSV
+    (tmp_path / 'read-only').write_text('')
+    monkeypatch.setattr(GeoIP, 'index_path', staticmethod(lambda p: tmp_path / 'read-only' / 'geoip.csv.idx'))
+    monkeypatch.setattr(Config, 'store', tmp_path / 'store')
+
+    assert GeoIP(path).lookup('8.8.8.8') == 'US'
+    assert GeoIP.store_index_path(path).parent == tmp_path / 'store' / 'geoip'
+    assert GeoIP.store_index_path(path).is_file()
+    assert GeoIP(path).lookup('1.0.1.5') == 'CN'
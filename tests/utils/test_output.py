@@ -0,0 +1,33 @@
+from io import StringIO
+from json import dumps
+
+from proxion.util.output import *
+
+
+def _write(writer_class, proxies, **kwargs) -> str:
+    stream = StringIO()
+    with writer_class(stream, **kwargs) as writer:
+        for proxy in proxies:
+            writer.write(proxy)
+    return stream.getvalue()
+
+
+def test_json_writer():
+    proxies = [Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'), Proxy('2.2.2.2:1080')]
+    for lst in ([], proxies[:1], proxies):
+        serialized = [p.serialize() for p in lst]
+        assert _write(JSONWriter, lst) == dumps(serialized, indent=4) + '\n'
+        assert _write(JSONWriter, lst, inline=True) == dumps(serialized) + '\n'
+        assert _write(JSONWriter, lst, info=False) == dumps([p.pip for p in lst], indent=4) + '\n'
+
+
+def test_line_writers():
+    proxies = [Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'), Proxy('2.2.2.2:1080')]
+    assert _write(JSONLinesWriter, proxies, info=False) == '"1.1.1.1:80"\n"2.2.2.2:1080"\n'
+    assert _write(GrepWriter, proxies[:1]) == \
+        "1.1.1.1:80 ,protos:['http'] ,last_check:1 ,last_lat:0.5 ,exit_country:AA\n"
+    assert _write(CSVWriter, proxies).splitlines() == [
+        'pip,protos,last_check,last_lat,exit_country,ewma_lat,reliability',
+        '1.1.1.1:80,http,1,0.5,AA,,',
+        '2.2.2.2:1080,,,,,,',
+    ]
@@ -0,0 +1,85 @@
+from collections import Counter
+
+from proxion.util import Proxy, ProxyDB, ProxyPool
+from proxion.util.pool import sample_indices
+
+
+def test_sample_indices():
+    assert sorted(sample_indices(100)) == list(range(100))
+    assert list(sample_indices(0)) == []
+
+
+def test_pool_random():
+    pool = ProxyPool([
+        Proxy('1.1.1.1:80', ['http'], 1, 0.05, 'AA'),
+        Proxy('2.2.2.2:80', ['http', 'socks5'], 1, 0.3, 'aa'),
+        Proxy('3.3.3.3:80', ['socks5'], 1, 0.45, 'BB'),
+        Proxy('4.4.4.4:80', ['socks4'], 1, 20, 'BB'),
+        Proxy('5.5.5.5:80'),
+    ])
+    assert len(pool) == 5
+
+    def pips(n=0, **kwargs):
+        return sorted(p.pip for p in pool.random(n, **kwargs))
+
+    assert len(pips()) == 5
+    assert pips(protos=['http']) == ['1.1.1.1:80', '2.2.2.2:80']
+    assert pips(protos=['socks5', 'socks4'], country='bb') == ['3.3.3.3:80', '4.4.4.4:80']
+    assert pips(country='AA') == ['1.1.1.1:80', '2.2.2.2:80']
+    assert pips(country='ZZ') == []
+    # 0.3 and 0.45 share a bucket, only part of it is fast enough
+    assert pips(max_latency=0.4) == ['1.1.1.1:80', '2.2.2.2:80']
+    assert pips(max_latency=30) == ['1.1.1.1:80', '2.2.2.2:80', '3.3.3.3:80', '4.4.4.4:80']
+    assert len(pips(2)) == 2
+    assert len(pips(10)) == 5
+
+    # Every proxy gets picked
+    counts = Counter(p.pip for _ in range(500) for p in pool.random(1))
+    assert len(counts) == 5
+
+
+def test_pool_follows_db(tmp_path):
+    ProxyDB(tmp_path / 'proxydb.sqlite')
+    ProxyDB.update_one(Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'))
+    pool = ProxyPool()
+    try:
+        assert [p.pip for p in pool.random(0)] == ['1.1.1.1:80']
+
+        ProxyDB.update_some([Proxy('2.2.2.2:80', ['socks5'], 1, 0.5, 'BB'),
+                             Proxy('1.1.1.1:80', ['http'], 2, 0.5, 'CC')])
+        assert [p.pip for p in pool.random(0, country='BB')] == ['2.2.2.2:80']
+        assert [p.pip for p in pool.random(0, country='CC')] == ['1.1.1.1:80']
+        assert pool.random(0, country='AA') == []
+
+        ProxyDB.remove_one(Proxy('2.2.2.2:80'))
+        assert '2.2.2.2:80' not in pool
+        assert pool.random(0, protos=['socks5']) == []
+
+        # Opening another DB reloads the pool
+        ProxyDB(tmp_path / 'other.sqlite')
+        assert len(pool) == 0
+    finally:
+        pool.close()
+    ProxyDB.update_one(Proxy('3.3.3.3:80'))
+    assert len(pool) == 0
+
+
+def test_pool_proxy_changed_in_place(tmp_path):
+    ProxyDB(tmp_path / 'proxydb.sqlite')
+    pool = ProxyPool()
+    try:
+        proxy = Proxy('1.1.1.1:80', ['http'], 1, 0.05, 'AA')
+        ProxyDB.update_one(proxy)
+        # Changed by its owner, then put again
+        proxy.last_lat = 3.0
+        proxy.exit_country = 'BB'
+        ProxyDB.update_one(proxy)
+        assert len(pool) == 1
+        assert pool.random(0, max_latency=0.1) == []
+        assert pool.random(0, country='AA') == []
+        assert [p.pip for p in pool.random(0, country='BB', max_latency=5)] == ['1.1.1.1:80']
+
+        ProxyDB.remove_one(proxy)
+        assert len(pool) == 0 and pool.random(0) == []
+    finally:
+        pool.close()
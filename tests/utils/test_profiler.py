@@ -0,0 +1,40 @@
+from json import loads
+from threading import Thread
+import multiprocessing as mp
+import pstats
+
+from proxion.util import Profiler
+
+
+def _busy_worker():
+    with Profiler.profiled('worker'):
+        sum(range(10000))
+
+
+def test_profiler(tmp_path):
+    with Profiler.phase('unprofiled'):
+        pass
+    assert Profiler.stop() is None
+
+    output = tmp_path / 'run.prof'
+    Profiler.start(output)
+    with Profiler.phase('check'):
+        with Profiler.phase('save'):
+            with Profiler.phase('save'):  # Nested in itself, counted once
+                pass
+        thread = Thread(target=_busy_worker)
+        thread.start()
+        thread.join()
+        proc = mp.get_context('fork').Process(target=_busy_worker)
+        proc.start()
+        proc.join()
+    assert Profiler.stop() == output
+    assert not Profiler.enabled
+
+    assert set(Profiler.totals) == {'check', 'save'}
+    trace = loads((tmp_path / 'run.prof.trace.json').read_text())
+    names = [event['name'] for event in trace['traceEvents']]
+    assert sorted(names) == ['check', 'save', 'total', 'worker', 'worker']
+    # Both workers' profiles were merged in
+    stats = pstats.Stats(str(output))
+    assert sum(stats.stats[func][0] for func in stats.stats if 'builtins.sum' in func[2]) == 2
@@ -1,3 +1,7 @@
+import gzip
+import io
+import sys
+
 from proxion.util.proxy import *
 from pytest import raises
 
@@ -40,4 +44,72 @@ def test_proxy():
     assert items['last_check'] == p.last_check
     assert items['exit_country'] == p.exit_country
 
-# TODO add test_parse_file
\ No newline at end of file
+
+
+def test_proxy_compact():
+    p = Proxy(' 10.0.0.1:0080 ', ['socks5', 'http'], 1, 0.5, 'US')
+    assert not hasattr(p, '__dict__')
+    assert (p.pip, p.ip, p.port) == ('10.0.0.1:80', '10.0.0.1', 80)
+    assert p.protos == {'socks5', 'http'}
+    assert p.proto_mask == protos_to_mask(['http', 'socks5'])
+    assert p.exit_country is Proxy('10.0.0.2:80', exit_country='US').exit_country
+
+    with raises(ValueError):
+        p.protos = ['gopher']
+
+    # The trusted constructor builds the same proxy from stored values
+    t = Proxy.trusted('10.0.0.1:80', p.proto_mask, 1, 0.5, 'US')
+    assert t.serialize() == p.serialize() == {
+        '10.0.0.1:80': {'protos': ['socks5', 'http'], 'last_check': 1, 'last_lat': 0.5, 'exit_country': 'US'}
+    }
+    assert unpack_pip(pack_pip('255.255.255.255:65535')) == '255.255.255.255:65535'
+
+
+def test_parse_file(tmp_path):
+    lines = '1.1.1.1:80\nnot a proxy\n\n 2.2.2.2:1080 \n1.1.1.1:080\n256.1.1.1:80\n'
+    plain = tmp_path / 'list.txt'
+    plain.write_text(lines)
+    compressed = tmp_path / 'list.gz'
+    with gzip.open(compressed, 'wt') as f:
+        f.write(lines)
+
+    for path in (plain, compressed):
+        assert [p.pip for p in parse_proxies_file(path)] == ['1.1.1.1:80', '2.2.2.2:1080']
+
+    reader = ProxyListReader([plain, compressed])
+    assert list(reader) == ['1.1.1.1:80', '2.2.2.2:1080']
+    assert reader.rejected == 4
+    assert reader.duplicates == 4
+
+
+def test_proxy_list_reader_stdin(monkeypatch):
+    stdin = io.BytesIO(b'1.1.1.1:80\nnot a proxy\n')
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(stdin))
+    assert list(ProxyListReader(['-'])) == ['1.1.1.1:80']
+    assert not stdin.closed
+
+
+def test_proxy_history():
+    p = Proxy('1.1.1.1:80')
+    assert (p.checks, p.success_rate, p.reliability, p.history) == (0, None, 0.5, ())
+
+    p.record(True, 0.2)
+    p.record(False)
+    p.record(True, 0.4)
+    assert p.history == (True, False, True)
+    assert p.latencies == (0.4, 0.2)
+    assert abs(p.ewma_lat - (0.3 * 0.4 + 0.7 * 0.2)) < 1e-9
+    assert p.success_rate == 2 / 3
+    assert p.reliability == 3 / 5
+
+    # The ring buffers keep only the latest rounds
+    for _ in range(Proxy.history_size):
+        p.record(False)
+    assert p.history == (False,) * Proxy.history_size
+    assert len(p.latencies) == 2
+    assert p.reliability < 0.1
+
+    # update() merges the latest check, keeping the history
+    p.update(Proxy('1.1.1.1:80', ['http'], 1, 0.1))
+    assert p.checks == Proxy.history_size
+    assert p.serialize()['1.1.1.1:80']['history']['outcomes'] == '0' * Proxy.history_size
@@ -0,0 +1,242 @@
+from time import time
+
+from pytest import mark, raises
+
+from proxion.util.proxydb import *
+from proxion.util.storage import SQLiteStorage, Storage
+import sqlite3
+
+
+@mark.parametrize('db_file', ['proxydb.json', 'proxydb.sqlite'])
+def test_proxydb(tmp_path, db_file):
+    ProxyDB(tmp_path / db_file)
+    assert ProxyDB.update_some([Proxy('1.1.1.1:80', ['http', 'https'], 1, 0.5, 'AA'),
+                                Proxy('2.2.2.2:1080')]) == 2
+    assert ProxyDB.is_in('1.1.1.1:80')
+
+    proxy = ProxyDB.get_proxy('1.1.1.1:80')
+    assert proxy.protos == {'http', 'https'}
+    assert (proxy.last_check, proxy.last_lat, proxy.exit_country) == (1, 0.5, 'AA')
+    assert ProxyDB.get_proxy('2.2.2.2:1080').protos == set()
+
+    ProxyDB.remove_one(Proxy('2.2.2.2:1080'))
+    with raises(KeyError):
+        ProxyDB.remove_one(Proxy('2.2.2.2:1080'))
+    assert [p.pip for p in ProxyDB.get_proxies()] == ['1.1.1.1:80']
+
+    # Reopening keeps the committed state
+    ProxyDB(tmp_path / db_file)
+    assert list(ProxyDB.get_proxy_dict()) == ['1.1.1.1:80']
+
+
+def test_proxydb_migration(tmp_path):
+    ProxyDB(tmp_path / 'proxydb.json')
+    ProxyDB.update_one(Proxy('1.1.1.1:80', ['socks5'], 1, 0.5, 'AA'))
+
+    ProxyDB(tmp_path / 'proxydb.sqlite')
+    assert isinstance(ProxyDB.storage, SQLiteStorage)
+    assert ProxyDB.get_proxy('1.1.1.1:80').serialize() == \
+        Proxy('1.1.1.1:80', ['socks5'], 1, 0.5, 'AA').serialize()
+
+    with raises(ValueError):
+        ProxyDB(tmp_path / 'proxydb.txt')
+    # The DB already open is still usable
+    assert ProxyDB.is_in('1.1.1.1:80')
+
+
+def test_storage_interface():
+    with raises(TypeError):
+        Storage('proxydb')
+
+
+@mark.parametrize('db_file', ['proxydb.json', 'proxydb.sqlite'])
+def test_committer(tmp_path, db_file):
+    ProxyDB(tmp_path / db_file)
+    ProxyDB.update_one(Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'))
+
+    committer = ProxyDBCommitter(batch_size=3, interval=3600)
+    t = time()
+
+    # Failed checks only refresh proxies which are already known
+    committer.add('1.1.1.1:80', None, t)
+    committer.add('2.2.2.2:80', None, t)
+    assert committer.committed == 0
+    assert ProxyDB.get_proxy('1.1.1.1:80').last_check == 1
+
+    # Reaching the batch size commits everything pending
+    committer.add('3.3.3.3:1080', Proxy('3.3.3.3:1080', ['socks5'], t, 0.2, 'BB'), t)
+    assert committer.committed == 2
+    assert not committer.pending
+
+    known = ProxyDB.get_proxy('1.1.1.1:80')
+    assert known.last_check == t
+    assert known.last_lat == 0.5
+    assert known.protos == {'http'}
+    assert not ProxyDB.is_in('2.2.2.2:80')
+    assert ProxyDB.get_proxy('3.3.3.3:1080').exit_country == 'BB'
+
+    # Working protocols are merged into the known ones
+    committer.add('1.1.1.1:80', Proxy('1.1.1.1:80', ['https'], t + 1, 0.1, 'AA'), t + 1)
+    committer.commit()
+    known = ProxyDB.get_proxy('1.1.1.1:80')
+    assert known.protos == {'http', 'https'}
+    assert known.last_lat == 0.1
+
+
+def test_committer_rounds(tmp_path):
+    ProxyDB(tmp_path / 'proxydb.sqlite')
+    ProxyDB.update_one(Proxy('1.1.1.1:80', ['http'], 1, 0.5, 'AA'))
+    committer = ProxyDBCommitter(batch_size=10, interval=3600)
+    t = time()
+
+    # Rounds queued before the same commit are recorded one by one
+    committer.add_round('1.1.1.1:80', [Proxy('1.1.1.1:80', ['http'], t, 0.2),
+                                       Proxy('1.1.1.1:80', ['https'], t, 0.3)], t)
+    committer.add_round('1.1.1.1:80', [], t + 1)
+    committer.add_round('1.1.1.1:80', [Proxy('1.1.1.1:80', ['http'], t + 2, 0.4)], t + 2)
+    committer.add_round('2.2.2.2:80', [], t)
+    committer.add_round('2.2.2.2:80', [Proxy('2.2.2.2:80', ['socks5'], t + 1, 0.1)], t + 1)
+    assert committer.commit() == 2
+
+    proxy = ProxyDB.get_proxy('1.1.1.1:80')
+    assert proxy.history == (True, False, True)
+    assert proxy.latencies == (0.4, 0.3)
+    assert proxy.protos == {'http', 'https'}
+    assert ProxyDB.get_proxy('2.2.2.2:80').history == (True, False)
+
+
+@mark.parametrize('db_file', ['proxydb.json', 'proxydb.sqlite'])
+def test_query(tmp_path, db_file):
+    ProxyDB(tmp_path / db_file)
+    t = time()
+    ProxyDB.update_some([
+        Proxy('1.1.1.1:80', ['http'], t, 0.5, 'AA'),
+        Proxy('2.2.2.2:1080', ['socks5', 'socks4'], t - 3600, 0.2, 'BB'),
+        Proxy('3.3.3.3:8080', ['https'], t - 60, 1.5, 'AA'),
+        Proxy('4.4.4.4:3128'),
+    ])
+
+    def pips(**kwargs):
+        return [p.pip for p in ProxyDB.query(**kwargs)]
+
+    assert sorted(pips()) == ['1.1.1.1:80', '2.2.2.2:1080', '3.3.3.3:8080', '4.4.4.4:3128']
+    assert pips(protos={'socks5'}) == ['2.2.2.2:1080']
+    assert sorted(pips(protos={'socks5'}, strict=False)) == ['2.2.2.2:1080', '4.4.4.4:3128']
+    assert sorted(pips(countries=['aa'])) == ['1.1.1.1:80', '3.3.3.3:8080']
+    assert pips(max_latency=1, order='latency') == ['2.2.2.2:1080', '1.1.1.1:80']
+    assert pips(fresh=600, order='last_check') == ['1.1.1.1:80', '3.3.3.3:8080']
+    assert sorted(pips(stale=600, strict=False)) == ['2.2.2.2:1080', '4.4.4.4:3128']
+    assert pips(order='latency', limit=1) == ['2.2.2.2:1080']
+    assert len(pips(order='random', limit=2)) == 2
+
+    # Empty values are as missing as NULLs, for both storages
+    ProxyDB.update_one(Proxy('5.5.5.5:80', ['http'], 0, 0.1, ''))
+    assert sorted(pips(countries=['aa'], strict=False)) == ['1.1.1.1:80', '3.3.3.3:8080', '4.4.4.4:3128',
+                                                          '5.5.5.5:80']
+    assert sorted(pips(countries=['aa'])) == ['1.1.1.1:80', '3.3.3.3:8080']
+    assert '5.5.5.5:80' in pips(fresh=600, strict=False)
+    assert '5.5.5.5:80' not in pips(stale=600)
+    assert '5.5.5.5:80' in pips(stale=600, strict=False)
+
+
+@mark.parametrize('db_file', ['proxydb.json', 'proxydb.sqlite'])
+def test_port_protocols(tmp_path, db_file):
+    ProxyDB(tmp_path / db_file)
+    ProxyDB.update_some([Proxy('1.1.1.1:1080', ['socks5']), Proxy('2.2.2.2:1080', ['socks5', 'socks4']),
+                         Proxy('3.3.3.3:8080', ['http']), Proxy('4.4.4.4:8080')])
+    assert ProxyDB.port_protocols() == {1080: {'socks5': 2, 'socks4': 1}, 8080: {'http': 1}}
+
+
+def _with_history(proxy: Proxy, history: str, latency: float = 0.1) -> Proxy:
+    for success in reversed(history):
+        proxy.record(success == '1', latency)
+    return proxy
+
+
+@mark.parametrize('db_file', ['proxydb.json', 'proxydb.sqlite'])
+def test_history(tmp_path, db_file):
+    ProxyDB(tmp_path / db_file)
+    ProxyDB.update_some([
+        _with_history(Proxy('1.1.1.1:80', ['http']), '1111111110', 0.3),
+        _with_history(Proxy('2.2.2.2:80', ['http']), '1'),
+        _with_history(Proxy('3.3.3.3:80', ['http']), '0001'),
+        _with_history(Proxy('5.5.5.5:80', ['http']), '1111111110', 0.1),
+        Proxy('4.4.4.4:80', ['http']),
+    ])
+
+    # The history survives a round trip trough the DB
+    ProxyDB(tmp_path / db_file)
+    proxy = ProxyDB.get_proxy('1.1.1.1:80')
+    assert proxy.history == (True,) * 9 + (False,)
+    assert proxy.latencies == (0.3,) * 9
+    assert proxy.ewma_lat == 0.3
+
+    def pips(**kwargs):
+        return [p.pip for p in ProxyDB.query(**kwargs)]
+
+    assert pips(order='reliability') == ['5.5.5.5:80', '1.1.1.1:80', '2.2.2.2:80', '4.4.4.4:80', '3.3.3.3:80']
+    assert sorted(pips(min_reliability=0.6)) == ['1.1.1.1:80', '2.2.2.2:80', '5.5.5.5:80']
+    assert sorted(pips(min_reliability=0.6, strict=False)) == \
+        ['1.1.1.1:80', '2.2.2.2:80', '4.4.4.4:80', '5.5.5.5:80']
+
+    # Every committed round is recorded
+    committer = ProxyDBCommitter()
+    committer.add('3.3.3.3:80', Proxy('3.3.3.3:80', ['https'], 1, 0.2), 1)
+    committer.add('3.3.3.3:80', None, 1)
+    committer.add('4.4.4.4:80', None, 1)
+    committer.commit()
+    assert ProxyDB.get_proxy('3.3.3.3:80').history == (True, False, False, False, True)
+    assert ProxyDB.get_proxy('4.4.4.4:80').history == (False,)
+
+
+def test_sqlite_schema_migration(tmp_path):
+    path = tmp_path / 'proxydb.sqlite'
+    conn = sqlite3.connect(str(path))
+    conn.executescript('''
+        CREATE TABLE proxies (pip TEXT PRIMARY KEY, protos TEXT NOT NULL DEFAULT '',
+                              last_check REAL, last_lat REAL, exit_country TEXT);
+        INSERT INTO proxies VALUES ('1.1.1.1:80', 'http', 1, 0.5, 'AA');
+        PRAGMA user_version=1;
+    ''')
+    conn.close()
+
+    ProxyDB(path)
+    proxy = ProxyDB.get_proxy('1.1.1.1:80')
+    assert (proxy.last_lat, proxy.checks, proxy.reliability) == (0.5, 0, 0.5)
+    ProxyDB.update_one(_with_history(proxy, '10'))
+    ProxyDB(path)
+    assert ProxyDB.get_proxy('1.1.1.1:80').history == (True, False)
+
+
+def test_sqlite_failed_migration(tmp_path):
+    path = tmp_path / 'proxydb.sqlite'
+    conn = sqlite3.connect(str(path))
+    # Its second ALTER TABLE fails, the first one must be rolled back
+    conn.executescript('''
+        CREATE TABLE proxies (pip TEXT PRIMARY KEY, protos TEXT NOT NULL DEFAULT '',
+                              last_check REAL, last_lat REAL, exit_country TEXT, latencies BLOB);
+        PRAGMA user_version=1;
+    ''')
+    conn.close()
+
+    with raises(sqlite3.OperationalError):
+        ProxyDB(path)
+    ProxyDB.storage = None
+    conn = sqlite3.connect(str(path))
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(proxies)')]
+    assert columns == ['pip', 'protos', 'last_check', 'last_lat', 'exit_country', 'latencies']
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'protos'").fetchone() is None
+    conn.close()
+
+
+def test_sqlite_newer_schema(tmp_path):
+    path = tmp_path / 'proxydb.sqlite'
+    conn = sqlite3.connect(str(path))
+    conn.execute(f'PRAGMA user_version={SQLiteStorage.schema_version + 1}')
+    conn.close()
+    with raises(ValueError):
+        SQLiteStorage(path)
+    conn = sqlite3.connect(str(path))
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'proxies'").fetchone() is None
+    conn.close()